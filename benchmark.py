@@ -0,0 +1,668 @@
+from src.FeaturesData import *
+from src.ModelRegistry import *
+from src.Prefilter import *
+from src.RunReport import *
+from src.OutputData import *
+from src.WindowGate import *
+import sys
+import os
+import argparse
+import json
+import subprocess
+import multiprocessing
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import time
+import tracemalloc
+import urllib.request
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath("."))
+
+scriptDir = Path(__file__).resolve().parent
+
+def timeit(func, repeat: int) -> dict:
+    """ Best wall time over `repeat` runs and peak traced memory of one run """
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': best, 'peak_mb': peak / 2**20, 'result': result}
+
+def bench_hmm(hmmFiles: list, repeat: int):
+    """ Dict-based parse_hmm_multiprot vs streaming iterHmmProfiles """
+
+    for hmmFile in hmmFiles:
+        legacy = timeit(lambda: parse_hmm_multiprot(hmmFile), repeat)
+        streaming = timeit(lambda: dict(iterHmmProfiles(hmmFile)), repeat)
+
+        for name, emissions in streaming['result'].items():
+            reference = np.array([list(state.values()) for state in legacy['result'][name]], dtype=np.float32)
+            if not np.array_equal(reference, emissions):
+                raise Exception("Parsers disagree on protein " + name + " of " + str(hmmFile))
+
+        print(Path(hmmFile).name)
+        for label, run in (('parse_hmm_multiprot', legacy), ('iterHmmProfiles', streaming)):
+            print(f"  {label:<20} {run['seconds'] * 1000:10.1f} ms {run['peak_mb']:10.2f} MB peak")
+        print(f"  speed-up {legacy['seconds'] / streaming['seconds']:.1f}x")
+
+def sample_features() -> FeaturesData:
+    """ Features of the zar1_rpp1 sample, built from the reference jackhmmer output (no jackhmmer needed) """
+
+    ref = str(scriptDir) + '/sample/output_ref/'
+    seqData = dict(readFasta(ref + 'zar1_rpp1.fasta_proc'))
+    hmm_it1 = dict(iterHmmProfiles(ref + 'zar1_rpp1-1.hmm'))
+    hmm_it2 = dict(iterHmmProfiles(ref + 'zar1_rpp1-2.hmm'))
+
+    return FeaturesData(seqData=seqData, hmmData=generateInputFile(seqData, hmm_it1, hmm_it2))
+
+def bench_models(modelsDir: Path, bundle: Path, repeat: int, tolerance: float = 1e-6):
+    """ NumPy forward pass of the .npz bundle vs sklearn predict_proba on the sample windows """
+
+    sklearnModels = ModelRegistry.loadPickles(modelsDir).predictors
+    numpyModels = ModelRegistry.loadBundle(bundle).predictors
+    inputData = sample_features()
+
+    for name in sklearnModels:
+        X = generateXmat(inputData, name)
+        reference = timeit(lambda: sklearnModels[name].predict_proba(X), repeat)
+        fast = timeit(lambda: numpyModels[name].predict_proba(X), repeat)
+        deviation = np.abs(reference['result'] - fast['result']).max()
+
+        print(f"{name:<10} sklearn {reference['seconds'] * 1000:8.2f} ms   numpy {fast['seconds'] * 1000:8.2f} ms   max |dp| {deviation:.2e}")
+        if deviation > tolerance:
+            raise Exception("NumPy forward pass of " + name + " deviates from predict_proba by " + str(deviation))
+
+def bench_precision(modelsDir: Path, precisionList: list, cutoffs: list, repeat: int):
+    """
+        Reduced-precision inference against the float64 reference on the sample windows: time, largest probability
+        deviation and number of windows whose hit status (round(p, 4) >= cutoff, as in results_table) changes
+    """
+
+    reference = ModelRegistry.loadRegistry(modelsDir)
+    inputData = sample_features()
+    windows = {name: generateXmat(inputData, name) for name in reference.predictors}
+    baseline = {name: timeit(lambda: reference.predictors[name].predict_proba(windows[name]), repeat) for name in windows}
+
+    def hits(proba, cutoff):
+        return np.round(np.asarray(proba, dtype=np.float64)[:, 1], 4) >= cutoff
+
+    print(f"{'precision':<10} {'motif':<10} {'float64':>10} {'reduced':>10}   {'max |dp|':>9}   " + '   '.join(f"changed@{c}" for c in cutoffs))
+    for precision in precisionList:
+        registry = reference.withPrecision(precision)
+        totals = {'seconds': 0.0, 'reference': 0.0, 'deviation': 0.0, 'changed': [0] * len(cutoffs), 'hits': [0] * len(cutoffs)}
+
+        for name, model in registry.predictors.items():
+            reduced = timeit(lambda: model.predict_proba(windows[name]), repeat)
+            expected = baseline[name]['result']
+            deviation = float(np.abs(expected - reduced['result']).max()) if len(expected) else 0.0
+            changed = [int((hits(expected, c) != hits(reduced['result'], c)).sum()) for c in cutoffs]
+
+            totals['seconds'] += reduced['seconds']
+            totals['reference'] += baseline[name]['seconds']
+            totals['deviation'] = max(totals['deviation'], deviation)
+            totals['changed'] = [a + b for a, b in zip(totals['changed'], changed)]
+            totals['hits'] = [a + int(hits(expected, c).sum()) for a, c in zip(totals['hits'], cutoffs)]
+            print(f"{precision:<10} {name:<10} {baseline[name]['seconds'] * 1000:7.2f} ms {reduced['seconds'] * 1000:7.2f} ms   "
+                  f"{deviation:9.2e}   " + '   '.join(f"{n:>{len('changed@' + str(c))}}" for n, c in zip(changed, cutoffs)))
+
+        print(f"{precision:<10} {'all':<10} {totals['reference'] * 1000:7.2f} ms {totals['seconds'] * 1000:7.2f} ms   "
+              f"{totals['deviation']:9.2e}   " + '   '.join(f"{n}/{h} hits" for n, h in zip(totals['changed'], totals['hits'])))
+
+def bench_gates(modelsDir: Path, features: list, folds: int, cutoff: float, recall: float, margin: float, cutoffs: list, repeat: int):
+    """
+        Held-out recall and speed of gated inference (gate scores, then the predictor on the candidate windows only)
+        against full inference. The proteins are split into folds; the gates are fitted as `nlrexpress.py gates` does
+        on all but one fold and evaluated on that fold. Per motif: calibration hits, the fraction of windows predicted,
+        the time of both, and the recall of the full run's hits (round(p, 4) >= cutoff, as in results_table) at each
+        of cutoffs, summed over the folds in which the motif had a usable gate.
+        features: saveFeatures files, or the sample windows (two proteins: leave-one-protein-out)
+    """
+
+    from nlrexpress import predict_gated
+
+    registry = ModelRegistry.loadRegistry(modelsDir)
+    inputData = FeaturesData(seqData={}, hmmData={})
+    for k, path in enumerate(features):
+        data = loadFeatures(path)
+        inputData.seqData.update({str(k) + '/' + name: seq for name, seq in data.seqData.items()})
+        inputData.hmmData.update({str(k) + '/' + name: profile for name, profile in data.hmmData.items()})
+    if not features:
+        inputData = sample_features()
+
+    names = list(inputData.seqData)
+    folds = min(folds, len(names))
+    if folds < 2:
+        raise ValueError('Held-out gate recall needs at least two proteins')
+
+    def subset(selected):
+        return FeaturesData(seqData={name: inputData.seqData[name] for name in selected},
+                            hmmData={name: inputData.hmmData[name] for name in selected})
+
+    def hits(proba, cutoff):
+        return np.round(np.asarray(proba, dtype=np.float64)[:, 1], 4) >= cutoff
+
+    stats = {name: {'folds': 0, 'calibration': 0, 'windows': 0, 'candidates': 0, 'full': 0.0, 'gated': 0.0,
+                    'kept': [0] * len(cutoffs), 'hits': [0] * len(cutoffs)} for name in registry.predictors}
+    for fold in range(folds):
+        heldOut = subset(names[fold::folds])
+        calibration = subset([name for k, name in enumerate(names) if k % folds != fold])
+        gates = fitGates(calibration, registry.predictors, registry.modelHashes(), cutoff, recall, margin)
+        usable = gates.validGates(registry.modelHashes())
+
+        for name, gate in usable.items():
+            width = windowWidth(name)
+            full = timeit(lambda: predictWindows(registry.predictors[name], generateWindowMat(heldOut, width)), repeat)
+            gated = timeit(lambda: predict_gated(heldOut, registry, {name: gate}, width)[name], repeat)
+
+            record = stats[name]
+            record['folds'] += 1
+            record['calibration'] += gate.hits
+            record['windows'] += len(full['result'])
+            record['candidates'] += int(candidateWindows(heldOut, width, {name: gate})[2][name].sum())
+            record['full'] += full['seconds']
+            record['gated'] += gated['seconds']
+            record['kept'] = [a + int((hits(full['result'], c) & hits(gated['result'], c)).sum()) for a, c in zip(record['kept'], cutoffs)]
+            record['hits'] = [a + int(hits(full['result'], c).sum()) for a, c in zip(record['hits'], cutoffs)]
+
+    print(f"{folds} folds, gates fitted at cutoff {cutoff}, recall {recall}, margin {margin}; recall measured on the held-out fold")
+    print(f"{'motif':<10} {'folds':>5} {'calib':>5} {'windows':>8} {'gated':>7}   {'full':>10} {'gated':>10}   " + '   '.join(f"recall@{c}" for c in cutoffs))
+    totals = {'windows': 0, 'candidates': 0, 'full': 0.0, 'gated': 0.0, 'kept': [0] * len(cutoffs), 'hits': [0] * len(cutoffs)}
+    for name, record in stats.items():
+        if not record['folds']:
+            continue
+        for key in ['windows', 'candidates', 'full', 'gated']:
+            totals[key] += record[key]
+        totals['kept'] = [a + b for a, b in zip(totals['kept'], record['kept'])]
+        totals['hits'] = [a + b for a, b in zip(totals['hits'], record['hits'])]
+        print(f"{name:<10} {record['folds']:>5} {record['calibration']:>5} {record['windows']:>8} {record['candidates'] / max(record['windows'], 1):7.1%}   "
+              f"{record['full'] * 1000:7.2f} ms {record['gated'] * 1000:7.2f} ms   "
+              + '   '.join(f"{k:>{len('recall@' + str(c)) - 3}}/{h:<2}" for k, h, c in zip(record['kept'], record['hits'], cutoffs)))
+
+    print(f"{'all':<10} {'':>5} {'':>5} {totals['windows']:>8} {totals['candidates'] / max(totals['windows'], 1):7.1%}   {totals['full'] * 1000:7.2f} ms "
+          f"{totals['gated'] * 1000:7.2f} ms   " + '   '.join(f"{k}/{h} hits" for k, h in zip(totals['kept'], totals['hits'])))
+    print("Never gated (no usable gate in any fold, full inference): " + (', '.join(name for name in stats if not stats[name]['folds']) or '-'))
+
+def results_table_reference(inputData: FeaturesData, results: dict, cutoff=0.2) -> pd.DataFrame:
+    """ Per-residue triple loop that results_table replaced, kept as the reference output """
+
+    countpos = {motif: 0 for motif in results}
+
+    protein, res_id, motif_id, probability, negative_5_pos, motifseq, positive_5_pos = [], [], [], [], [], [], []
+
+    for prot in inputData.seqData:
+        seq = inputData.seqData[prot]
+        seqLength = len(seq)
+
+        for i, aa in enumerate(seq):
+            for motif in results:
+
+                if i >= allMotifs[motif]["windLeft"] and i < seqLength - (allMotifs[motif]["motifSpan"] + allMotifs[motif]["windRight"]):
+                    if round(results[motif][countpos[motif]][1], 4) >= cutoff:
+                        protein.append(prot)
+                        res_id.append(i+1)
+                        motif_id.append(motif)
+                        probability.append(100 * results[motif][countpos[motif]][1])
+                        negative_5_pos.append(seq[i-5:i])
+                        motifseq.append(seq[i:i + allMotifs[motif]["motifSpan"]])
+                        positive_5_pos.append(seq[i + allMotifs[motif]["motifSpan"]:i + allMotifs[motif]["motifSpan"] + 5])
+
+                    countpos[motif] += 1
+
+    return pd.DataFrame({'protein': protein, 'res_id': res_id, 'motif_id': motif_id, 'probability': probability, 'negative_5_pos': negative_5_pos, 'motifseq': motifseq, 'positive_5_pos': positive_5_pos})
+
+def generateInputFile_reference(seqData: dict, hmm_it1: dict, hmm_it2: dict) -> dict:
+    """ Per-residue lists that generateInputFile replaced (parse_hmm_multiprot dicts in), kept as the reference features """
+
+    data = {}
+
+    for name in seqData:
+        seq = seqData[name]
+        data[name] = []
+
+        for i, aa in enumerate(seq):
+            data[name].append([])
+            for k, (key, val) in enumerate( hmm_it1[name][i].items() ):
+                data[name][-1].append(val)
+
+            if name in hmm_it2:
+                for k, (key, val) in enumerate( hmm_it2[name][i].items() ):
+                    data[name][-1].append(val)
+            else:
+                for k, (key, val) in enumerate( hmm_it1[name][i].items() ):
+                    data[name][-1].append(val)
+
+    return data
+
+def generateXmat_reference(inputData: FeaturesData, motif: str) -> list:
+    """ List-of-lists window loop that generateXmat replaced (over generateInputFile_reference features), kept as the reference X """
+
+    X = []
+
+    for prot in inputData.hmmData:
+        seqLength = len( inputData.seqData[prot] )
+
+        for i in range(seqLength):
+
+                windLeft = allMotifs[motif]["windLeft"]
+                windRight = allMotifs[motif]["windRight"]
+                motifSpan = allMotifs[motif]["motifSpan"]
+
+                if i >= windLeft and i < seqLength - ( motifSpan + windRight) :
+                    features = inputData.hmmData[prot]
+
+                    X.append([])
+                    for w in range(windLeft * (-1), motifSpan + windRight + 1):
+                        X[-1] += features[i+w]
+
+    return X
+
+def synthetic_results(nProteins: int, minLength: int, maxLength: int, seed: int = 0):
+    """ Random sequences and predict_proba-shaped results with a few percent of windows above 0.2 """
+
+    rng = np.random.default_rng(seed)
+    alphabet = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+    lengths = rng.integers(minLength, maxLength + 1, nProteins)
+
+    seqData = {}
+    for k, length in enumerate(lengths):
+        seqData['prot_' + str(k)] = ''.join(rng.choice(alphabet, length))
+
+    results = {}
+    for motif in allMotifs:
+        nWindows = int(np.maximum(lengths - (windowWidth(motif) - 1), 0).sum())
+        positive = rng.beta(0.2, 5, nWindows)
+        results[motif] = np.column_stack((1 - positive, positive))
+
+    return FeaturesData(seqData=seqData, hmmData={}), results
+
+def bench_output(nProteins: int, minLength: int, maxLength: int, repeat: int, reference: bool):
+    """ Vectorized results_table vs the per-residue loop on a synthetic result set """
+
+    from nlrexpress import results_table
+
+    inputData, results = synthetic_results(nProteins, minLength, maxLength)
+    nWindows = sum(len(results[motif]) for motif in results)
+    print(f"{nProteins} proteins, {nWindows} scored windows")
+
+    fast = timeit(lambda: results_table(inputData, results), repeat)
+    print(f"  results_table            {fast['seconds']:8.2f} s  {fast['peak_mb']:10.1f} MB peak  {len(fast['result'])} hits")
+
+    if reference:
+        slow = timeit(lambda: results_table_reference(inputData, results), 1)
+        print(f"  per-residue loop         {slow['seconds']:8.2f} s  {slow['peak_mb']:10.1f} MB peak")
+        print(f"  speed-up {slow['seconds'] / fast['seconds']:.1f}x")
+        if not slow['result'].equals(fast['result']):
+            raise Exception("results_table output differs from the per-residue loop")
+
+def synthetic_hits(nProteins: int, hitsPerProtein: int, seed: int = 0) -> pd.DataFrame:
+    """ Results table of nProteins proteins with hitsPerProtein random motif hits each """
+
+    rng = np.random.default_rng(seed)
+    motifs = np.array(list(allMotifs))
+    nHits = nProteins * hitsPerProtein
+
+    return pd.DataFrame({'protein': np.repeat(['prot_' + str(k) for k in range(nProteins)], hitsPerProtein),
+                         'res_id': rng.integers(1, 1000, nHits),
+                         'motif_id': rng.choice(motifs, nHits),
+                         'probability': 100 * rng.random(nHits)})
+
+def bench_annotate(sizes: list, hitsPerProtein: int, repeat: int):
+    """ annotate_table on synthetic hit tables of increasing size; time per row should stay flat """
+
+    from nlrexpress import annotate_table
+
+    for nProteins in sizes:
+        df = synthetic_hits(nProteins, hitsPerProtein)
+        run = timeit(lambda: annotate_table(df), repeat)
+        print(f"{nProteins:>8} proteins {len(df):>9} rows  {run['seconds']:8.3f} s  {run['seconds'] / len(df) * 1e6:8.3f} us/row"
+              f"  {run['peak_mb']:8.1f} MB peak")
+
+def bench_prefilter(inputFasta: Path, reference: Path, minScores: list, nDatabase: int, seed: int = 0):
+    """
+        Recall of the kmer prefilter against the full run: motif hits of the reference output kept on the
+        sample proteins, leave-one-out recall on target DB sequences (each scored with itself excluded) and
+        pass rate of shuffled decoys of the same sequences, for each minimum score.
+    """
+
+    rng = np.random.default_rng(seed)
+    prefilter = Prefilter(method='kmer', targetDB=scriptDir / targetDB)
+    start = time.perf_counter()
+    index = loadIndex(prefilter.targetDB, prefilter.k)
+    print(f"index: {len(index.codes)} {prefilter.k}-mers, built in {time.perf_counter() - start:.2f} s")
+
+    seqData = dict(readFasta(inputFasta))
+    start = time.perf_counter()
+    sampleScores = {name: index.diagonalScore(seqData[name], prefilter.band) for name in seqData}
+    print(f"sample: {len(seqData)} proteins screened in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    with open(reference, 'r') as referenceFile:
+        hitProteins = [line.split()[0] for line in referenceFile if line.strip() and not line.startswith('#')]
+
+    database = [seq for name, seq in readFasta(prefilter.targetDB)]
+    picked = rng.choice(len(database), min(nDatabase, len(database)), replace=False)
+    looScores = np.array([index.diagonalScore(database[i], prefilter.band, exclude=i) for i in picked])
+    decoyScores = np.array([index.diagonalScore(''.join(rng.permutation(list(database[i]))), prefilter.band) for i in picked])
+
+    for minScore in minScores:
+        kept = [name for name in hitProteins if sampleScores[name] >= minScore]
+        print(f"  min score {minScore:>3}: sample hit recall {len(kept) / max(len(hitProteins), 1):6.1%}"
+              f"   DB leave-one-out recall {(looScores >= minScore).mean():6.1%}"
+              f"   shuffled decoys passing {(decoyScores >= minScore).mean():6.1%}")
+
+# Background amino acid frequencies (UniProtKB) in HMM alphabet order, for synthetic proteomes
+aminoAcidFrequencies = np.array([8.25, 1.38, 5.46, 6.72, 3.86, 7.07, 2.27, 5.91, 5.80, 9.65,
+                                 2.41, 4.06, 4.74, 3.93, 5.53, 6.64, 5.35, 6.86, 1.10, 2.92])
+
+def synthetic_proteome(nProteins: int, medianLength: int = 350, sigma: float = 0.5, minLength: int = 30,
+                       maxLength: int = 5000, seed: int = 0) -> dict:
+    """ name -> sequence, lengths log-normal around medianLength, residues drawn from background frequencies """
+
+    rng = np.random.default_rng(seed)
+    lengths = np.clip(rng.lognormal(np.log(medianLength), sigma, nProteins).astype(np.int64), minLength, maxLength)
+    residues = np.frombuffer(aminoAcids.encode(), dtype='S1')[
+        rng.choice(20, int(lengths.sum()), p=aminoAcidFrequencies / aminoAcidFrequencies.sum())].tobytes().decode()
+
+    offsets = np.concatenate(([0], np.cumsum(lengths))).tolist()
+    return {'synth_' + str(k): residues[offsets[k]:offsets[k + 1]] for k in range(nProteins)}
+
+def synthetic_hmm(output: Path, seqData: dict, iteration: int = 1, seed: int = 0, poolSize: int = 4096):
+    """
+        Writes an HMMER3/f checkpoint file as jackhmmer --chkhmm does (one record per protein, NAME suffixed
+        with -i1 for the second iteration). Node lines are drawn from a pool of random match, insert and
+        transition rows so that large files are written quickly.
+    """
+
+    rng = np.random.default_rng(seed + iteration)
+    scores = -np.log(rng.dirichlet(np.full(20, 0.5), (poolSize, 2)) + 1e-12)
+    transitions = -np.log(rng.dirichlet(np.ones(3), poolSize))
+    pool = [' ' + ''.join(' %8.5f' % val for val in scores[k, 0]) + '      - x - - -\n'
+            + '        ' + ''.join(' %8.5f' % val for val in scores[k, 1]) + '\n'
+            + '        ' + ''.join(' %8.5f' % val for val in np.concatenate((transitions[k], [0.51083, 0.91629, 0.51083, 0.91629]))) + '\n'
+            for k in range(poolSize)]
+    compo = '  COMPO ' + ''.join(' %8.5f' % val for val in -np.log(aminoAcidFrequencies / aminoAcidFrequencies.sum())) + '\n'
+    header = ('HMM          ' + '        '.join(aminoAcids) + '   \n'
+              + '            m->m     m->i     m->d     i->m     i->i     d->m     d->d\n'
+              + compo + pool[0].split('\n', 1)[1])
+
+    suffix = '-i1' if iteration == 2 else ''
+    with open(output, 'w') as hmmFile:
+        for name, seq in seqData.items():
+            hmmFile.write('HMMER3/f [3.3 | Nov 2019]\nNAME  ' + name + suffix + '\nLENG  ' + str(len(seq))
+                          + '\nALPH  amino\nRF    no\nMM    no\nCONS  yes\nCS    no\nMAP   no\nNSEQ  1\n' + header)
+            picks = rng.integers(0, poolSize, len(seq)).tolist()
+            hmmFile.write(''.join('%7d' % (i + 1) + pool[k] for i, k in enumerate(picks)))
+            hmmFile.write('//\n')
+
+def suite_run(nProteins: int, medianLength: int, batchSize: int, workDir: Path, stages: list) -> dict:
+    """
+        One size of the suite, run in its own process; returns the stage summary of the run report.
+        As in predict --batch_size, the proteins go through HMM parsing, features, inference and output
+        batchSize at a time, so memory follows the batch size and the stage times add up over the batches.
+    """
+
+    from nlrexpress import predict_motifs, results_table, annotate_table
+
+    report = startReport()
+    workDir = Path(workDir)
+    workDir.mkdir(parents=True, exist_ok=True)
+
+    seqData = synthetic_proteome(nProteins, medianLength)
+    inputFasta = workDir / 'synthetic.fasta'
+    writeFasta(seqData, inputFasta)
+    residues = sum(len(seq) for seq in seqData.values())
+
+    with stage('read_fasta', proteins=nProteins, residues=residues):
+        seqData = processFastaFile(inputFasta, workDir / 'synthetic.fasta_proc')
+
+    writer = ResultsWriter.openWriter(workDir, 'csv', allMotifs) if 'output' in stages else None
+    names = list(seqData)
+    for start in range(0, nProteins, batchSize):
+        batch = {name: seqData[name] for name in names[start:start + batchSize]}
+        batchResidues = sum(len(seq) for seq in batch.values())
+
+        for iteration in (1, 2):
+            synthetic_hmm(workDir / ('synthetic-' + str(iteration) + '.hmm'), batch, iteration, seed=start)
+        with stage('parse_hmm', proteins=len(batch), residues=batchResidues):
+            hmm_it1 = dict(iterHmmProfiles(workDir / 'synthetic-1.hmm'))
+            hmm_it2 = dict(iterHmmProfiles(workDir / 'synthetic-2.hmm'))
+
+        with stage('generateInputFile', proteins=len(batch), residues=batchResidues):
+            inputData = FeaturesData(seqData=batch, hmmData=generateInputFile(batch, hmm_it1, hmm_it2))
+        del hmm_it1, hmm_it2
+
+        if 'inference' in stages:
+            # window_matrix/*, predict_proba/* and load_models are recorded by predict_motifs itself
+            results = predict_motifs(inputData)
+            if writer is not None:
+                with stage('results_table') as record:
+                    table = results_table(inputData, results)
+                    record['rows'] = len(table)
+                with stage('write_output', rows=len(table)):
+                    writer.write(table)
+            del results
+        del inputData
+
+    for iteration in (1, 2):
+        if (workDir / ('synthetic-' + str(iteration) + '.hmm')).exists():
+            os.remove(workDir / ('synthetic-' + str(iteration) + '.hmm'))
+
+    if writer is not None:
+        writer.close()
+        if 'annotate' in stages:
+            table = pd.read_csv(writer.path)
+            with stage('annotate', rows=len(table)):
+                annotate_table(table)
+
+    return {'proteins': nProteins, 'residues': residues, 'batch_size': batchSize, 'peak_rss_mb': peakRssMb(), 'stages': report.summary()}
+
+def bench_suite(sizes: list, medianLength: int, batchSize: int, stages: list, output: Path, workDir: Path = None):
+    """
+        Stage timings, throughput and memory on synthetic proteomes of increasing size, written as JSON.
+        Each size runs in a fresh process, so its peak RSS is its own.
+    """
+
+    runs = []
+    with tempfile.TemporaryDirectory(dir=workDir) as tmpDir:
+        for nProteins in sizes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                run = executor.submit(suite_run, nProteins, medianLength, batchSize, Path(tmpDir) / str(nProteins), stages).result()
+            runs.append(run)
+
+            print(f"{nProteins} proteins, {run['residues']} residues, {run['peak_rss_mb']:.0f} MB peak RSS")
+            for name, total in run['stages'].items():
+                counter = next((key for key in ('windows', 'rows', 'residues', 'proteins') if key in total), None)
+                rate = f"{total[counter + '_per_sec']:14.0f} {counter}/s" if counter else ''
+                print(f"  {name:<36} {total['wall_seconds']:9.3f} s {total['peak_rss_mb']:9.0f} MB {rate}")
+
+    with open(output, 'w') as outputFile:
+        json.dump({'median_length': medianLength, 'batch_size': batchSize, 'stages': stages, 'runs': runs}, outputFile, indent=1)
+    print('Report written to ' + str(output))
+
+def bench_compare(baseline: Path, current: Path):
+    """ Wall time ratio current / baseline of every stage of every size present in both suite reports """
+
+    with open(baseline) as baselineFile, open(current) as currentFile:
+        before = {run['proteins']: run for run in json.load(baselineFile)['runs']}
+        after = {run['proteins']: run for run in json.load(currentFile)['runs']}
+
+    for nProteins in sorted(set(before) & set(after)):
+        print(f"{nProteins} proteins   peak RSS {before[nProteins]['peak_rss_mb']:.0f} -> {after[nProteins]['peak_rss_mb']:.0f} MB")
+        for name, total in after[nProteins]['stages'].items():
+            if name in before[nProteins]['stages']:
+                old = before[nProteins]['stages'][name]['wall_seconds']
+                print(f"  {name:<36} {old:9.3f} -> {total['wall_seconds']:9.3f} s   x{total['wall_seconds'] / max(old, 1e-9):.2f}")
+
+def bench_server(url: str, input: Path, nRequests: int, concurrency: int, proteinsPerRequest: int):
+    """
+        Load generator for `nlrexpress.py serve`: nRequests POST /predict requests of proteinsPerRequest proteins
+        drawn from input, concurrency at a time. Reports throughput and latency percentiles.
+    """
+
+    seqData = dict(readFasta(input))
+    names = list(seqData)
+
+    def send(k: int) -> float:
+        request = {'sequences': {names[(k * proteinsPerRequest + i) % len(names)]: seqData[names[(k * proteinsPerRequest + i) % len(names)]]
+                                 for i in range(proteinsPerRequest)}}
+        start = time.perf_counter()
+        with urllib.request.urlopen(urllib.request.Request(url.rstrip('/') + '/predict', data=json.dumps(request).encode(),
+                                                           headers={'Content-Type': 'application/json'})) as response:
+            json.load(response)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.array(list(executor.map(send, range(nRequests))))
+    elapsed = time.perf_counter() - start
+
+    with urllib.request.urlopen(url.rstrip('/') + '/health') as response:
+        health = json.load(response)
+
+    print(f"{nRequests} requests of {proteinsPerRequest} proteins, concurrency {concurrency}: {elapsed:.2f} s")
+    print(f"  {nRequests / elapsed:10.2f} requests/s {nRequests * proteinsPerRequest / elapsed:10.2f} proteins/s")
+    print(f"  latency p50 {np.percentile(latencies, 50):.3f} s   p99 {np.percentile(latencies, 99):.3f} s   max {latencies.max():.3f} s")
+    print(f"  server: {health['batches']} batches, {health['requests'] / max(health['batches'], 1):.1f} requests per batch")
+
+def bench_startup(subcommands: list, results: Path, repeat: int):
+    """
+        Cold-start wall time of nlrexpress.py (`<subcommand> --help`, and a full annotate run of results if given),
+        each in a fresh interpreter (best and median of repeat runs), and which heavy libraries get imported.
+        `python -c pass` is the interpreter floor.
+    """
+
+    commands = ['-c pass', '--help'] + [subcommand + ' --help' for subcommand in subcommands]
+    tmpDir = tempfile.TemporaryDirectory()
+    if results is not None:
+        commands.append('annotate --input ' + str(Path(results).resolve()) + ' --output_directory ' + tmpDir.name)
+
+    heavy = ['numpy', 'pandas', 'Bio', 'sklearn', 'pyarrow']
+    print(f"{'command':<28} {'best':>8} {'median':>8}   imports")
+    for command in commands:
+        argv = [sys.executable] + (['-c', 'pass'] if command == '-c pass' else [str(scriptDir / 'nlrexpress.py')] + command.split())
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=scriptDir)
+            times.append(time.perf_counter() - start)
+
+        trace = subprocess.run(argv[:1] + ['-X', 'importtime'] + argv[1:], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               cwd=scriptDir, text=True).stderr
+        loaded = {line.split('|')[-1].strip().split('.')[0] for line in trace.splitlines() if line.startswith('import time:')}
+        print(f"{command.split(' --output_directory')[0]:<28} {min(times) * 1000:6.0f} ms {np.median(times) * 1000:6.0f} ms   "
+              f"{' '.join(m for m in heavy if m in loaded)}")
+
+    tmpDir.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser("NLRexpress benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs per benchmark")
+
+    subparsers = parser.add_subparsers(dest="command")
+    hmm_parser = subparsers.add_parser("hmm", help="HMM checkpoint parsers")
+    hmm_parser.add_argument("--input", type=str, nargs="+",
+                            default=[str(scriptDir) + '/sample/output_ref/zar1_rpp1-1.hmm',
+                                     str(scriptDir) + '/sample/output_ref/zar1_rpp1-2.hmm'],
+                            help="HMM files to parse")
+
+    models_parser = subparsers.add_parser("models", help="NumPy model bundle vs sklearn predict_proba")
+    models_parser.add_argument("--models_directory", type=str, default=str(scriptDir) + '/models', help="Directory with the MLP .pkl files")
+    models_parser.add_argument("--bundle", type=str, default=None, help="Model bundle [default: <models_directory>/" + bundleName + "]")
+
+    output_parser = subparsers.add_parser("output", help="results_table on a synthetic result set")
+    output_parser.add_argument("--proteins", type=int, default=50000, help="Number of synthetic proteins")
+    output_parser.add_argument("--min_length", type=int, default=30, help="Minimum protein length")
+    output_parser.add_argument("--max_length", type=int, default=90, help="Maximum protein length")
+    output_parser.add_argument("--no_reference", action="store_true", help="Skip the (slow) per-residue loop reference")
+
+    annotate_parser = subparsers.add_parser("annotate", help="annotate_table scaling on synthetic hit tables")
+    annotate_parser.add_argument("--proteins", type=int, nargs="+", default=[1000, 10000, 100000], help="Numbers of synthetic proteins")
+    annotate_parser.add_argument("--hits", type=int, default=30, help="Motif hits per protein")
+
+    prefilter_parser = subparsers.add_parser("prefilter", help="Recall of the kmer prefilter against a full run")
+    prefilter_parser.add_argument("--input", type=str, default=str(scriptDir) + '/sample/output_ref/zar1_rpp1.fasta_proc', help="FASTA of the full run")
+    prefilter_parser.add_argument("--reference", type=str, default=str(scriptDir) + '/sample/output_ref/zar1_rpp1.short.output.txt',
+                                  help="Motif hits of the full run (short output)")
+    prefilter_parser.add_argument("--min_scores", type=int, nargs="+", default=[5, 8, 10, 12, 15], help="Prefilter minimum scores to evaluate")
+    prefilter_parser.add_argument("--database_sample", type=int, default=500, help="Target DB sequences used for the leave-one-out recall")
+
+    suite_parser = subparsers.add_parser("suite", help="Stage scaling on synthetic proteomes and HMM checkpoint files (no jackhmmer)")
+    suite_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000], help="Numbers of synthetic proteins")
+    suite_parser.add_argument("--median_length", type=int, default=350, help="Median synthetic protein length (log-normal)")
+    suite_parser.add_argument("--batch_size", type=int, default=500, help="Proteins per parsing/inference batch; bounds memory")
+    suite_parser.add_argument("--stages", type=str, nargs="+", default=['inference', 'output', 'annotate'],
+                              choices=['inference', 'output', 'annotate'], help="Stages run after feature building")
+    suite_parser.add_argument("--output", type=str, default="benchmark_suite.json", help="JSON report")
+    suite_parser.add_argument("--work_directory", type=str, default=None, help="Directory for the synthetic files [default: system temp]")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two suite JSON reports")
+    compare_parser.add_argument("baseline", type=str, help="Baseline suite report")
+    compare_parser.add_argument("current", type=str, help="Current suite report")
+
+    server_parser = subparsers.add_parser("server", help="Latency and throughput of a running prediction server")
+    server_parser.add_argument("--url", type=str, default="http://127.0.0.1:8765", help="Server address")
+    server_parser.add_argument("--input", type=str, default=str(scriptDir) + '/sample/output_ref/zar1_rpp1.fasta_proc', help="FASTA the request proteins are drawn from")
+    server_parser.add_argument("--requests", type=int, default=100, help="Number of requests")
+    server_parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight")
+    server_parser.add_argument("--proteins", type=int, default=1, help="Proteins per request")
+
+    startup_parser = subparsers.add_parser("startup", help="Cold-start time of the nlrexpress.py subcommands")
+    startup_parser.add_argument("--subcommands", type=str, nargs="+", default=["predict", "annotate", "serve", "bundle"],
+                                help="nlrexpress.py subcommands to time (with --help)")
+    startup_parser.add_argument("--results", type=str, default=None, help="Results file for a timed annotate run")
+
+    precision_parser = subparsers.add_parser("precision", help="float32 inference and the int8 accuracy emulation vs the float64 reference on the sample windows")
+    precision_parser.add_argument("--models_directory", type=str, default=str(scriptDir) + '/models', help="Directory with the models")
+    precision_parser.add_argument("--precisions", type=str, nargs="+", default=['float32', 'int8'], choices=precisions[1:] + emulatedPrecisions,
+                                  help="Precisions to validate")
+    precision_parser.add_argument("--cutoffs", type=float, nargs="+", default=[0.2, 0.8], help="Hit cutoffs at which changed hits are counted")
+
+    gates_parser = subparsers.add_parser("gates", help="Recall and speed of gated inference vs full inference")
+    gates_parser.add_argument("--models_directory", type=str, default=str(scriptDir) + '/models', help="Directory with the models")
+    gates_parser.add_argument("--features", type=str, nargs="*", default=[],
+                              help="<stem>.features.npz files whose proteins are split into folds [default: the sample windows]")
+    gates_parser.add_argument("--folds", type=int, default=2, help="Protein folds: gates are fitted on all but one and evaluated on that one")
+    gates_parser.add_argument("--cutoff", type=float, default=0.2, help="Hit probability the gate thresholds are calibrated for")
+    gates_parser.add_argument("--recall", type=float, default=1.0, help="Fraction of the calibration hits each gate must keep")
+    gates_parser.add_argument("--margin", type=float, default=2.0, help="Slack subtracted from the gate thresholds (logit units)")
+    gates_parser.add_argument("--cutoffs", type=float, nargs="+", default=[0.2, 0.8], help="Hit cutoffs at which recall is measured")
+
+    args = parser.parse_args()
+    if args.command == "hmm":
+        bench_hmm(args.input, args.repeat)
+    elif args.command == "models":
+        bench_models(Path(args.models_directory), Path(args.bundle or Path(args.models_directory) / bundleName), args.repeat)
+    elif args.command == "output":
+        bench_output(args.proteins, args.min_length, args.max_length, args.repeat, not args.no_reference)
+    elif args.command == "annotate":
+        bench_annotate(args.proteins, args.hits, args.repeat)
+    elif args.command == "prefilter":
+        bench_prefilter(Path(args.input), Path(args.reference), args.min_scores, args.database_sample)
+    elif args.command == "suite":
+        bench_suite(args.sizes, args.median_length, args.batch_size, args.stages, Path(args.output), args.work_directory)
+    elif args.command == "compare":
+        bench_compare(Path(args.baseline), Path(args.current))
+    elif args.command == "server":
+        bench_server(args.url, Path(args.input), args.requests, args.concurrency, args.proteins)
+    elif args.command == "precision":
+        bench_precision(Path(args.models_directory), args.precisions, args.cutoffs, args.repeat)
+    elif args.command == "gates":
+        bench_gates(Path(args.models_directory), args.features, args.folds, args.cutoff, args.recall, args.margin, args.cutoffs, args.repeat)
+    elif args.command == "startup":
+        bench_startup(args.subcommands, args.results and Path(args.results), args.repeat)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,162 +1,700 @@
-from src.ModuleData import *
+from __future__ import annotations
+from src.ModelRegistry import *
 from src.FeaturesData import *
+from src.FastaIO import *
+from src.OutputData import *
+from src.Prefilter import *
+from src.RunManifest import *
+from src.RunReport import *
+from src.PredictionServer import *
+from src.WindowGate import *
+from src.LazyModule import LazyModule
 import sys
 import os
 import argparse
 import logging
-import pandas as pd
+import math
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# pandas only loads on the paths building or reading results tables
+pd = LazyModule('pandas')
 
 sys.path.insert(0, os.path.abspath("."))
 
-def predict(input: Path, output_directory: Path, threads: int):
-    """Predict NLR-related motifs"""
+def predict(input: Path, output_directory: Path, threads: int, workers: int = 1, cache_directory: Path = None, cache_size: float = 10,
+            fused: bool = False, chunk_size: int = 65536, batch_size: int = None,
+            output_format: str = 'csv', partition_by_protein: bool = False, store_probabilities: str = None,
+            prefilter: str = None, prefilter_min_score: int = 10, prefilter_evalue: float = 1e-3, jackhmmer_cpus: int = jackhmmerCpus,
+            restart: bool = False, profile_stages: list = None, profiler: str = 'cProfile', cutoff: float = 0.2, precision: str = 'float64',
+            overlap: bool = False, gated: bool = False):
+    """
+        Predict NLR-related motifs.
+        input is a FASTA file (optionally gzip-compressed) or a splitFasta parts manifest (<stem>.parts.json),
+        whose parts are then run as shards.
+        Stage timings, CPU, peak RSS and throughput are written to <output_directory>/nlrexpress.report.json;
+        stages whose name starts with one of profile_stages are also profiled into <output_directory>/profile.
+        Invoked again on the same output directory, features and stored probabilities are reused: a new cutoff only
+        re-thresholds them and an updated model only re-runs its own motif (see run_stages).
+    """
+
+    scriptDir = Path(__file__).resolve().parent
+    report = startReport(profile_stages, profiler, Path(str(output_directory) + '/profile'))
+
+    screen = None
+    if prefilter is not None:
+        screen = Prefilter(method=prefilter, targetDB=scriptDir / targetDB, minScore=prefilter_min_score, evalue=prefilter_evalue)
+
+    cache = None
+    if cache_directory is not None:
+        cache = ProfileCache.loadCache(directory=Path(cache_directory), maxBytes=int(cache_size * 2**30),
+                                       targetDB=scriptDir / targetDB, params=jackhmmerParams)
+
+    if workers > 1 or batch_size or str(input).endswith(partsManifestSuffix):
+        writer = ResultsWriter.openWriter(output_directory, output_format, allMotifs, partition_by_protein)
+        probaWriter = None
+        if store_probabilities:
+            probaWriter = ProbabilityWriter.openProbabilities(output_directory, allMotifs, store_probabilities)
+
+        predict_batches(Path(input), Path(output_directory), writer, threads, workers, batch_size, cache, fused, chunk_size, probaWriter, screen,
+                        jackhmmer_cpus, restart, cutoff, precision, overlap, gated)
+
+        writer.close()
+        if probaWriter is not None:
+            probaWriter.close()
+        report.write(Path(str(output_directory) + '/nlrexpress.report.json'))
+        return
+
+    inputData, results = run_stages(Path(input), Path(output_directory), threads, cache, screen, fused, chunk_size, jackhmmer_cpus, restart,
+                                    precision, overlap, gated)
+
+    write_output(inputData, results, output_directory, cutoff, output_format, partition_by_protein)
+    if screen is not None:
+        write_skipped(skipped_table(inputData), output_directory)
+
+    report.write(Path(str(output_directory) + '/nlrexpress.report.json'))
+
+    if store_probabilities:
+        probaWriter = ProbabilityWriter.openProbabilities(output_directory, allMotifs, store_probabilities)
+        probaWriter.write(inputData, results)
+        probaWriter.close()
+
+def predict_batches(input: Path, output_directory: Path, writer: ResultsWriter, threads: int, workers: int = 1, batch_size: int = None,
+                    cache: ProfileCache = None, fused: bool = False, chunk_size: int = 65536, probaWriter: ProbabilityWriter = None,
+                    prefilter: Prefilter = None, jackhmmer_cpus: int = jackhmmerCpus, restart: bool = False, cutoff: float = 0.2,
+                    precision: str = 'float64', overlap: bool = False, gated: bool = False):
+    """
+        Splits the input FASTA into batches of batch_size proteins (or takes the parts of a parts manifest as they are)
+        and runs the full pipeline (jackhmmer, parsing, features, inference) batch by batch, passing each batch's rows
+        to writer in input order.
+        Only one batch's features and probabilities are held per process at a time, so peak memory follows the
+        batch size rather than the input size. With workers > 1, batches run in a process pool.
+        With probaWriter, each batch stores its per-residue probabilities in its own directory and they are
+        appended to probaWriter in the same order.
+        With prefilter, the proteins it skips are listed in <output_directory>/nlrexpress.skipped.csv.
+        Every shard keeps its own run manifest, so a re-invocation only recomputes the shards that did not finish.
+    """
+
+    probaDtype = probaWriter.dtype if probaWriter is not None else None
+
+    batchesDir = Path(str(output_directory) + "/shards")
+    batchesDir.mkdir(parents=True, exist_ok=True)
+
+    if str(input).endswith(partsManifestSuffix):
+        batches = readParts(input)
+    else:
+        if not batch_size:
+            # Several shards per worker so that a shard of long proteins does not hold up the whole run
+            with openFasta(input, 'r') as inputFile:
+                nSeq = sum(1 for line in inputFile if line.startswith(">"))
+            batch_size = max(1, math.ceil(nSeq / (4 * workers)))
+        batches = splitFasta(input, batchesDir, batch_size)
+
+    def collect(batch, table, skipped):
+        with stage('write_output', rows=len(table)):
+            writer.write(table)
+        if probaWriter is not None:
+            probaWriter.appendStore(shard_directory(output_directory, batch))
+        if prefilter is not None:
+            write_skipped(skipped, output_directory, append=True)
+
+    if prefilter is not None:
+        write_skipped(pd.DataFrame(columns=['protein', 'prefilter_score']), output_directory)
+
+    if workers <= 1:
+        for k, batch in enumerate(batches):
+            logging.info('Batch ' + str(k + 1) + '/' + str(len(batches)) + ' - started')
+            table, skipped, stages = predict_shard(batch, shard_directory(output_directory, batch), threads, cache, fused, chunk_size,
+                                                   probaDtype, prefilter, jackhmmer_cpus, restart, cutoff, precision, overlap, gated)
+            collect(batch, table, skipped)
+            logging.info('Batch ' + str(k + 1) + '/' + str(len(batches)) + ' - done')
+        return
+
+    threadsPerWorker = max(1, threads // workers)
+    logging.info('Sharded run: ' + str(len(batches)) + ' shards, ' + str(workers) + ' workers, ' + str(threadsPerWorker) + ' threads per worker')
+
+    # Shard tables are appended in input order, so the output does not depend on which worker finishes first.
+    # Stages recorded in the workers are added to the report of this process.
+    with ProcessPoolExecutor(max_workers=workers, initializer=limit_threads, initargs=(threadsPerWorker,)) as executor:
+        futures = [executor.submit(predict_shard, batch, shard_directory(output_directory, batch), threadsPerWorker, cache, fused,
+                                   chunk_size, probaDtype, prefilter, jackhmmer_cpus, restart, cutoff, precision, overlap, gated)
+                   for batch in batches]
+        for batch, future in zip(batches, futures):
+            table, skipped, stages = future.result()
+            currentReport().stages.extend(stages)
+            collect(batch, table, skipped)
+
+    # The workers only counted their own cache entries
+    if cache is not None:
+        cache.evict()
+
+def predict_shard(shard: Path, shardDir: Path, threads: int, cache: ProfileCache = None, fused: bool = False, chunk_size: int = 65536,
+                  proba_dtype: str = None, prefilter: Prefilter = None, jackhmmer_cpus: int = jackhmmerCpus, restart: bool = False,
+                  cutoff: float = 0.2, precision: str = 'float64', overlap: bool = False, gated: bool = False) -> tuple:
+    """ Runs one shard in its own output directory and returns its (results, skipped proteins) tables and its stage records """
+
+    shardDir.mkdir(exist_ok=True)
+    firstStage = len(currentReport().stages)
+
+    inputData, results = run_stages(shard, shardDir, threads, cache, prefilter, fused, chunk_size, jackhmmer_cpus, restart, precision,
+                                    overlap, gated)
+
+    if proba_dtype:
+        probaWriter = ProbabilityWriter.openProbabilities(shardDir, allMotifs, proba_dtype)
+        probaWriter.write(inputData, results)
+        probaWriter.close()
+
+    with stage('results_table') as record:
+        table = results_table(inputData, results, cutoff)
+        record['rows'] = len(table)
+
+    stages = currentReport().stages[firstStage:]
+    for record in stages:
+        record['shard'] = fastaStem(shard)
+
+    return table, skipped_table(inputData), stages
+
+def shard_directory(output_directory: Path, shard: Path) -> Path:
+    return Path(str(output_directory) + "/shards/" + fastaStem(shard))
+
+_threadLimits = None
+
+def limit_threads(threads: int):
+    """ Caps the BLAS/OpenMP pools of a worker process to its share of the thread budget """
+
+    from threadpoolctl import threadpool_limits
+    global _threadLimits
+    _threadLimits = threadpool_limits(limits=threads)
+
+def run_stages(input: Path, output_directory: Path, threads: int, cache: ProfileCache = None, prefilter: Prefilter = None,
+               fused: bool = False, chunk_size: int = 65536, jackhmmer_cpus: int = jackhmmerCpus, restart: bool = False,
+               precision: str = 'float64', overlap: bool = False, gated: bool = False) -> tuple:
+    """
+        Features and motif probabilities of one run directory, checkpointed in its run manifest
+        (processed FASTA, jackhmmer batches and iterations, <stem>.features.npz, <stem>.probabilities.npz).
+        Stages an earlier invocation completed, with outputs still matching their checksums, are loaded instead
+        of recomputed. restart ignores the manifest.
+        Stored probabilities carry the hash of the model of each motif: when models were updated since,
+        inference is only run again for the motifs whose model changed.
+        With overlap, each jackhmmer batch is parsed and scored as soon as it finishes, while later batches
+        are still searching (see overlapJackhmmer).
+        With gated, the stored hash of a gated motif also covers its window gate.
+    """
+
+    scriptDir = Path(__file__).resolve().parent
+    settings = {'targetDB': fileChecksum(scriptDir / targetDB), 'jackhmmer': jackhmmerParams,
+                'prefilter': None if prefilter is None else vars(prefilter)}
+    manifest = RunManifest.loadManifest(output_directory, input, settings, restart)
+
+    featuresFile = Path(str(output_directory) + "/" + fastaStem(input) + '.features.npz')
+    resultsFile = Path(str(output_directory) + "/" + fastaStem(input) + '.probabilities.npz')
+
+    overlapped = []
+    if manifest.isComplete('features'):
+        logging.info('Features of the previous run reused')
+        with stage('load_features'):
+            inputData = loadFeatures(featuresFile)
+    else:
+        consume = ((lambda batchData: overlapped.append((batchData, predict_motifs(batchData, fused, chunk_size, precision=precision, gated=gated))))
+                   if overlap else None)
+
+        inputData = generateFeatures(inputFasta=input, output_directory=output_directory, threads=threads, cache=cache,
+                                     prefilter=prefilter, cpusPerJob=jackhmmer_cpus, manifest=manifest, consume=consume)
+        with stage('save_features', proteins=len(inputData.seqData)):
+            saveFeatures(inputData, featuresFile)
+            manifest.complete('features', [featuresFile])
+
+    hashes = ModelRegistry.loadRegistry(scriptDir / 'models', precision).modelHashes()
+    if gated:
+        gates = window_gates(hashes, precision)
+        hashes = {motif: gates[motif].gatedHash(modelHash) if motif in gates else modelHash for motif, modelHash in hashes.items()}
+    results, changed = {}, list(hashes)
+    if overlapped:
+        with stage('assemble_probabilities'):
+            results = assemble_motif_results(inputData, overlapped, fused, chunk_size, precision, gated)
+        changed = []
+    elif manifest.isComplete('probabilities'):
+        with stage('load_probabilities'):
+            results = loadMotifResults(resultsFile)
+            stored = loadMotifHashes(resultsFile)
+        changed = [motif for motif in hashes if motif not in results or stored[motif] != hashes[motif]]
+        if changed:
+            logging.info('Models or window gates changed since the previous run, predicting again: ' + ', '.join(changed))
+        else:
+            logging.info('Motif probabilities of the previous run reused')
+
+    if overlapped or changed or list(results) != list(hashes):
+        if changed:
+            results.update(predict_motifs(inputData, fused, chunk_size, changed, precision, gated))
+        results = {motif: results[motif] for motif in hashes}
+        with stage('save_probabilities'):
+            saveMotifResults(results, resultsFile, hashes)
+            manifest.complete('probabilities', [resultsFile])
+
+    return inputData, results
+
+def predict_motifs(inputData: FeaturesData, fused: bool = False, chunk_size: int = 65536, motifs: list = None,
+                   precision: str = 'float64', gated: bool = False) -> dict:
+    """
+        Runs every predictor (or only those of motifs) on the features and returns motif -> predict_proba output.
+        With fused, the predictors of a window group share one first-layer matrix multiply per chunk of chunk_size windows.
+        precision float32 runs NumPy copies of the models with float32 weights (see NumpyMLP.withPrecision).
+        With gated, the motifs having a window gate only run their predictor on the gate's candidate windows (see predict_gated).
+    """
+
+    scriptDir = Path(__file__).resolve().parent
+
+    with stage('load_models'):
+        registry = ModelRegistry.loadRegistry(scriptDir / 'models', precision)
+    predictors = {p: registry.predictors[p] for p in registry.predictors if motifs is None or p in motifs}
+    gates = window_gates(predictors, precision) if gated else {}
+
+    # Motifs sharing a window width share one X matrix
+    results = {}
+    for width, group in planWindowGroups(predictors).items():
+        if any(p in gates for p in group):
+            results.update(predict_gated(inputData, registry, {p: gates[p] for p in group if p in gates}, width, fused, chunk_size))
+            group = [p for p in group if p not in gates]
+            if not group:
+                continue
+
+        logging.info('Preparing features: NN input for motifs ' + ', '.join(group) + ' started')
+        with stage('window_matrix/width_' + str(width)) as record:
+            X = generateWindowMat(inputData, width)
+            record['windows'] = X.shape[0]
+        logging.info('Preparing features: NN input for motifs ' + ', '.join(group) + ' done')
+
+        if fused:
+            with stage('predict_proba_fused/' + '+'.join(group), windows=X.shape[0] * len(group)):
+                results.update( registry.fusedGroup(group).predict_proba(X, chunk_size) )
+        else:
+            for p in group:
+                with stage('predict_proba/' + p, windows=X.shape[0]):
+                    results[p] = predictWindows(predictors[p], X)
+        del X
+
+    return {p: results[p] for p in predictors}
+
+def predict_gated(inputData: FeaturesData, registry: ModelRegistry, gates: dict, width: int, fused: bool = False,
+                  chunk_size: int = 65536) -> dict:
+    """
+        predict_proba output of the motifs of gates (motif -> LinearGate, all of one window width), in window order.
+        The gate scores are computed on the stacked profiles without building the window matrix; only the candidate
+        windows are gathered and run through the predictors. The other windows get probability 0.
+    """
+
+    with stage('window_gate/width_' + str(width)) as record:
+        features, rows, candidates = candidateWindows(inputData, width, gates)
+        union = np.logical_or.reduce(list(candidates.values()))
+        X = windowView(features, width)[rows[union]] if union.any() else np.empty((0, width * nFeatures), dtype=features.dtype)
+        record['windows'], record['candidates'] = len(rows), len(X)
+
+    # Candidates of each motif among the rows of X
+    group = list(gates)
+    selected = {p: candidates[p][union] for p in group}
+
+    if fused:
+        with stage('predict_proba_fused_gated/' + '+'.join(group), windows=len(X) * len(group)):
+            proba = registry.fusedGroup(group).predict_proba(X, chunk_size)
+        proba = {p: proba[p][selected[p]] for p in group}
+    else:
+        proba = {}
+        for p in group:
+            with stage('predict_proba_gated/' + p, windows=int(selected[p].sum())):
+                proba[p] = predictWindows(registry.predictors[p], X[selected[p]])
+
+    results = {}
+    for p in group:
+        results[p] = np.zeros((len(rows), proba[p].shape[1]), dtype=proba[p].dtype)
+        results[p][:, 0] = 1
+        results[p][candidates[p]] = proba[p]
+        logging.debug('Window gate ' + p + ': ' + str(len(proba[p])) + ' of ' + str(len(rows)) + ' windows predicted')
+
+    return results
+
+def window_gates(motifs, precision: str = 'float64') -> dict:
+    """
+        motif -> LinearGate for the motifs whose gate in models/nlrexpress_gates.npz was fitted against the current
+        (float64) model; reduced-precision runs use the same gates, checked against the models they were converted from
+    """
 
     scriptDir = Path(__file__).resolve().parent
+    gatesFile = scriptDir / 'models' / gatesName
+    if not gatesFile.exists():
+        raise FileNotFoundError('Window gates not found at ' + str(gatesFile) + ', fit them first with nlrexpress.py gates')
 
-    motifs = allMotifs
+    registry = ModelRegistry.loadRegistry(scriptDir / 'models', precision)
+    gates = loadGateSet(gatesFile).validGates(registry.referenceHashes or registry.modelHashes())
+    return {motif: gates[motif] for motif in motifs if motif in gates}
+
+def fit_gates(features: list, output: Path, cutoff: float = 0.2, recall: float = 1.0, margin: float = 2.0):
+    """ Fits the window gates against the float64 models on the windows of saveFeatures files (<stem>.features.npz of earlier runs) """
+
+    scriptDir = Path(__file__).resolve().parent
+    registry = ModelRegistry.loadRegistry(scriptDir / 'models')
+
+    inputData = FeaturesData(seqData={}, hmmData={})
+    for k, path in enumerate(features):
+        data = loadFeatures(path)
+        for name in data.seqData:
+            inputData.seqData[str(k) + '/' + name] = data.seqData[name]
+            inputData.hmmData[str(k) + '/' + name] = data.hmmData[name]
+
+    with stage('fit_gates', proteins=len(inputData.seqData)):
+        gateSet = fitGates(inputData, registry.predictors, registry.modelHashes(), cutoff, recall, margin)
+    gateSet.save(output)
+
+def assemble_motif_results(inputData: FeaturesData, parts: list, fused: bool = False, chunk_size: int = 65536,
+                           precision: str = 'float64', gated: bool = False) -> dict:
+    """
+        Window-ordered motif -> predict_proba output of inputData from (batch FeaturesData, predict_motifs output) parts
+        in any protein order. Proteins of no part (profile cache hits, jackhmmer output reused) are predicted here.
+    """
+
+    covered = {name for batchData, batchResults in parts for name in batchData.seqData}
+    rest = [name for name in inputData.seqData if name not in covered]
+    if rest:
+        restData = FeaturesData(seqData={name: inputData.seqData[name] for name in rest}, hmmData={name: inputData.hmmData[name] for name in rest})
+        parts = parts + [(restData, predict_motifs(restData, fused, chunk_size, precision=precision, gated=gated))]
+
+    index = {name: k for k, name in enumerate(inputData.seqData)}
+    lengths = np.array([len(seq) for seq in inputData.seqData.values()], dtype=np.int64)
+    proteins = [np.array([index[name] for name in batchData.seqData], dtype=np.int64) for batchData, batchResults in parts]
 
-    inputData = generateFeatures(inputFasta=Path(input), output_directory = Path(output_directory), threads = threads)
     results = {}
+    for motif in parts[0][1]:
+        nWindows = np.maximum(lengths - (windowWidth(motif) - 1), 0)
+        starts = np.concatenate(([0], np.cumsum(nWindows)))
+        for k, (batchData, batchResults) in zip(proteins, parts):
+            proba = np.asarray(batchResults[motif])
+            if motif not in results:
+                results[motif] = np.empty((int(starts[-1]), proba.shape[1]), dtype=proba.dtype)
+            # Window rows of each batch protein go to that protein's slot in input order
+            counts = nWindows[k]
+            results[motif][np.repeat(starts[k] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())] = proba
+
+    return results
+
+def write_output(inputData: FeaturesData, results: dict, output_dir: Path, cutoff=0.2, output_format='csv', partition_by_protein=False) :
+
+    with stage('results_table') as record:
+        table = results_table(inputData, results, cutoff)
+        record['rows'] = len(table)
+
+    with stage('write_output', rows=len(table)):
+        writer = ResultsWriter.openWriter(output_dir, output_format, allMotifs, partition_by_protein)
+        writer.write( table )
+        writer.close()
+
+def skipped_table(inputData: FeaturesData) -> pd.DataFrame:
+    return pd.DataFrame({'protein': list(inputData.skipped), 'prefilter_score': list(inputData.skipped.values())})
+
+def write_skipped(skipped: pd.DataFrame, output_dir: Path, append=False):
+
+    path = Path(str(output_dir) + '/nlrexpress.skipped.csv')
+    skipped.to_csv(path, mode='a' if append else 'w', header=not append, index=False)
+    if not append:
+        logging.info('Proteins skipped by the prefilter written to ' + str(path))
+
+def results_table(inputData: FeaturesData, results: dict, cutoff=0.2) -> pd.DataFrame:
+    """
+        One row per (protein, residue, motif) whose probability rounds to >= cutoff, ordered by protein,
+        residue and then motif (results order). Window rows are mapped back to residues through per-protein
+        window offsets, so only the hits are visited in Python.
+    """
+
+    names = list(inputData.seqData)
+    seqLengths = np.array([len(inputData.seqData[prot]) for prot in names], dtype=np.int64)
+
+    hitProt, hitRes, hitMotif, hitProba = [], [], [], []
+    for m, motif in enumerate(results):
+        windLeft = allMotifs[motif]["windLeft"]
+        nWindows = np.maximum(seqLengths - (windowWidth(motif) - 1), 0)
+        offsets = np.concatenate(([0], np.cumsum(nWindows)))
+
+        proba = np.asarray(results[motif])[:, 1]
+        # Cheap superset mask first, then the exact round(p, 4) >= cutoff test on the few candidates. NumPy rounding, as
+        # round() of the float64 scalars in the per-residue loop: Python's round of a float differs on ties like 0.19995
+        candidates = np.flatnonzero(proba >= cutoff - 1e-4)
+        candidates = candidates[np.round(proba[candidates], 4) >= cutoff].astype(np.int64)
+
+        prot = np.searchsorted(offsets, candidates, side='right') - 1
+        hitProt.append(prot)
+        hitRes.append(candidates - offsets[prot] + windLeft)
+        hitMotif.append(np.full(len(candidates), m))
+        hitProba.append(proba[candidates])
+
+    if results:
+        hitProt, hitRes, hitMotif, hitProba = (np.concatenate(a) for a in (hitProt, hitRes, hitMotif, hitProba))
+        order = np.lexsort((hitMotif, hitRes, hitProt))
+        hitProt, hitRes, hitMotif, hitProba = hitProt[order], hitRes[order], hitMotif[order], hitProba[order]
+    else:
+        hitProt = hitRes = hitMotif = np.empty(0, dtype=np.int64)
+        hitProba = np.empty(0)
+
+    motifs = list(results)
+    spans = [allMotifs[motif]["motifSpan"] for motif in motifs]
+    negative_5_pos, motifseq, positive_5_pos = [], [], []
+    for k, i, m in zip(hitProt.tolist(), hitRes.tolist(), hitMotif.tolist()):
+        seq = inputData.seqData[names[k]]
+        span = spans[m]
+        negative_5_pos.append(seq[i-5:i])
+        motifseq.append(seq[i:i + span])
+        positive_5_pos.append(seq[i + span:i + span + 5])
+
+    return pd.DataFrame({'protein': [names[k] for k in hitProt.tolist()],
+                         'res_id': (hitRes + 1).tolist(),
+                         'motif_id': [motifs[m] for m in hitMotif.tolist()],
+                         'probability': (100 * hitProba).tolist(),
+                         'negative_5_pos': negative_5_pos, 'motifseq': motifseq, 'positive_5_pos': positive_5_pos})
+
+CC_motifs = ["extEDVID"]
+NBS_motifs = ["VG", "P-loop", "RNSB-A", "RNSB-B", "RNSB-C", "RNSB-D", "Walker-B", "GLPL", "MHD"]
+TIR_motifs = ["bA", "aA", "bC", "aC", "bDaD1", "aD3"]
+LRR_motifs = ["LxxLxL"]
+
+motifDomains = {**{motif: "CC" for motif in CC_motifs}, **{motif: "NBS" for motif in NBS_motifs},
+                **{motif: "TIR" for motif in TIR_motifs}, **{motif: "LRR" for motif in LRR_motifs}}
+
+def annotate(input: Path, output_directory: Path, threshold: float = 0.8, allowed_gaps: int = 1):
+    """
+        Collapses the motif hits of each protein into domains and a domain architecture (e.g. CC-NBS-LRR),
+        written to nlrexpress.domains.csv and nlrexpress.architectures.csv in output_directory.
+    """
+
+    df = readResults(input)
+    domains, architectures = annotate_table(df, threshold, allowed_gaps)
+
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+    domains.to_csv(str(output_directory) + '/nlrexpress.domains.csv', index=False)
+    architectures.to_csv(str(output_directory) + '/nlrexpress.architectures.csv', index=False)
+    logging.info('Annotated ' + str(len(architectures)) + ' proteins')
+
+def annotate_table(df: pd.DataFrame, threshold: float = 0.8, allowed_gaps: int = 1) -> tuple:
+    """
+        Single pass over a results table sorted once by (protein, res_id), proteins kept in order of appearance.
+        Hits below threshold (a fraction; probabilities are stored as percentages) or of unknown motifs are skipped.
+        Consecutive hits of the same domain form one domain run; a run of at most allowed_gaps motifs lying between
+        two runs of the same domain is absorbed into them (motifs included), unless one of these is such a run too
+        (e.g. alternating CC and NBS hits are kept as they are). Returns (domain runs, protein -> architecture) tables.
+    """
+
+    domain = df['motif_id'].astype(str).map(motifDomains)
+    keep = (df['probability'].to_numpy() >= 100 * threshold) & domain.notna().to_numpy()
+
+    # Proteins keep their order of appearance
+    protein = df['protein'].astype(str)
+    hits = pd.DataFrame({'protein': protein.to_numpy()[keep],
+                         'order': pd.Categorical(protein, categories=protein.unique()).codes[keep],
+                         'res_id': df['res_id'].to_numpy()[keep],
+                         'domain': domain.to_numpy()[keep]})
+    hits = hits.sort_values(['order', 'res_id'], kind='stable', ignore_index=True).drop(columns='order')
+
+    runs = collapse_runs(hits.assign(start=hits['res_id'], end=hits['res_id'], n_motifs=1))
+
+    if allowed_gaps > 0 and len(runs) > 2:
+        protein, runDomain, size = runs['protein'].to_numpy(), runs['domain'].to_numpy(), runs['n_motifs'].to_numpy()
+        gap = np.zeros(len(runs), dtype=bool)
+        gap[1:-1] = (size[1:-1] <= allowed_gaps) & (protein[:-2] == protein[2:]) & (protein[1:-1] == protein[:-2]) \
+                    & (runDomain[:-2] == runDomain[2:])
+        gap[1:-1] &= ~gap[:-2] & ~gap[2:]
+        runs = collapse_runs(runs.assign(domain=np.where(gap, np.roll(runDomain, 1), runDomain)))
+
+    architectures = runs.groupby('protein', sort=False)['domain'].agg('-'.join).reset_index(name='architecture')
+
+    return runs, architectures
+
+def collapse_runs(runs: pd.DataFrame) -> pd.DataFrame:
+    """ Merges consecutive rows of the same protein and domain (rows already in protein, position order) """
+
+    protein, domain = runs['protein'].to_numpy(), runs['domain'].to_numpy()
+    newRun = np.ones(len(runs), dtype=bool)
+    newRun[1:] = (protein[1:] != protein[:-1]) | (domain[1:] != domain[:-1])
+    runId = np.cumsum(newRun)
+
+    return runs.groupby(runId, sort=False).agg(protein=('protein', 'first'), domain=('domain', 'first'),
+                                               start=('start', 'min'), end=('end', 'max'),
+                                               n_motifs=('n_motifs', 'sum')).reset_index(drop=True)
+
+def serve(host: str, port: int, work_directory: Path, threads: int, cache_directory: Path = None, cache_size: float = 10,
+          prefilter: str = None, prefilter_min_score: int = 10, prefilter_evalue: float = 1e-3, jackhmmer_cpus: int = jackhmmerCpus,
+          fused: bool = False, chunk_size: int = 65536, cutoff: float = 0.2, window: float = 0.05, max_batch: int = 256,
+          precision: str = 'float64', gated: bool = False):
+    """
+        Prediction daemon: the predictors, the profile cache and the prefilter index are loaded once, and concurrent
+        requests arriving within `window` seconds share one jackhmmer and inference pass (see MicroBatcher).
+    """
 
-    CCexpress = ModuleData.loadModels(
-        modelsPath = { 'extEDVID': str(scriptDir) + '/models/MLP_CC_extEDVID.pkl' })
-    for p in CCexpress.predictors:
-        X = generateXmat( inputData, p)
-        results[p] = CCexpress.predictors[p].model.predict_proba( X )
-
-    TIRexpress = ModuleData.loadModels(
-        modelsPath={
-                     'bA': str(scriptDir) + '/models/MLP_TIR_bA.pkl',
-                     'aA': str(scriptDir) + '/models/MLP_TIR_aA.pkl',
-                     'bC': str(scriptDir) + '/models/MLP_TIR_bC.pkl',
-                     'aC': str(scriptDir) + '/models/MLP_TIR_aC.pkl',
-                     'bDaD1': str(scriptDir) + '/models/MLP_TIR_bD-aD1.pkl',
-                     'aD3': str(scriptDir) + '/models/MLP_TIR_aD3.pkl'
-                     })
-    
-    for p in TIRexpress.predictors:
-        X = generateXmat(inputData, p)
-        results[p] = TIRexpress.predictors[p].model.predict_proba( X )
-
-    NBSexpress = ModuleData.loadModels(
-        modelsPath={
-                      'VG': str(scriptDir) + '/models/MLP_NBS_VG.pkl',
-                     'P-loop': str(scriptDir) + '/models/MLP_NBS_P-loop.pkl',
-                     'RNSB-A': str(scriptDir) + '/models/MLP_NBS_RNSB-A.pkl',
-                     'RNSB-B': str(scriptDir) + '/models/MLP_NBS_RNSB-B.pkl',
-                     'RNSB-C': str(scriptDir) + '/models/MLP_NBS_RNSB-C.pkl',
-                     'RNSB-D': str(scriptDir) + '/models/MLP_NBS_RNSB-D.pkl',
-                     'Walker-B': str(scriptDir) + '/models/MLP_NBS_Walker-B.pkl',
-                     'GLPL': str(scriptDir) + '/models/MLP_NBS_GLPL.pkl',
-                     'MHD': str(scriptDir) + '/models/MLP_NBS_MHD.pkl'
-                     })
-    
-    for p in NBSexpress.predictors:
-        X = generateXmat(inputData, p)
-        results[p] = NBSexpress.predictors[p].model.predict_proba( X )
-
-    LRRexpress = ModuleData.loadModels(
-        modelsPath={'LxxLxL': str(scriptDir) + '/models/MLP_LRR_LxxLxL.pkl'})
-    for p in LRRexpress.predictors:
-        X = generateXmat(inputData, p)
-        results[p] = LRRexpress.predictors[p].model.predict_proba( X )
-
-    write_output(inputData, results, output_directory)
-
-def write_output(inputData: FeaturesData, results: dict, output_dir: Path, cutoff=0.2) :
-
-    countpos = {motif: 0 for motif in results}
-
-    protein, res_id, motif_id, probability, negative_5_pos, motifseq, positive_5_pos = [], [], [], [], [], [], []
-
-    for prot in inputData.seqData:
-        seq = inputData.seqData[prot]
-        seqLength = len(seq)
-
-        for i, aa in enumerate(seq):
-            for motif in results:
-
-                if i >= allMotifs[motif]["windLeft"] and i < seqLength - (allMotifs[motif]["motifSpan"] + allMotifs[motif]["windRight"]):
-                    if round(results[motif][countpos[motif]][1], 4) >= cutoff:
-                        protein.append(prot)
-                        res_id.append(i+1)
-                        motif_id.append(motif)
-                        probability.append(100 * results[motif][countpos[motif]][1])
-                        negative_5_pos.append(seq[i-5:i])
-                        motifseq.append(seq[i:i + allMotifs[motif]["motifSpan"]])
-                        positive_5_pos.append(seq[i + allMotifs[motif]["motifSpan"]:i + allMotifs[motif]["motifSpan"] + 5])
-                
-                    countpos[motif] += 1
-
-    df = pd.DataFrame({'protein': protein, 'res_id': res_id, 'motif_id': motif_id, 'probability': probability, 'negative_5_pos': negative_5_pos, 'motifseq': motifseq, 'positive_5_pos': positive_5_pos})
-    df.to_csv(str(output_dir) + '/nlrexpress.csv', index=False)
-
-def annotate(input: Path, output_directory: Path):
-
-    CC_motifs = ["extEDVID"]
-    NBS_motifs = ["VG", "P-loop", "RNSB-A", "RNSB-B", "RNSB-C", "RNSB-D", "Walker-B", "GLPL", "MHD"]
-    TIR_motifs = ["bA", "aA", "bC", "aC", "bDaD1", "aD3"]
-    LRR_motifs = ["LxxLxL"]
-
-    threshold = 0.8
-    allowed_gaps = 1
-
-    # read input into pandas df
-    df = pd.read_csv(input)
-
-    # get unique proteins
-    proteins = df['protein'].unique()
-
-    for protein in proteins:
-        annotation = []
-
-        # subset df for protein
-        df_subset = df[df["protein"] == protein]
-
-        # ensure sorted by residue id
-        df_subset = df_subset.sort_values(by=["res_id"])
-
-        # get lists of data
-        residues = df_subset["res_id"].tolist()
-        motifs = df_subset["motif_id"].tolist()
-        probabilities = df_subset["probability"].tolist()
-
-        for i in range(len(residues)):
-            # check if residue is a CC motif
-            if motifs[i] in CC_motifs and probabilities[i] >= threshold:
-                annotation.append("CC")
-            elif motifs[i] in NBS_motifs and probabilities[i] >= threshold:
-                annotation.append("NBS")
-            elif motifs[i] in TIR_motifs and probabilities[i] >= threshold:
-                annotation.append("TIR")
-            elif motifs[i] in LRR_motifs and probabilities[i] >= threshold:
-                annotation.append("LRR")
-            else:
-                raise Exception(f"Unknown motif at residue {residues[i]} of protein {protein}")
-        
-        print(annotation)
+    scriptDir = Path(__file__).resolve().parent
+    Path(work_directory).mkdir(parents=True, exist_ok=True)
+
+    registry = ModelRegistry.loadRegistry(scriptDir / 'models', precision)
+    if gated:
+        window_gates(registry.predictors, precision)
+    cache = None
+    if cache_directory is not None:
+        cache = ProfileCache.loadCache(directory=Path(cache_directory), maxBytes=int(cache_size * 2**30),
+                                       targetDB=scriptDir / targetDB, params=jackhmmerParams)
+    screen = None
+    if prefilter is not None:
+        screen = Prefilter(method=prefilter, targetDB=scriptDir / targetDB, minScore=prefilter_min_score, evalue=prefilter_evalue)
+        if prefilter == 'kmer':
+            loadIndex(screen.targetDB, screen.k)
+
+    def process(seqData):
+        return serve_batch(seqData, Path(work_directory), threads, cache, screen, jackhmmer_cpus, fused, chunk_size, cutoff, precision, gated)
+
+    batcher = MicroBatcher(process=process, window=window, maxProteins=max_batch).start()
+    server = makeServer(host, port, batcher, info={'models': str(registry.source), 'precision': precision, 'prefilter': prefilter, 'cutoff': cutoff,
+                                                      'gated': gated})
+    logging.info('NLRexpress server listening on http://' + host + ':' + str(server.server_address[1]))
+    server.serve_forever()
+
+def serve_batch(seqData: dict, work_directory: Path, threads: int, cache: ProfileCache = None, prefilter: Prefilter = None,
+                jackhmmer_cpus: int = jackhmmerCpus, fused: bool = False, chunk_size: int = 65536, cutoff: float = 0.2,
+                precision: str = 'float64', gated: bool = False) -> dict:
+    """
+        One pipeline pass over a micro-batch in a scratch directory; returns protein name -> {'hits': [results rows],
+        'skipped': prefilter score or None}
+    """
+
+    startReport()
+    batchDir = Path(tempfile.mkdtemp(prefix='batch_', dir=work_directory))
+    try:
+        batchFasta = batchDir / 'batch.fasta'
+        writeFasta(seqData, batchFasta)
+        inputData = generateFeatures(inputFasta=batchFasta, output_directory=batchDir, threads=threads, cache=cache,
+                                     prefilter=prefilter, cpusPerJob=jackhmmer_cpus)
+        table = pd.DataFrame(columns=['protein'])
+        if inputData.seqData:
+            table = results_table(inputData, predict_motifs(inputData, fused, chunk_size, precision=precision, gated=gated), cutoff)
+    finally:
+        shutil.rmtree(batchDir, ignore_errors=True)
+
+    proteins = {name: {'hits': [], 'skipped': inputData.skipped.get(name)} for name in seqData}
+    for row in table.to_dict('records'):
+        proteins[row.pop('protein')]['hits'].append(row)
+
+    return proteins
 
 def main():
     parser = argparse.ArgumentParser("NLRexpress")
     parser.add_argument("--debug", action="store_true", help="Print debug messages")
 
     subparsers = parser.add_subparsers(dest="command")
-    predict_parser = subparsers.add_parser("nlrexpress", help="Predict NLR-related motifs")
+    predict_parser = subparsers.add_parser("predict", help="Predict NLR-related motifs")
     predict_parser.add_argument("--input", type=str, required=True, help="Input FASTA file")
     predict_parser.add_argument("--output_directory", type=str, required=True, help="Output directory")
     predict_parser.add_argument("--threads", type=int, default=4, help="Number of threads")
+    predict_parser.add_argument("--jackhmmer_cpus", type=int, default=jackhmmerCpus,
+                                help="CPUs per jackhmmer process; threads // jackhmmer_cpus processes run on length-balanced batches")
+    predict_parser.add_argument("--workers", type=int, default=1, help="Number of worker processes; the input is sharded and the thread budget split between them")
+    predict_parser.add_argument("--cache_directory", type=str, default=None, help="Directory of the per-sequence profile cache (disabled if not set)")
+    predict_parser.add_argument("--cache_size", type=float, default=10, help="Maximum profile cache size in GB")
+    predict_parser.add_argument("--fused", action="store_true", help="Run the predictors sharing a window width as one fused first-layer matrix multiply")
+    predict_parser.add_argument("--chunk_size", type=int, default=65536, help="Windows per fused inference chunk")
+    predict_parser.add_argument("--batch_size", type=int, default=None, help="Stream the input in batches of this many proteins to bound memory use")
+    predict_parser.add_argument("--output_format", type=str, default="csv", choices=outputFormats, help="Format of the nlrexpress results file")
+    predict_parser.add_argument("--partition_by_protein", action="store_true", help="parquet output: write one row group per protein")
+    predict_parser.add_argument("--store_probabilities", type=str, default=None, choices=["float16", "float32"],
+                                help="Also store every residue's probabilities for all motifs in a memory-mapped nlrexpress.proba file")
+    predict_parser.add_argument("--profile_stages", type=str, nargs="+", default=None,
+                                help="Profile the stages whose name starts with one of these (e.g. parse_hmm predict_proba/VG) into <output_directory>/profile")
+    predict_parser.add_argument("--profiler", type=str, default="cProfile", choices=profilers, help="Profiler used for --profile_stages")
+    predict_parser.add_argument("--cutoff", type=float, default=0.2,
+                                help="Minimum motif probability (0-1) of the reported hits; changing it on a finished run only re-thresholds")
+    predict_parser.add_argument("--precision", type=str, default="float64", choices=precisions,
+                                help="Weights of the NumPy forward pass: float32 trades a bounded accuracy loss for speed")
+    predict_parser.add_argument("--overlap", action="store_true",
+                                help="Parse and score each jackhmmer batch as soon as it finishes, while later batches are still searching")
+    predict_parser.add_argument("--gated", action="store_true",
+                                help="Only run the predictors on the windows passing their linear window gate (see gates); the others get probability 0")
+    predict_parser.add_argument("--restart", action="store_true", help="Ignore the run manifest of an earlier invocation and recompute every stage")
+    predict_parser.add_argument("--prefilter", type=str, default=None, choices=prefilterMethods,
+                                help="Pre-screen the proteins against the target DB and skip jackhmmer and the predictors for those without NLR signal")
+    predict_parser.add_argument("--prefilter_min_score", type=int, default=10, help="kmer prefilter: minimum seed matches on one diagonal band")
+    predict_parser.add_argument("--prefilter_evalue", type=float, default=1e-3, help="phmmer prefilter: maximum E-value of a hit")
 
     annotate_parser = subparsers.add_parser("annotate", help="Annotate proteins with NLR-related motifs")
-    annotate_parser.add_argument("--input", type=str, required=True, help="Input FASTA file")
+    annotate_parser.add_argument("--input", type=str, required=True, help="nlrexpress results file (.csv, .parquet or .npz)")
     annotate_parser.add_argument("--output_directory", type=str, required=True, help="Output directory")
+    annotate_parser.add_argument("--threshold", type=float, default=0.8, help="Minimum motif probability (0-1)")
+    annotate_parser.add_argument("--allowed_gaps", type=int, default=1, help="Maximum motifs of another domain absorbed between two runs of the same domain")
+
+    bundle_parser = subparsers.add_parser("bundle", help="Export the predictor models to a NumPy .npz bundle (no sklearn needed to load it)")
+    bundle_parser.add_argument("--models_directory", type=str, default=str(Path(__file__).resolve().parent / 'models'), help="Directory with the MLP .pkl files")
+    bundle_parser.add_argument("--output", type=str, default=None, help="Bundle path [default: <models_directory>/" + bundleName + "]")
+
+    serve_parser = subparsers.add_parser("serve", help="Run a prediction server keeping the models warm and batching concurrent requests")
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    serve_parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    serve_parser.add_argument("--work_directory", type=str, required=True, help="Scratch directory for the jackhmmer runs of each batch")
+    serve_parser.add_argument("--threads", type=int, default=4, help="Number of threads")
+    serve_parser.add_argument("--jackhmmer_cpus", type=int, default=jackhmmerCpus, help="CPUs per jackhmmer process")
+    serve_parser.add_argument("--cache_directory", type=str, default=None, help="Directory of the per-sequence profile cache (disabled if not set)")
+    serve_parser.add_argument("--cache_size", type=float, default=10, help="Maximum profile cache size in GB")
+    serve_parser.add_argument("--prefilter", type=str, default=None, choices=prefilterMethods, help="Pre-screen the proteins against the target DB")
+    serve_parser.add_argument("--prefilter_min_score", type=int, default=10, help="kmer prefilter: minimum seed matches on one diagonal band")
+    serve_parser.add_argument("--prefilter_evalue", type=float, default=1e-3, help="phmmer prefilter: maximum E-value of a hit")
+    serve_parser.add_argument("--fused", action="store_true", help="Fused first-layer inference per window group")
+    serve_parser.add_argument("--chunk_size", type=int, default=65536, help="Windows per fused inference chunk")
+    serve_parser.add_argument("--precision", type=str, default="float64", choices=precisions, help="Weights of the NumPy forward pass")
+    serve_parser.add_argument("--gated", action="store_true", help="Only run the predictors on the windows passing their window gate")
+    serve_parser.add_argument("--cutoff", type=float, default=0.2, help="Minimum motif probability (0-1) of the returned hits")
+    serve_parser.add_argument("--batch_window", type=float, default=0.05, help="Seconds a batch waits for more requests")
+    serve_parser.add_argument("--max_batch", type=int, default=256, help="Maximum proteins per batch")
+
+    gates_parser = subparsers.add_parser("gates", help="Fit the linear window gates of --gated inference on the features of earlier runs")
+    gates_parser.add_argument("--features", type=str, nargs="+", required=True, help="<stem>.features.npz files of finished predict runs")
+    gates_parser.add_argument("--output", type=str, default=str(Path(__file__).resolve().parent / 'models' / gatesName), help="Gates file")
+    gates_parser.add_argument("--cutoff", type=float, default=0.2, help="Hit probability the gate thresholds are calibrated for")
+    gates_parser.add_argument("--recall", type=float, default=1.0, help="Fraction of the calibration hits each gate must keep")
+    gates_parser.add_argument("--margin", type=float, default=2.0, help="Slack subtracted from the gate thresholds (logit units)")
 
     args = parser.parse_args()
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
     if args.command == "predict":
-        predict(args.input, args.output_directory, args.threads)
+        predict(args.input, args.output_directory, args.threads, args.workers, args.cache_directory, args.cache_size,
+                args.fused, args.chunk_size, args.batch_size, args.output_format, args.partition_by_protein,
+                args.store_probabilities, args.prefilter, args.prefilter_min_score, args.prefilter_evalue,
+                args.jackhmmer_cpus, args.restart, args.profile_stages, args.profiler, args.cutoff, args.precision,
+                args.overlap, args.gated)
     elif args.command == "annotate":
-        annotate(args.input, args.output_directory)
+        annotate(args.input, args.output_directory, args.threshold, args.allowed_gaps)
+    elif args.command == "serve":
+        logging.basicConfig(level=logging.INFO)
+        serve(args.host, args.port, args.work_directory, args.threads, args.cache_directory, args.cache_size,
+              args.prefilter, args.prefilter_min_score, args.prefilter_evalue, args.jackhmmer_cpus,
+              args.fused, args.chunk_size, args.cutoff, args.batch_window, args.max_batch, args.precision, args.gated)
+    elif args.command == "bundle":
+        registry = ModelRegistry.loadPickles(args.models_directory)
+        registry.exportBundle(args.output or Path(args.models_directory) / bundleName)
+    elif args.command == "gates":
+        logging.basicConfig(level=logging.INFO)
+        fit_gates(args.features, Path(args.output), args.cutoff, args.recall, args.margin)
     else:
         parser.print_help()
         sys.exit(1)
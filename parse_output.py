@@ -59,32 +59,21 @@ def classify_motif(motif):
 
 def classify_NLR(df):
 
-    prot_names = df['#ProtName'].unique()
-
-    for prot_name in prot_names:
+    # Map every motif to its class once, then walk the proteins in a single group-by pass
+    # (sorted once by protein, in order of appearance, and 'ResId') instead of filtering the whole table per protein.
+    motif_types = {motif: motif_type for motif_type, motifs in MOTIFS.items() for motif in motifs}
+    df = df.assign(MotifType=df['Motif'].map(motif_types).fillna("Unknown"),
+                   ProtOrder=pd.Categorical(df['#ProtName'], categories=df['#ProtName'].unique()))
+    df = df.sort_values(by=['ProtOrder', 'ResId'], kind='stable')
+
+    for prot_name, df_prot in df.groupby('#ProtName', sort=False):
         print(prot_name)
 
-        df_prot = df[df['#ProtName'] == prot_name]
-        
-        # sort df_prot by 'ResID' and get list of motifs from 'Motif' column
-        motifs = df_prot.sort_values(by=['ResId'])['Motif'].tolist()
-
-        # Get the order of CC, TIR, NBARC, and LRR domains
-        # To do this, iterate through the motif list.
-        # Identify the MOTIFS class the current motif belongs to.
-        # If the current motif classification is not the same as the current classification, then the current motif is the first motif of the current classification.
-        #
+        # Get the order of CC, TIR, NBARC, and LRR domains:
+        # a motif starts a new domain whenever its classification differs from the previous motif's.
+        motif_types = df_prot['MotifType']
+        domains = motif_types[motif_types != motif_types.shift()].tolist()
 
-        domains = []
-
-        current_classification = ""
-        for motif in motifs:
-            motif_type = classify_motif(motif)
-
-            if motif_type != current_classification:
-                domains.append(motif_type)
-                current_classification = motif_type
-        
         print(domains)
 
 
@@ -1,58 +1,23 @@
-from src.FeaturesData import *
+from src.FastaIO import *
 import click
 
-@click.group(chain=True, invoke_without_command=True)
-def cli():
-    pass
-
-
 @click.command()
-@click.option('--input', required=True, help='Input FASTA file ')
+@click.option('--input', required=True, help='Input FASTA file (.gz for gzip-compressed)')
 @click.option('--outdir', required=True, help='Output folder')
-@click.option('--batchsize', required=False, default=1000, help='Number of sequences to be split per file. [default: 1000]')
-
-def splitFastaFile( input:Path, outdir:Path, batchsize:int)  :
-
-    # TODO implement a better FASTA file check
-
-    seqData = {}
-
-    try:
-        with open( input, 'r' ) as inputFile :
-            lines = inputFile.readlines()
-            for i, line in enumerate(lines):
-                if line[0] == ">":
-                    if i>0:
-                        seqData[ name ] = seq
-                    name = line.split()[0][1:]
-                    seq = ''
-                else:
-                    seq += line[:-1]
-            seqData[name] = seq
-    except :
-        print("Input FASTA file error")
-        raise
-
-
-    count = 1
-    part = 1
-
-    outputFile = open( str(outdir) + '/' + Path(input).stem + '_part_' +  str(part) + '.fasta', 'w')
-
-    for name in seqData:
-        if count <= batchsize:
-            print('>', name, sep='', file=outputFile)
-            print(seqData[name], file=outputFile)
-            count += 1
-        else:
-            outputFile.close()
-            part += 1
-            count = 1
-            outputFile = open(str(outdir) + '/' + Path(input).stem + '_part_' + str(part) + '.fasta', 'w')
-
-            print('>', name, sep='', file=outputFile)
-            print(seqData[name], file=outputFile)
-
+@click.option('--batchsize', required=False, default=1000, help='Number of sequences to be split per file, 0 for no limit. [default: 1000]')
+@click.option('--max_residues', required=False, default=0, help='Close a part once it holds this many residues, 0 for no limit. [default: 0]')
+@click.option('--gzip', 'compress', is_flag=True, default=False, help='Write gzip-compressed parts (.fasta.gz)')
+@click.option('--threads', required=False, default=1, help='Parts written concurrently. [default: 1]')
+
+def splitFastaFile( input:Path, outdir:Path, batchsize:int, max_residues:int, compress:bool, threads:int )  :
+    """
+        Splits a FASTA file into parts by sequence count and/or residues and writes <stem>.parts.json,
+        which can be passed to nlrexpress.py predict --input.
+    """
+
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    parts = splitFasta(input, outdir, batchsize or None, max_residues or None, compress, threads)
+    print(str(len(parts)) + ' parts, manifest ' + str(Path(outdir) / (fastaStem(input) + partsManifestSuffix)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,108 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import gzip
+import json
+import logging
+
+partsManifestSuffix = '.parts.json'
+
+def openFasta(path: Path, mode: str = 'r'):
+    """ Text handle on a FASTA file, gzip-compressed if its name ends with .gz """
+
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', compresslevel=6)
+    return open(path, mode)
+
+def fastaStem(path: Path) -> str:
+    """ File name without its .gz and FASTA extensions """
+
+    name = Path(path).name
+    return Path(name[:-3] if name.endswith('.gz') else name).stem
+
+def readFasta(input: Path):
+    """
+        Yields (name, sequence) for every record of a FASTA file, as SeqIO.parse would give (record.id, str(record.seq)):
+        the name is the first word of the header, sequence lines are joined with white space removed and
+        lines before the first header are ignored. Gzip-compressed files (.gz) are read as they are.
+    """
+
+    name, lines = None, []
+    with openFasta(input, 'r') as inputFile:
+        for line in inputFile:
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(lines).replace(' ', '')
+                words = line[1:].split(None, 1)
+                name, lines = words[0] if words else '', []
+            elif name is not None:
+                lines.append(line.strip())
+
+    if name is not None:
+        yield name, ''.join(lines).replace(' ', '')
+
+def writeFasta(seqData:dict, output:Path):
+
+    with openFasta(output, 'w') as outputFile:
+        for name in seqData:
+            print('>', name, sep='', file=outputFile)
+            print(seqData[name], file=outputFile)
+
+def writeRecords(records: list, output: Path):
+
+    with openFasta(output, 'w') as outputFile:
+        for name, seq in records:
+            outputFile.write('>' + name + '\n' + seq + '\n')
+
+def splitFasta(input:Path, outdir:Path, batchsize:int = None, maxResidues:int = None, compress:bool = False, threads:int = 1) -> list :
+    """
+        Streams the records of input into consecutive parts <stem>_part_<n>.fasta (.fasta.gz with compress) in outdir.
+        A part is closed once it holds batchsize records or at least maxResidues residues, so parts can be balanced
+        by work rather than by protein count. Only the part being filled and the parts being written are in memory;
+        with threads > 1, up to that many finished parts are written (and compressed) concurrently.
+
+        The parts are listed with their protein and residue counts in <outdir>/<stem>.parts.json, which predict
+        accepts as input. Returns the part paths in input order.
+    """
+
+    if not batchsize and not maxResidues:
+        raise ValueError('splitFasta needs a batch size, a maximum number of residues per part, or both')
+
+    stem = fastaStem(input)
+    parts, pending = [], []
+    records, residues = [], 0
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+
+        def closePart():
+            parts.append({'path': Path(outdir) / (stem + '_part_' + str(len(parts) + 1) + ('.fasta.gz' if compress else '.fasta')),
+                          'proteins': len(records), 'residues': residues})
+            pending.append(executor.submit(writeRecords, records, parts[-1]['path']))
+            while len(pending) >= max(1, threads):
+                pending.pop(0).result()
+
+        for name, seq in readFasta(input):
+            records.append((name, seq))
+            residues += len(seq)
+            if (batchsize and len(records) >= batchsize) or (maxResidues and residues >= maxResidues):
+                closePart()
+                records, residues = [], 0
+
+        if records:
+            closePart()
+        for future in pending:
+            future.result()
+
+    with open(Path(outdir) / (stem + partsManifestSuffix), 'w') as manifestFile:
+        json.dump({'input': str(input), 'batch_size': batchsize, 'max_residues': maxResidues,
+                   'parts': [{**part, 'path': part['path'].name} for part in parts]}, manifestFile, indent=1)
+
+    logging.info('Split ' + str(input) + ' into ' + str(len(parts)) + ' parts')
+    return [part['path'] for part in parts]
+
+def readParts(manifest: Path) -> list :
+    """ Part paths listed in a splitFasta parts manifest, in input order """
+
+    with open(manifest, 'r') as manifestFile:
+        parts = json.load(manifestFile)['parts']
+    return [Path(manifest).parent / part['path'] for part in parts]
@@ -1,10 +1,19 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 import logging
 from datetime import datetime
 import subprocess
-from Bio import SeqIO
+import asyncio
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from .FastaIO import readFasta, writeFasta, fastaStem
+from .ProfileCache import ProfileCache
+from .Prefilter import Prefilter
+from .RunManifest import RunManifest
+from .RunReport import stage
 
 allMotifs = {
     "extEDVID": {"windLeft": 5, "windRight": 5, "motifSpan": 12},
@@ -26,117 +35,528 @@ allMotifs = {
     "LxxLxL": {"windLeft": 5, "windRight": 5, "motifSpan": 6}
 }
 
+targetDB = 'hmmer_db/targetDB.fasta'
+jackhmmerParams = ["-N", "2", "-E", "1e-5", "--domE", "1e-5"]
+# CPUs given to each jackhmmer process; --threads is split into threads // jackhmmerCpus concurrent processes
+jackhmmerCpus = 2
+
+# Per-residue profile columns: 20 match emissions for each of the two jackhmmer iterations
+nFeatures = 40
+featuresDtype = np.float32
+
 @dataclass
 class FeaturesData:
     """
-
+        seqData: protein name -> sequence
+        hmmData: protein name -> (L, 40) profile array
+        skipped: protein name -> prefilter score of the proteins left out by the prefilter
     """
     seqData: dict
     hmmData: dict
+    skipped: dict = field(default_factory=dict)
 
-def generateFeatures(inputFasta: Path, output_directory: Path, threads: int) -> FeaturesData :
+def generateFeatures(inputFasta: Path, output_directory: Path, threads: int, cache: ProfileCache = None,
+                     prefilter: Prefilter = None, cpusPerJob: int = jackhmmerCpus, manifest: RunManifest = None,
+                     consume = None) -> FeaturesData :
+    """
+        Profiles of the proteins of inputFasta (after the prefilter, from the cache or from jackhmmer).
+        With consume, jackhmmer runs as overlapJackhmmer and consume(FeaturesData) is called on each batch as soon as
+        it is parsed; proteins served from the cache or from jackhmmer output of an earlier run are not passed to it.
+    """
 
-    processesInputFasta = Path(str(output_directory) + "/" + str(inputFasta.stem) + '.fasta_proc')
-    seqData = processFastaFile( inputFasta, processesInputFasta )
+    processesInputFasta = Path(str(output_directory) + "/" + fastaStem(inputFasta) + '.fasta_proc')
+    with stage('read_fasta') as record:
+        seqData = processFastaFile( inputFasta, processesInputFasta )
+        record['proteins'] = len(seqData)
+
+    # Proteins failing the prefilter get neither profiles nor predictions
+    skipped = {}
+    if prefilter is not None:
+        with stage('prefilter', proteins=len(seqData)) as record:
+            seqData, skipped = prefilter.screen(seqData, processesInputFasta, output_directory, threads)
+            record['skipped'] = len(skipped)
+        if not seqData:
+            return FeaturesData(seqData = seqData, hmmData = {}, skipped = skipped)
+        if skipped:
+            processesInputFasta = Path(str(output_directory) + "/" + fastaStem(inputFasta) + '.candidates.fasta_proc')
+            writeFasta(seqData, processesInputFasta)
+
+    if manifest is not None:
+        manifest.complete('fasta_proc', [processesInputFasta])
+
+    if cache is None:
+        return FeaturesData(seqData = seqData, hmmData = generateProfiles(seqData, processesInputFasta, output_directory, threads, cpusPerJob,
+                                                                          manifest, consume),
+                            skipped = skipped)
+
+    hmmData = {}
+    with stage('profile_cache', proteins=len(seqData)) as record:
+        for name in seqData:
+            profile = cache.get(seqData[name])
+            if profile is not None:
+                hmmData[name] = profile
+        record['hits'] = len(hmmData)
+
+    missing = {name: seqData[name] for name in seqData if name not in hmmData}
+    logging.info('Profile cache: ' + str(len(hmmData)) + ' hits, ' + str(len(missing)) + ' misses')
+
+    if missing:
+        missingFasta = Path(str(output_directory) + "/" + fastaStem(inputFasta) + '.uncached.fasta_proc')
+        writeFasta(missing, missingFasta)
+        computed = generateProfiles(missing, missingFasta, output_directory, threads, cpusPerJob, manifest, consume)
+        for name in computed:
+            cache.put(missing[name], computed[name])
+        hmmData.update(computed)
+        cache.evictIfFull()
+
+    hmmData = {name: hmmData[name] for name in seqData}
+    logging.info('Profile cache: ' + ', '.join(key + ' ' + str(round(val, 3)) for key, val in cache.stats().items()))
+
+    return FeaturesData(seqData = seqData, hmmData = hmmData, skipped = skipped)
+
+def generateProfiles(seqData: dict, processedFasta: Path, output_directory: Path, threads: int, cpusPerJob: int = jackhmmerCpus,
+                     manifest: RunManifest = None, consume = None) -> dict :
+    """
+        Runs jackhmmer on processedFasta and returns protein name -> (L, 40) profile.
+        With a manifest, jackhmmer output recorded by an earlier run for the same processedFasta is reused.
+        With consume, see overlapJackhmmer.
+    """
 
-    run_jackhmmer(processesInputFasta, output_directory, threads, 'hmmer_db/targetDB.fasta')
+    residues = sum(len(seq) for seq in seqData.values())
+
+    if manifest is not None and manifest.isComplete('hmm'):
+        logging.info('jackhmmer output of the previous run reused')
+        hmmFiles = [path for path in manifest.files('hmm') if path.suffix == '.hmm']
+    elif consume is not None:
+        with stage('jackhmmer_overlapped', proteins=len(seqData), residues=residues):
+            hmmData, hmmFiles = overlapJackhmmer(seqData, processedFasta, output_directory, threads, cpusPerJob, manifest, consume)
+        if manifest is not None:
+            manifest.complete('hmm', [processedFasta] + hmmFiles)
+        return hmmData
+    else:
+        with stage('jackhmmer', proteins=len(seqData), residues=residues):
+            hmmFiles = scheduleJackhmmer(seqData, processedFasta, output_directory, threads, cpusPerJob, manifest)
+        if manifest is not None:
+            manifest.complete('hmm', [processedFasta] + hmmFiles)
 
     logging.info('Preparing features: Parsing HMM profile - started')
 
-    try:
-        hmmFile1 = str(output_directory) + "/" + str(processesInputFasta.stem) + '-1.hmm'
-        hmm_it1 = parse_hmm_multiprot(hmmFile1)
-    except FileNotFoundError:
-        raise FileNotFoundError('Preparing features: HMM profile iteration 1 was not found at. Execution stopped ')
+    with stage('parse_hmm', proteins=len(seqData), residues=residues):
+        hmm_it1, hmm_it2 = parseHmmFiles(hmmFiles)
+        if not hmm_it1:
+            raise FileNotFoundError('Preparing features: HMM profile iteration 1 was not found for ' + str(processedFasta) + '. Execution stopped ')
+        if not hmm_it2:
+            logging.warning('Preparing features: HMM profile iteration 2 was not found for ' + str(processedFasta) + '. The first iteration HMM profile will be used alone.')
 
-    try:
-        hmmFile2 = str(output_directory) + "/" + str(processesInputFasta.stem) + '-2.hmm'
-        hmm_it2 = parse_hmm_multiprot(hmmFile2)
+    with stage('generateInputFile', proteins=len(seqData), residues=residues):
+        return generateInputFile(seqData, hmm_it1, hmm_it2)
 
-    except FileNotFoundError:
-        logging.warning('Preparing features: HMM profile iteration 2 was not found at: ' + hmmFile2 + '. The first iteration HMM profile will be used alone.')
-        hmm_it2 = parse_hmm_multiprot(hmmFile1)
+def parseHmmFiles(hmmFiles: list) -> tuple :
+    """
+        Profiles of jackhmmer checkpoint files (<stem>-1.hmm / <stem>-2.hmm of one run or of each batch),
+        as (iteration 1, iteration 2) protein name -> emissions
+    """
 
-    hmmData = generateInputFile(seqData, hmm_it1, hmm_it2)
+    hmm_it1, hmm_it2 = {}, {}
+    for hmmFile in hmmFiles:
+        if str(hmmFile).endswith('-1.hmm'):
+            hmm_it1.update(iterHmmProfiles(hmmFile))
+        elif str(hmmFile).endswith('-2.hmm'):
+            hmm_it2.update(iterHmmProfiles(hmmFile))
 
-    return FeaturesData(seqData = seqData, hmmData = hmmData)
+    return hmm_it1, hmm_it2
 
-def generateXmat (FeaturesData:dict, motif:str):
-    X = []
+def windowWidth(motif: str) -> int:
+    """ Number of profile rows covered by one NN input window of the motif """
 
-    logging.info('Preparing features: NN input for motif ' + motif + ' started')
+    return allMotifs[motif]["windLeft"] + allMotifs[motif]["motifSpan"] + allMotifs[motif]["windRight"] + 1
 
-    for prot in FeaturesData.hmmData:
-        seqLength = len( FeaturesData.seqData[prot] )
-
-        for i in range(seqLength):
+def planWindowGroups(motifs) -> dict:
+    """
+        Groups motifs by window width, keeping the input order inside each group.
+        Window rows only depend on the width, so every motif of a group shares the same X matrix.
+    """
 
-                windLeft = allMotifs[motif]["windLeft"]
-                windRight = allMotifs[motif]["windRight"]
-                motifSpan = allMotifs[motif]["motifSpan"]
+    groups = {}
+    for motif in motifs:
+        groups.setdefault(windowWidth(motif), []).append(motif)
 
-                if i >= windLeft and i < seqLength - ( motifSpan + windRight) :
-                    features = FeaturesData.hmmData[prot]
+    return groups
 
-                    X.append([])
-                    for w in range(windLeft * (-1), motifSpan + windRight + 1):
-                        X[-1] += features[i+w]
+def generateXmat (FeaturesData:dict, motif:str) -> np.ndarray:
+    """
+        Builds the NN input matrix for a motif: one row per window position, each row being the
+        flattened profile rows from i - windLeft to i + motifSpan + windRight.
+    """
 
+    logging.info('Preparing features: NN input for motif ' + motif + ' started')
+    X = generateWindowMat(FeaturesData, windowWidth(motif))
     logging.info('Preparing features: NN input for motif ' + motif + ' done')
 
     return X
 
-def generateInputFile( seqData:dict, hmm_it1:dict, hmm_it2:dict) -> dict:
+def generateWindowMat(FeaturesData:dict, width:int) -> np.ndarray:
+    """ Stacks the windows of the given width of all proteins into one (nWindows, width * 40) matrix """
+
+    blocks = []
+    dtype = featuresDtype
+    for prot in FeaturesData.hmmData:
+        features = FeaturesData.hmmData[prot]
+        dtype = features.dtype
+        if features.shape[0] >= width:
+            blocks.append( windowView(features, width) )
+
+    if blocks:
+        return np.concatenate(blocks)
+
+    return np.empty((0, width * nFeatures), dtype=dtype)
+
+def windowView(features: np.ndarray, width: int) -> np.ndarray:
+    """
+        Read-only strided view of a (L, nFeatures) profile as (L - width + 1, width * nFeatures),
+        without copying. Consecutive windows overlap in memory.
+    """
+
+    features = np.ascontiguousarray(features)
+    nWindows = features.shape[0] - width + 1
+    return np.lib.stride_tricks.as_strided(features,
+                                           shape=(nWindows, width * features.shape[1]),
+                                           strides=(features.strides[0], features.strides[1]),
+                                           writeable=False)
+
+def generateInputFile( seqData:dict, hmm_it1:dict, hmm_it2:dict, dtype=featuresDtype) -> dict:
+    """
+        Stacks both jackhmmer iterations ((LENG, 20) arrays from iterHmmProfiles) into one
+        contiguous (L, 40) array per protein. Proteins missing from the second iteration reuse the first one.
+        Profiles parsed and stacked with dtype=np.float64 give the X of the list-based generateInputFile / generateXmat.
+    """
+
     data = {}
 
     for name in seqData:
-        seq = seqData[name]
-        data[name] = []
+        seqLength = len(seqData[name])
+        it1 = hmm_it1[name]
+        it2 = hmm_it2[name] if name in hmm_it2 else it1
 
-        for i, aa in enumerate(seq):
-            data[name].append([])
-            for k, (key, val) in enumerate( hmm_it1[name][i].items() ):
-                data[name][-1].append(val)
-
-            if name in hmm_it2:
-                for k, (key, val) in enumerate( hmm_it2[name][i].items() ):
-                    data[name][-1].append(val)
-            else:
-                for k, (key, val) in enumerate( hmm_it1[name][i].items() ):
-                    data[name][-1].append(val)
+        features = np.empty((seqLength, nFeatures), dtype=dtype)
+        features[:, :nFeatures // 2] = it1[:seqLength]
+        features[:, nFeatures // 2:] = it2[:seqLength]
+        data[name] = features
 
     return data
 
 def processFastaFile(input:Path, output:Path) -> dict :
-    seqData = {}
+    """ Reads the input FASTA and writes it back as one >name line and one sequence line per protein """
 
-    with open(input, 'r') as inputFile, open(output, 'w') as outputFile:
-        for record in SeqIO.parse(inputFile, "fasta"):
-            seqData[record.id] = str(record.seq)
-            SeqIO.write(record, outputFile, "fasta")
+    seqData = dict(readFasta(input))
+    writeFasta(seqData, output)
 
     return seqData
 
+def saveFeatures(inputData: FeaturesData, output: Path):
+    """ Writes sequences, profiles (concatenated, with per-protein lengths) and prefilter skips to one .npz file """
+
+    names = list(inputData.seqData)
+    profiles = [inputData.hmmData[name] for name in names]
+    np.savez(output,
+             names=np.array(names, dtype=str),
+             sequences=np.array([inputData.seqData[name] for name in names], dtype=str),
+             lengths=np.array([len(profile) for profile in profiles], dtype=np.int64),
+             profiles=np.concatenate(profiles) if profiles else np.empty((0, nFeatures), dtype=featuresDtype),
+             skipped_names=np.array(list(inputData.skipped), dtype=str),
+             skipped_scores=np.array(list(inputData.skipped.values()), dtype=np.float64))
+
+def loadFeatures(input: Path) -> FeaturesData :
+    """ Reads a saveFeatures file; the profiles are views into one array """
+
+    with np.load(input, allow_pickle=False) as data:
+        names = data['names'].tolist()
+        offsets = np.concatenate(([0], np.cumsum(data['lengths'])))
+        profiles = data['profiles']
+        seqData = dict(zip(names, data['sequences'].tolist()))
+        skipped = dict(zip(data['skipped_names'].tolist(), data['skipped_scores'].tolist()))
+
+    hmmData = {name: profiles[offsets[k]:offsets[k + 1]] for k, name in enumerate(names)}
+    return FeaturesData(seqData=seqData, hmmData=hmmData, skipped=skipped)
+
+def packBatches(seqData: dict, nBatches: int) -> list :
+    """
+        Longest-first packing of the proteins into at most nBatches batches of similar total length
+        (jackhmmer time grows with query length). Batches are returned largest first.
+    """
+
+    loads = [(0, k, []) for k in range(min(nBatches, len(seqData)))]
+    for name in sorted(seqData, key=lambda name: len(seqData[name]), reverse=True):
+        load, k, names = heapq.heappop(loads)
+        names.append(name)
+        heapq.heappush(loads, (load + len(seqData[name]), k, names))
+
+    return [names for load, k, names in sorted(loads, key=lambda batch: (-batch[0], batch[1])) if names]
+
+def scheduleJackhmmer(seqData: dict, processedFasta: Path, output_directory: Path, threads: int, cpusPerJob: int = jackhmmerCpus,
+                      manifest: RunManifest = None):
+    """
+        Runs jackhmmer as threads // cpusPerJob concurrent processes over length-balanced batches of processedFasta
+        and returns the checkpoint HMM files written (those of each batch, which are parsed as they are).
+        Several batches per process keep the processes busy until the end of the run, and the longest batches go first.
+        With a manifest, each finished batch is recorded and batches completed by an earlier run are not run again.
+    """
+
+    nJobs = max(1, threads // max(1, cpusPerJob))
+    if nJobs == 1 or len(seqData) < 2:
+        run_jackhmmer(processedFasta, output_directory, threads, targetDB)
+        return batchFiles(Path(output_directory) / processedFasta.name)[1:]
+
+    batchesDir, batches = writeJackhmmerBatches(seqData, processedFasta, output_directory, 4 * nJobs)
+
+    allBatches = batches
+    if manifest is not None:
+        batches = [batch for batch in batches if not manifest.isComplete('hmm/' + batch[0].stem)]
+        if len(batches) < len(allBatches):
+            logging.info('jackhmmer: ' + str(len(allBatches) - len(batches)) + ' batches completed by the previous run')
+
+    nJobs = max(1, min(nJobs, len(batches)))
+    totalResidues = sum(residues for batchFasta, residues, nSeq in batches)
+    if batches:
+        logging.info('jackhmmer: ' + str(len(batches)) + ' batches, ' + str(nJobs) + ' processes, ' + str(threads // nJobs) + ' CPUs each')
+
+    def runBatch(batchFasta):
+        start = time.perf_counter()
+        run_jackhmmer(batchFasta, batchesDir, threads // nJobs, targetDB)
+        return time.perf_counter() - start
+
+    doneResidues = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=nJobs) as executor:
+        futures = {executor.submit(runBatch, batch[0]): batch for batch in batches}
+        for done, future in enumerate(as_completed(futures)):
+            batchFasta, residues, nSeq = futures[future]
+            try:
+                elapsed = future.result()
+                completeBatch(batchFasta, manifest)
+            except (subprocess.CalledProcessError, FileNotFoundError) as error:
+                failed.append(error)
+                continue
+            doneResidues += residues
+            logging.info('jackhmmer ' + batchFasta.stem + ': ' + str(nSeq) + ' sequences, ' + str(residues) + ' residues in '
+                         + str(round(elapsed, 1)) + ' s (' + str(done + 1) + '/' + str(len(batches)) + ' batches, '
+                         + str(round(100 * doneResidues / totalResidues)) + '% of residues)')
+
+    # The other batches are finished and recorded first, so that a resumed run only searches the failed ones
+    if failed:
+        raise failed[0]
+
+    return [hmmFile for batch in allBatches for hmmFile in batchFiles(batch[0])[1:]]
+
+def writeJackhmmerBatches(seqData: dict, processedFasta: Path, output_directory: Path, nBatches: int) -> tuple :
+    """ Writes the packBatches batches to <stem>_jackhmmer/; returns that directory and (batch FASTA, residues, proteins) per batch """
+
+    batchesDir = Path(str(output_directory) + "/" + str(processedFasta.stem) + '_jackhmmer')
+    batchesDir.mkdir(parents=True, exist_ok=True)
+
+    batches = []
+    for k, names in enumerate(packBatches(seqData, nBatches)):
+        batchFasta = batchesDir / (str(processedFasta.stem) + '_batch_' + str(k + 1) + '.fasta_proc')
+        writeFasta({name: seqData[name] for name in names}, batchFasta)
+        batches.append((batchFasta, sum(len(seqData[name]) for name in names), len(names)))
+
+    return batchesDir, batches
+
+def batchFiles(batchFasta: Path) -> list :
+    """ A jackhmmer batch FASTA and the checkpoint HMMs written for it """
+
+    hmmFiles = [batchFasta.parent / (batchFasta.stem + iteration) for iteration in ('-1.hmm', '-2.hmm')]
+    return [batchFasta] + [hmmFile for hmmFile in hmmFiles if hmmFile.exists()]
+
+def completeBatch(batchFasta: Path, manifest: RunManifest = None):
+    """
+        Checks the checkpoints of a finished jackhmmer batch: raises if iteration 1 is missing, and records the batch
+        in the manifest only once both iterations were written (without iteration 2 a resumed run searches it again)
+    """
+
+    hmmFile1, hmmFile2 = [batchFasta.parent / (batchFasta.stem + iteration) for iteration in ('-1.hmm', '-2.hmm')]
+    if not hmmFile1.exists():
+        logging.error('Preparing features: HMM profile iteration 1 was not found at ' + str(hmmFile1))
+        raise FileNotFoundError('Preparing features: HMM profile iteration 1 was not found at ' + str(hmmFile1) + '. Execution stopped ')
+    if not hmmFile2.exists():
+        logging.warning('Preparing features: HMM profile iteration 2 was not found at ' + str(hmmFile2) + '. The first iteration HMM profile will be used alone.')
+    elif manifest is not None:
+        manifest.complete('hmm/' + batchFasta.stem, batchFiles(batchFasta))
+
+def checkJackhmmer(command: list, returncode: int):
+    """ Raises subprocess.CalledProcessError if the jackhmmer command failed """
+
+    if returncode != 0:
+        logging.error('jackhmmer failed with exit status ' + str(returncode) + ': ' + ' '.join(command))
+        raise subprocess.CalledProcessError(returncode, command)
+
+def overlapJackhmmer(seqData: dict, processedFasta: Path, output_directory: Path, threads: int, cpusPerJob: int = jackhmmerCpus,
+                     manifest: RunManifest = None, consume = None, queueSize: int = 2) -> tuple :
+    """
+        Producer/consumer version of scheduleJackhmmer: the batches are searched by asyncio jackhmmer subprocesses,
+        threads // cpusPerJob at a time, and every finished batch goes through a bounded queue to a consumer thread that
+        parses its HMMs, builds its profiles and calls consume(FeaturesData) (e.g. windowing and inference) while
+        later batches are still searching. Batches completed by an earlier run (manifest) are only parsed and consumed.
+        Returns protein name -> (L, 40) profile and the checkpoint HMM files of the batches.
+    """
+
+    nJobs = max(1, threads // max(1, cpusPerJob))
+    batchesDir, batches = writeJackhmmerBatches(seqData, processedFasta, output_directory, 4 * nJobs)
+    searched = [batch for batch in batches if manifest is None or not manifest.isComplete('hmm/' + batch[0].stem)]
+    nJobs = max(1, min(nJobs, len(searched)))
+    logging.info('jackhmmer (overlapped): ' + str(len(searched)) + ' batches to search, ' + str(nJobs) + ' processes, '
+                 + str(threads // nJobs) + ' CPUs each, ' + str(len(batches) - len(searched)) + ' completed by the previous run')
+
+    hmmData = {}
+    failed = []
+
+    def parseBatch(batchFasta: Path):
+        names = [name for name, seq in readFasta(batchFasta)]
+        hmmFile1, hmmFile2 = [batchesDir / (batchFasta.stem + iteration) for iteration in ('-1.hmm', '-2.hmm')]
+        if not hmmFile1.exists():
+            raise FileNotFoundError('Preparing features: HMM profile iteration 1 was not found at ' + str(hmmFile1) + '. Execution stopped ')
+        hmm_it1 = dict(iterHmmProfiles(hmmFile1))
+        hmm_it2 = dict(iterHmmProfiles(hmmFile2)) if hmmFile2.exists() else hmm_it1
+
+        batchData = FeaturesData(seqData={name: seqData[name] for name in names}, hmmData={})
+        batchData.hmmData = generateInputFile(batchData.seqData, hmm_it1, hmm_it2)
+        consume(batchData)
+        hmmData.update(batchData.hmmData)
+
+    async def pipeline():
+        queue = asyncio.Queue(maxsize=queueSize)
+        slots = asyncio.Semaphore(nJobs)
+        loop = asyncio.get_running_loop()
+
+        async def search(batch):
+            batchFasta, residues, nSeq = batch
+            if batch in searched:
+                async with slots:
+                    start = time.perf_counter()
+                    command = jackhmmerCommand(batchFasta, batchesDir, threads // nJobs, targetDB)
+                    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL)
+                    try:
+                        await process.wait()
+                    except asyncio.CancelledError:
+                        process.kill()
+                        raise
+                try:
+                    checkJackhmmer(command, process.returncode)
+                    completeBatch(batchFasta, manifest)
+                except (subprocess.CalledProcessError, FileNotFoundError) as error:
+                    failed.append(error)
+                    await queue.put(None)
+                    return
+                logging.info('jackhmmer ' + batchFasta.stem + ': ' + str(nSeq) + ' sequences, ' + str(residues) + ' residues in '
+                             + str(round(time.perf_counter() - start, 1)) + ' s')
+            await queue.put(batchFasta)
+
+        async def consumeBatches():
+            for _ in batches:
+                batchFasta = await queue.get()
+                if batchFasta is not None:
+                    await loop.run_in_executor(None, parseBatch, batchFasta)
+
+        await asyncio.gather(consumeBatches(), *[search(batch) for batch in batches])
+
+    asyncio.run(pipeline())
+    # As in scheduleJackhmmer, the failed batches are reported once the others are searched and recorded
+    if failed:
+        raise failed[0]
+
+    return {name: hmmData[name] for name in seqData}, [hmmFile for batch in batches for hmmFile in batchFiles(batch[0])[1:]]
+
+def jackhmmerCommand(inputFasta: Path, output_directory: Path, threads: int, target_db: str) -> list :
+
+    scriptDir = Path(__file__).resolve().parents[1]
+    return ["jackhmmer",
+            "--cpu", str(threads),
+            "-o", "/dev/null",
+            *jackhmmerParams,
+            "--noali",
+            "--chkhmm", str(output_directory) + "/" + str(inputFasta.stem),
+            str(inputFasta),
+            str(scriptDir) + '/' + target_db,
+            ]
+
 def run_jackhmmer(inputFasta: Path, output_directory: Path, threads: int, target_db: str):
 
     logging.info('jackhmmer - started')
-    scriptDir = Path(__file__).resolve().parents[1]
-    subprocess.run(["jackhmmer",
-                    "--cpu", str(threads),
-                    "-o", "/dev/null",
-                    "-N", "2",
-                    "-E", "1e-5",
-                    "--domE", "1e-5",
-                    "--noali",
-                    "--chkhmm", str(output_directory) + "/" + str(inputFasta.stem),
-                    inputFasta,
-                    str(scriptDir) + '/' + target_db,
-                    ],
-                   stdout=subprocess.PIPE)
+    command = jackhmmerCommand(inputFasta, output_directory, threads, target_db)
+    checkJackhmmer(command, subprocess.run(command, stdout=subprocess.PIPE).returncode)
     logging.info('jackhmmer - done')
 
+def iterHmmProfiles( hmmFile:Path, dtype=featuresDtype ):
+    """
+        Streams a jackhmmer --chkhmm file one HMM record at a time, yielding (name, emissions) pairs
+        where emissions is a (LENG, 20) array of the match-state emission scores ('*' -> inf).
+        With dtype=np.float64 the scores are exactly those of parse_hmm_multiprot.
+
+    :param hmmFile:
+    :return: generator of (str, np.ndarray)
+    """
+
+    try:
+        f = open(hmmFile, 'r')
+    except FileNotFoundError:
+        logging.error('Preparing features: HMM profile not found at: ' + str(hmmFile))
+        raise FileNotFoundError('Preparing features: HMM profile not found at: ' + str(hmmFile))
+
+    with f:
+        name = None
+        length = 0
+        emissions = None
+        values = []
+        row = -1
+
+        try:
+            for line in f:
+                if row >= 0:
+                    if line[0:2] == "//":
+                        if row != length:
+                            raise Exception("Problem parsing HMM file: expected " + str(length) + " match states, found " + str(row) + " for prot " + name)
+                        # one str -> float conversion per record, straight into the preallocated array
+                        emissions.ravel()[:] = values
+                        yield name, emissions
+                        values = []
+                        row = -1
+                        continue
+
+                    # Match-state lines start with the right-aligned node index (%7d); COMPO, insert-emission
+                    # and transition lines are blank there, so they are skipped without being split
+                    if line[6:7].isdigit():
+                        fields = line.split()[1:21]
+                        if '*' in fields:
+                            fields = ['inf' if val == '*' else val for val in fields]
+                        values += fields
+                        row += 1
+
+                elif line[0:4] == "NAME":
+                    name = line.split()[1]
+                    if name[-3:] == "-i1": name = name[:-3]
+                    length = 0
+
+                elif line[0:4] == "LENG":
+                    length = int( line.split()[1] )
+
+                elif line[0:3] == 'HMM' and line[0:6] != 'HMMER3':
+                    if name is None or length == 0:
+                        raise Exception("Problem parsing HMM file: no NAME/LENG line was found before the HMM block", name)
+                    emissions = np.empty((length, 20), dtype=dtype)
+                    row = 0
+
+        except Exception:
+            logging.error("Something went wrong when parsing the HMM file " + str(hmmFile))
+            raise
+
+        if row >= 0:
+            logging.error("Problem parsing HMM file: truncated record for prot " + str(name))
+            raise Exception("Problem parsing HMM file: truncated record for prot ", name)
+
 def parse_hmm_multiprot( hmmFile:Path ) -> dict:
     """
+        Dict-based reference parser (one {aa: score} dict per match state), kept for benchmarking
+        against iterHmmProfiles.
 
     :param hmmFile:
     :return:
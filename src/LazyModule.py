@@ -0,0 +1,21 @@
+from __future__ import annotations
+from dataclasses import dataclass
+import importlib
+
+@dataclass
+class LazyModule:
+    """
+        Stand-in for a module that is only imported when one of its attributes is first used,
+        e.g. pd = LazyModule('pandas'). Attributes are cached on the stand-in after the first lookup.
+    """
+
+    moduleName: str
+
+    def __getattr__(self, attr: str):
+
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+
+        value = getattr(importlib.import_module(self.moduleName), attr)
+        setattr(self, attr, value)
+        return value
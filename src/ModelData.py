@@ -20,7 +20,8 @@ class ModelData:
     def loadModel(self, path: Path) -> ModelData :
         """" Loads model binary file into the object """
 
-        model = pickle.load(open(path, 'rb'))
+        with open(path, 'rb') as modelFile:
+            model = pickle.load(modelFile)
         return ModelData(name=self.name, modelPath=path, model=model, params=self.params)
 
 
@@ -0,0 +1,328 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+import hashlib
+import logging
+import pickle
+import time
+import numpy as np
+from .RunManifest import fileChecksum
+
+# Predictor -> model file, grouped by NLRexpress module
+modelFiles = {
+    'CCexpress': {'extEDVID': 'MLP_CC_extEDVID.pkl'},
+    'TIRexpress': {
+        'bA': 'MLP_TIR_bA.pkl',
+        'aA': 'MLP_TIR_aA.pkl',
+        'bC': 'MLP_TIR_bC.pkl',
+        'aC': 'MLP_TIR_aC.pkl',
+        'bDaD1': 'MLP_TIR_bD-aD1.pkl',
+        'aD3': 'MLP_TIR_aD3.pkl'},
+    'NBSexpress': {
+        'VG': 'MLP_NBS_VG.pkl',
+        'P-loop': 'MLP_NBS_P-loop.pkl',
+        'RNSB-A': 'MLP_NBS_RNSB-A.pkl',
+        'RNSB-B': 'MLP_NBS_RNSB-B.pkl',
+        'RNSB-C': 'MLP_NBS_RNSB-C.pkl',
+        'RNSB-D': 'MLP_NBS_RNSB-D.pkl',
+        'Walker-B': 'MLP_NBS_Walker-B.pkl',
+        'GLPL': 'MLP_NBS_GLPL.pkl',
+        'MHD': 'MLP_NBS_MHD.pkl'},
+    'LRRexpress': {'LxxLxL': 'MLP_LRR_LxxLxL.pkl'}
+}
+
+bundleName = 'nlrexpress_models.npz'
+
+# Inference precisions: sklearn/float64 reference and float32 weights
+precisions = ['float64', 'float32']
+# Accuracy emulations, for benchmark.py precision only: float32 weights rounded to what int8 weights could hold
+emulatedPrecisions = ['int8']
+
+def _identity(x): return x
+def _logistic(x): return 1 / (1 + np.exp(-x))
+def _relu(x): return np.maximum(x, 0)
+
+def _softmax(x):
+    x = np.exp(x - x.max(axis=1, keepdims=True))
+    return x / x.sum(axis=1, keepdims=True)
+
+activations = {'identity': _identity, 'logistic': _logistic, 'tanh': np.tanh, 'relu': _relu, 'softmax': _softmax}
+
+@dataclass
+class NumpyMLP:
+    """
+        Weights of a fitted sklearn MLPClassifier with a plain NumPy forward pass,
+        so predictions do not need sklearn to be imported.
+    """
+
+    coefs: list
+    intercepts: list
+    activation: str
+    outActivation: str
+    classes: np.ndarray
+
+    def fromSklearn(model) -> NumpyMLP :
+        return NumpyMLP(coefs=[np.asarray(w) for w in model.coefs_], intercepts=[np.asarray(b) for b in model.intercepts_],
+                        activation=model.activation, outActivation=model.out_activation_, classes=np.asarray(model.classes_))
+
+    def withPrecision(self, precision: str) -> NumpyMLP :
+        """
+            Copy of a float64 model with float32 weights and biases; the forward pass then runs in float32.
+            int8 (an emulation, see emulatedPrecisions) also rounds each weight column to 255 levels symmetric around 0,
+            as int8 weights with one float32 scale per output column would hold them. NumPy has no int8 matrix product,
+            so this measures the accuracy of int8 weights, not their speed or memory.
+        """
+
+        if precision == 'float64':
+            return self
+        if precision not in precisions + emulatedPrecisions:
+            raise ValueError('Unknown precision ' + precision + ', expected one of ' + ', '.join(precisions + emulatedPrecisions))
+
+        intercepts = [b.astype(np.float32) for b in self.intercepts]
+        if precision == 'float32':
+            return NumpyMLP(coefs=[w.astype(np.float32) for w in self.coefs], intercepts=intercepts,
+                            activation=self.activation, outActivation=self.outActivation, classes=self.classes)
+
+        scales = [(np.abs(w).max(axis=0) / 127).astype(np.float32) for w in self.coefs]
+        scales = [np.where(scale > 0, scale, np.float32(1)) for scale in scales]
+        coefs = [np.round(w / scale).astype(np.int8).astype(np.float32) * scale for w, scale in zip(self.coefs, scales)]
+        return NumpyMLP(coefs=coefs, intercepts=intercepts, activation=self.activation, outActivation=self.outActivation,
+                        classes=self.classes)
+
+    def affine(self, activation: np.ndarray, layer: int) -> np.ndarray :
+
+        return activation @ self.coefs[layer] + self.intercepts[layer]
+
+    def predict_proba(self, X) -> np.ndarray :
+        """ Same computation and output layout as MLPClassifier.predict_proba """
+
+        if self.coefs[0].dtype == np.float32:
+            X = np.asarray(X, dtype=np.float32)
+        return self.forwardFrom(self.affine(X, 0), 1)
+
+    def forwardFrom(self, activation: np.ndarray, layer: int) -> np.ndarray :
+        """ Finishes the forward pass given the pre-activation output of layer - 1 """
+
+        hiddenActivation = activations[self.activation]
+        nLayers = len(self.coefs)
+
+        for i in range(layer, nLayers):
+            activation = hiddenActivation(activation)
+            activation = self.affine(activation, i)
+        activation = activations[self.outActivation](activation)
+
+        if activation.shape[1] == 1:
+            activation = activation.ravel()
+            return np.vstack([1 - activation, activation]).T
+
+        return activation
+
+def predictWindows(model, X: np.ndarray) -> np.ndarray :
+    """
+        model.predict_proba(X), also for X without any row (a batch left empty by the prefilter), which sklearn rejects:
+        the output columns and dtype then come from one dummy window
+    """
+
+    if X.shape[0]:
+        return model.predict_proba(X)
+    return model.predict_proba(np.zeros((1, X.shape[1]), dtype=X.dtype))[:0]
+
+def modelHash(model) -> str :
+    """ SHA-256 of a predictor's weights and activations, the same for a pickle and its bundle export """
+
+    if not isinstance(model, NumpyMLP):
+        model = NumpyMLP.fromSklearn(model)
+
+    checksum = hashlib.sha256((model.activation + '/' + model.outActivation).encode())
+    for array in model.coefs + model.intercepts + [model.classes]:
+        array = np.ascontiguousarray(array)
+        checksum.update((str(array.dtype) + str(array.shape)).encode())
+        checksum.update(array.tobytes())
+
+    return checksum.hexdigest()
+
+@dataclass
+class FusedMLPGroup:
+    """
+        Predictors sharing one input window matrix, with their first-layer weights concatenated
+        so that the hidden activations of every predictor come from a single matrix multiply.
+    """
+
+    names: list
+    models: list
+    coef: np.ndarray
+    intercept: np.ndarray
+    offsets: list
+
+    def fuse(models: dict) -> FusedMLPGroup :
+        """ models: predictor name -> NumpyMLP or fitted MLPClassifier, all with the same input size """
+
+        names = list(models)
+        fused = [model if isinstance(model, NumpyMLP) else NumpyMLP.fromSklearn(model) for model in models.values()]
+        offsets = np.cumsum([0] + [model.coefs[0].shape[1] for model in fused]).tolist()
+
+        return FusedMLPGroup(names=names, models=fused,
+                             coef=np.ascontiguousarray(np.hstack([model.coefs[0] for model in fused])),
+                             intercept=np.hstack([model.intercepts[0] for model in fused]),
+                             offsets=offsets)
+
+    def predict_proba(self, X, chunkSize: int = 65536) -> dict :
+        """ Returns predictor name -> predict_proba output, processing X in chunks of chunkSize rows """
+
+        nRows = X.shape[0]
+        results = {}
+        for name, model in zip(self.names, self.models):
+            results[name] = np.empty((nRows, max(2, model.coefs[-1].shape[1])), dtype=self.coef.dtype)
+
+        for start in range(0, nRows, chunkSize):
+            stop = min(start + chunkSize, nRows)
+            chunkStart = time.perf_counter()
+
+            hidden = X[start:stop] @ self.coef + self.intercept
+            for k, (name, model) in enumerate(zip(self.names, self.models)):
+                results[name][start:stop] = model.forwardFrom(hidden[:, self.offsets[k]:self.offsets[k + 1]], 1)
+
+            elapsed = time.perf_counter() - chunkStart
+            logging.debug('Fused inference ' + ', '.join(self.names) + ': rows ' + str(start) + '-' + str(stop) + ' of ' + str(nRows)
+                          + ', ' + str(int((stop - start) / max(elapsed, 1e-9))) + ' windows/sec')
+
+        return results
+
+@dataclass
+class ModelRegistry:
+    """
+        All predictors, loaded once per process and kept in memory.
+        predictors: predictor name -> model exposing predict_proba, in module order
+        referenceHashes: modelHashes of the float64 predictors a reduced-precision registry was converted from
+    """
+
+    predictors: dict
+    source: Path
+    fusedGroups: dict = field(default_factory=dict)
+    hashes: dict = field(default_factory=dict)
+    pickleChecksums: dict = field(default_factory=dict)
+    referenceHashes: dict = field(default_factory=dict)
+
+    def modelHashes(self) -> dict :
+        """ Predictor name -> modelHash, computed on first use and kept with the registry """
+
+        if not self.hashes:
+            self.hashes = {name: modelHash(model) for name, model in self.predictors.items()}
+
+        return self.hashes
+
+    def fusedGroup(self, names: list) -> FusedMLPGroup :
+        """ Fused predictors for names, built on first use and kept with the registry """
+
+        key = tuple(names)
+        if key not in self.fusedGroups:
+            self.fusedGroups[key] = FusedMLPGroup.fuse({name: self.predictors[name] for name in names})
+
+        return self.fusedGroups[key]
+
+    def loadPickles(modelsDir: Path) -> ModelRegistry :
+        """ Loads the sklearn pickles (imports sklearn through unpickling) """
+
+        predictors, checksums = {}, {}
+        for module in modelFiles:
+            for name, fileName in modelFiles[module].items():
+                with open(Path(modelsDir) / fileName, 'rb') as modelFile:
+                    predictors[name] = pickle.load(modelFile)
+                checksums[name] = fileChecksum(Path(modelsDir) / fileName)
+
+        return ModelRegistry(predictors=predictors, source=Path(modelsDir), pickleChecksums=checksums)
+
+    def loadBundle(bundle: Path) -> ModelRegistry :
+        """ Loads a bundle written by exportBundle as NumpyMLP predictors """
+
+        predictors, checksums = {}, {}
+        with np.load(bundle, allow_pickle=False) as data:
+            for module in modelFiles:
+                for name in modelFiles[module]:
+                    if name + '/pickle_sha256' in data.files:
+                        checksums[name] = str(data[name + '/pickle_sha256'])
+                    nLayers = int(data[name + '/n_layers'])
+                    predictors[name] = NumpyMLP(coefs=[data[name + '/coef_' + str(i)] for i in range(nLayers)],
+                                                intercepts=[data[name + '/intercept_' + str(i)] for i in range(nLayers)],
+                                                activation=str(data[name + '/activation']),
+                                                outActivation=str(data[name + '/out_activation']),
+                                                classes=data[name + '/classes'])
+
+        return ModelRegistry(predictors=predictors, source=Path(bundle), pickleChecksums=checksums)
+
+    def exportBundle(self, bundle: Path):
+        """ Writes every predictor's weights, and the SHA-256 of the pickle it came from, to one compressed .npz file """
+
+        arrays = {}
+        for name, model in self.predictors.items():
+            if not isinstance(model, NumpyMLP):
+                model = NumpyMLP.fromSklearn(model)
+            arrays[name + '/n_layers'] = np.array(len(model.coefs))
+            arrays[name + '/activation'] = np.array(model.activation)
+            arrays[name + '/out_activation'] = np.array(model.outActivation)
+            arrays[name + '/classes'] = model.classes
+            if name in self.pickleChecksums:
+                arrays[name + '/pickle_sha256'] = np.array(self.pickleChecksums[name])
+            for i in range(len(model.coefs)):
+                arrays[name + '/coef_' + str(i)] = model.coefs[i]
+                arrays[name + '/intercept_' + str(i)] = model.intercepts[i]
+
+        np.savez_compressed(bundle, **arrays)
+        logging.info('Model bundle written to ' + str(bundle))
+
+    def withPrecision(self, precision: str) -> ModelRegistry :
+        """ Registry of NumpyMLP.withPrecision copies of the predictors """
+
+        if precision == 'float64':
+            return self
+
+        predictors = {name: (model if isinstance(model, NumpyMLP) else NumpyMLP.fromSklearn(model)).withPrecision(precision)
+                      for name, model in self.predictors.items()}
+        return ModelRegistry(predictors=predictors, source=self.source, referenceHashes=dict(self.modelHashes()))
+
+    def loadRegistry(modelsDir: Path, precision: str = 'float64') -> ModelRegistry :
+        """
+            Returns the resident registry for modelsDir, loading it on first use. The .npz bundle is
+            preferred when it was exported from the pickles present (same SHA-256, whatever their modification
+            times), otherwise the pickles are loaded.
+            Other precisions than float64 are converted from the float64 models once per process; only the
+            converted registry stays resident, the float64 one only if it was already.
+        """
+
+        modelsDir = Path(modelsDir).resolve()
+        if (modelsDir, precision) in _registries:
+            return _registries[(modelsDir, precision)]
+
+        if precision != 'float64':
+            reference = _registries.get((modelsDir, 'float64')) or ModelRegistry.loadModels(modelsDir)
+            registry = reference.withPrecision(precision)
+            logging.info('Models converted to ' + precision)
+            _registries[(modelsDir, precision)] = registry
+            return registry
+
+        registry = ModelRegistry.loadModels(modelsDir)
+        _registries[(modelsDir, precision)] = registry
+
+        return registry
+
+    def loadModels(modelsDir: Path) -> ModelRegistry :
+        """ The float64 models of modelsDir, from the bundle if it matches the pickles present, without keeping them resident """
+
+        bundle = modelsDir / bundleName
+        registry = None
+        if bundle.exists():
+            registry = ModelRegistry.loadBundle(bundle)
+            stale = [name for module in modelFiles for name, fileName in modelFiles[module].items()
+                     if (modelsDir / fileName).exists() and registry.pickleChecksums.get(name) != fileChecksum(modelsDir / fileName)]
+            if stale:
+                logging.warning('Model bundle ' + str(bundle) + ' does not match the pickles of ' + ', '.join(stale)
+                                + ', loading the pickles instead (re-export it with nlrexpress.py bundle)')
+                registry = None
+        if registry is None:
+            registry = ModelRegistry.loadPickles(modelsDir)
+
+        logging.info('Models loaded from ' + str(registry.source))
+
+        return registry
+
+_registries = {}
@@ -0,0 +1,250 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+import logging
+import numpy as np
+from .FeaturesData import allMotifs, windowWidth
+from .LazyModule import LazyModule
+
+pd = LazyModule('pandas')
+
+outputFormats = ['csv', 'parquet', 'npz']
+outputColumns = ['protein', 'res_id', 'motif_id', 'probability', 'negative_5_pos', 'motifseq', 'positive_5_pos']
+stringColumns = ['negative_5_pos', 'motifseq', 'positive_5_pos']
+
+def typedResults(df: pd.DataFrame, motifs: list) -> pd.DataFrame:
+    """ Categorical protein/motif_id, int32 res_id and float32 probability """
+
+    return df.astype({'protein': 'category', 'res_id': np.int32, 'probability': np.float32}).assign(
+        motif_id=pd.Categorical(df['motif_id'], categories=motifs))
+
+@dataclass
+class ResultsWriter:
+    """
+        Writes results tables to <output_dir>/nlrexpress.<format>, one table (batch) at a time.
+
+        csv:     rows are appended to the file as they come.
+        parquet: each table becomes one row group, or one row group per protein with partitionByProtein,
+                 written through pyarrow (optional dependency).
+        npz:     typed columns (category codes + categories, int32, float32), written on close.
+    """
+
+    path: Path
+    format: str
+    motifs: list
+    partitionByProtein: bool = False
+    writer: object = None
+    tables: list = field(default_factory=list)
+
+    def openWriter(output_dir: Path, format: str, motifs: list, partitionByProtein: bool = False) -> ResultsWriter :
+
+        if format not in outputFormats:
+            raise ValueError('Unknown output format ' + format + ', expected one of ' + ', '.join(outputFormats))
+
+        path = Path(str(output_dir) + '/nlrexpress.' + format)
+        results = ResultsWriter(path=path, format=format, motifs=list(motifs), partitionByProtein=partitionByProtein)
+
+        if format == 'csv':
+            pd.DataFrame(columns=outputColumns).to_csv(path, index=False)
+        elif format == 'parquet':
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError('The parquet output format requires pyarrow (conda install pyarrow)')
+
+            schema = pa.schema([('protein', pa.dictionary(pa.int32(), pa.string())),
+                                ('res_id', pa.int32()),
+                                ('motif_id', pa.dictionary(pa.int8(), pa.string())),
+                                ('probability', pa.float32())] +
+                               [(column, pa.string()) for column in stringColumns])
+            results.writer = pq.ParquetWriter(path, schema)
+
+        return results
+
+    def write(self, df: pd.DataFrame):
+
+        if self.format == 'csv':
+            df.to_csv(self.path, mode='a', header=False, index=False)
+
+        elif self.format == 'parquet':
+            import pyarrow as pa
+
+            df = typedResults(df, self.motifs)
+            if self.partitionByProtein:
+                for protein, rows in df.groupby('protein', sort=False, observed=True):
+                    self.writer.write_table(pa.Table.from_pandas(rows, schema=self.writer.schema, preserve_index=False))
+            elif len(df):
+                self.writer.write_table(pa.Table.from_pandas(df, schema=self.writer.schema, preserve_index=False))
+
+        else:
+            self.tables.append(df)
+
+    def close(self):
+
+        if self.format == 'parquet':
+            self.writer.close()
+
+        elif self.format == 'npz':
+            df = typedResults(pd.concat(self.tables, ignore_index=True) if self.tables else pd.DataFrame(columns=outputColumns), self.motifs)
+            self.tables = []
+            np.savez_compressed(self.path,
+                                protein_codes=df['protein'].cat.codes.to_numpy(np.int32),
+                                protein_categories=np.array(df['protein'].cat.categories, dtype=str),
+                                motif_codes=df['motif_id'].cat.codes.to_numpy(np.int8),
+                                motif_categories=np.array(self.motifs, dtype=str),
+                                res_id=df['res_id'].to_numpy(),
+                                probability=df['probability'].to_numpy(),
+                                **{column: df[column].to_numpy(dtype=str) for column in stringColumns})
+
+        logging.info('Results written to ' + str(self.path))
+
+def readResults(path: Path) -> pd.DataFrame:
+    """ Reads a results file written by ResultsWriter (format taken from the file extension) """
+
+    suffix = Path(path).suffix
+    if suffix == '.parquet':
+        return pd.read_parquet(path)
+
+    if suffix == '.npz':
+        with np.load(path, allow_pickle=False) as data:
+            df = pd.DataFrame({
+                'protein': pd.Categorical.from_codes(data['protein_codes'], categories=data['protein_categories']),
+                'res_id': data['res_id'],
+                'motif_id': pd.Categorical.from_codes(data['motif_codes'], categories=data['motif_categories']),
+                'probability': data['probability']})
+            for column in stringColumns:
+                df[column] = data[column]
+        return df
+
+    return pd.read_csv(path)
+
+def saveMotifResults(results: dict, output: Path, hashes: dict = None):
+    """
+        Writes motif -> predict_proba output (as returned by predict_motifs) to an .npz file, in motif order,
+        with the hash of the model each motif was predicted with (hashes: motif -> modelHash).
+        Of binary outputs only the positive column is stored: the other one is 1 - p, rebuilt by loadMotifResults.
+    """
+
+    def stored(proba):
+        proba = np.asarray(proba)
+        return proba[:, 1] if proba.ndim == 2 and proba.shape[1] == 2 else proba
+
+    np.savez(output, motifs=np.array(list(results), dtype=str),
+             hashes=np.array([(hashes or {}).get(motif, '') for motif in results], dtype=str),
+             **{'proba_' + str(m): stored(results[motif]) for m, motif in enumerate(results)})
+
+def loadMotifResults(input: Path) -> dict :
+
+    def proba(stored):
+        return np.column_stack([1 - stored, stored]) if stored.ndim == 1 else stored
+
+    with np.load(input, allow_pickle=False) as data:
+        return {motif: proba(data['proba_' + str(m)]) for m, motif in enumerate(data['motifs'].tolist())}
+
+def loadMotifHashes(input: Path) -> dict :
+    """ Motif -> hash of the model its stored probabilities come from ('' if not recorded) """
+
+    with np.load(input, allow_pickle=False) as data:
+        motifs = data['motifs'].tolist()
+        return dict(zip(motifs, data['hashes'].tolist() if 'hashes' in data else [''] * len(motifs)))
+
+def residueProbabilities(inputData, results: dict, dtype=np.float32) -> tuple :
+    """
+        Scatters the window-ordered positive-class probabilities of every motif back to residues.
+        Returns (names, lengths, (sum of lengths, nMotifs) array); residues without a window are NaN.
+    """
+
+    names = list(inputData.seqData)
+    lengths = np.array([len(inputData.seqData[name]) for name in names], dtype=np.int64)
+    resOffsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    proba = np.full((int(resOffsets[-1]), len(results)), np.nan, dtype=dtype)
+    for m, motif in enumerate(results):
+        nWindows = np.maximum(lengths - (windowWidth(motif) - 1), 0)
+        winOffsets = np.concatenate(([0], np.cumsum(nWindows)))
+        prot = np.repeat(np.arange(len(names)), nWindows)
+        rows = resOffsets[prot] + allMotifs[motif]["windLeft"] + (np.arange(winOffsets[-1]) - winOffsets[prot])
+        proba[rows, m] = np.asarray(results[motif])[:, 1]
+
+    return names, lengths, proba
+
+@dataclass
+class ProbabilityWriter:
+    """
+        Appends per-residue probabilities of all motifs to a raw <output_dir>/nlrexpress.proba file
+        (row-major, nMotifs columns) and writes the protein offset table to nlrexpress.proba_index.npz on close.
+    """
+
+    path: Path
+    dtype: str
+    motifs: list
+    names: list = field(default_factory=list)
+    lengths: list = field(default_factory=list)
+
+    def openProbabilities(output_dir: Path, motifs: list, dtype: str = 'float32') -> ProbabilityWriter :
+
+        path = Path(str(output_dir) + '/nlrexpress.proba')
+        open(path, 'wb').close()
+        return ProbabilityWriter(path=path, dtype=np.dtype(dtype).name, motifs=list(motifs))
+
+    def write(self, inputData, results: dict):
+
+        names, lengths, proba = residueProbabilities(inputData, {motif: results[motif] for motif in self.motifs}, self.dtype)
+        self.append(names, lengths, proba)
+
+    def append(self, names: list, lengths, proba: np.ndarray):
+
+        with open(self.path, 'ab') as probaFile:
+            probaFile.write(np.ascontiguousarray(proba, dtype=self.dtype).tobytes())
+        self.names += list(names)
+        self.lengths += list(lengths)
+
+    def appendStore(self, output_dir: Path):
+        """ Appends a store written by another ProbabilityWriter (e.g. a shard), copying its file in blocks """
+
+        store = ProbabilityStore.openStore(output_dir)
+        for start in range(0, store.proba.shape[0], 1 << 20):
+            self.append([], [], store.proba[start:start + (1 << 20)])
+        self.names += list(store.names)
+        self.lengths += np.diff(store.offsets).tolist()
+
+    def close(self):
+
+        np.savez(Path(str(self.path) + '_index.npz'),
+                 names=np.array(self.names, dtype=str),
+                 offsets=np.concatenate(([0], np.cumsum(np.array(self.lengths, dtype=np.int64)))),
+                 motifs=np.array(self.motifs, dtype=str),
+                 dtype=np.array(self.dtype))
+        logging.info('Per-residue probabilities written to ' + str(self.path))
+
+@dataclass
+class ProbabilityStore:
+    """
+        Memory-mapped view of a ProbabilityWriter output. protein(name) is an (L, nMotifs) slice of the map,
+        so reading one protein touches only its own rows.
+    """
+
+    proba: np.ndarray
+    names: np.ndarray
+    offsets: np.ndarray
+    motifs: list
+    index: dict
+
+    def openStore(output_dir: Path) -> ProbabilityStore :
+
+        path = Path(str(output_dir) + '/nlrexpress.proba')
+        with np.load(Path(str(path) + '_index.npz'), allow_pickle=False) as data:
+            names, offsets, motifs, dtype = data['names'], data['offsets'], data['motifs'].tolist(), str(data['dtype'])
+
+        if offsets[-1] == 0:
+            proba = np.empty((0, len(motifs)), dtype=dtype)
+        else:
+            proba = np.memmap(path, dtype=dtype, mode='r', shape=(int(offsets[-1]), len(motifs)))
+
+        return ProbabilityStore(proba=proba, names=names, offsets=offsets, motifs=motifs,
+                                index={name: k for k, name in enumerate(names.tolist())})
+
+    def protein(self, name: str) -> np.ndarray :
+        k = self.index[name]
+        return self.proba[self.offsets[k]:self.offsets[k + 1]]
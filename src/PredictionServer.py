@@ -0,0 +1,146 @@
+from __future__ import annotations
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import json
+import logging
+import queue
+import threading
+import time
+
+# Residue codes of protein sequences: the 20 amino acids and the ambiguous / non-standard ones (B, J, O, U, X, Z)
+residueCodes = set('ACDEFGHIKLMNPQRSTVWYBJOUXZ')
+
+@dataclass
+class MicroBatcher:
+    """
+        Merges concurrent requests into one pipeline pass. The first waiting request opens a batch, which
+        takes every request arriving within `window` seconds, up to maxProteins proteins, and is then passed
+        to process(seqData) -> protein name -> result. Batches run one at a time on the batcher thread.
+
+        Proteins are renamed to batch-unique ids before processing, so requests may reuse protein names.
+        When a batch of several requests fails, each of them is processed again on its own, so that only
+        the failing requests get the error.
+    """
+
+    process: object
+    window: float = 0.05
+    maxProteins: int = 256
+    requests: queue.Queue = field(default_factory=queue.Queue)
+    stats: dict = field(default_factory=lambda: {'requests': 0, 'proteins': 0, 'batches': 0, 'busy_seconds': 0.0})
+
+    def start(self) -> MicroBatcher :
+        threading.Thread(target=self.run, name='MicroBatcher', daemon=True).start()
+        return self
+
+    def submit(self, seqData: dict) -> Future :
+        """ Queues one request (protein name -> sequence); the future resolves to protein name -> result """
+
+        future = Future()
+        self.requests.put((seqData, future))
+        return future
+
+    def run(self):
+
+        while True:
+            batch = [self.requests.get()]
+            nProteins = len(batch[0][0])
+            deadline = time.perf_counter() + self.window
+
+            while nProteins < self.maxProteins:
+                try:
+                    request = self.requests.get(timeout=max(0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                nProteins += len(request[0])
+
+            self.runBatch(batch)
+
+    def runBatch(self, batch: list):
+
+        seqData, owners = {}, []
+        for k, (request, future) in enumerate(batch):
+            ids = {}
+            for name, seq in request.items():
+                ids[name] = 'r' + str(k) + '_' + str(len(seqData))
+                seqData[ids[name]] = seq
+            owners.append((ids, future))
+
+        start = time.perf_counter()
+        try:
+            results = self.process(seqData)
+        except Exception as error:
+            if len(batch) > 1:
+                logging.warning('Prediction batch of ' + str(len(batch)) + ' requests failed (' + str(error) + '), processing them one by one')
+                for request in batch:
+                    self.runBatch([request])
+                return
+            logging.exception('Prediction batch failed')
+            for ids, future in owners:
+                future.set_exception(error)
+            return
+        elapsed = time.perf_counter() - start
+
+        for ids, future in owners:
+            future.set_result({name: results[internal] for name, internal in ids.items()})
+
+        self.stats['requests'] += len(batch)
+        self.stats['proteins'] += len(seqData)
+        self.stats['batches'] += 1
+        self.stats['busy_seconds'] += elapsed
+        logging.info('Batch of ' + str(len(batch)) + ' requests, ' + str(len(seqData)) + ' proteins in ' + str(round(elapsed, 3)) + ' s')
+
+def makeServer(host: str, port: int, batcher: MicroBatcher, info: dict = None):
+    """
+        HTTP front end of a MicroBatcher:
+            POST /predict  {"sequences": {name: sequence, ...}} -> {"proteins": {name: result, ...}}
+            GET  /health   server info and batcher statistics
+    """
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+
+        def reply(self, status: int, body: dict):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self.reply(404, {'error': 'Unknown path ' + self.path})
+            self.reply(200, {'status': 'ok', **(info or {}), **batcher.stats, 'queued': batcher.requests.qsize()})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self.reply(404, {'error': 'Unknown path ' + self.path})
+
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                seqData = request['sequences']
+                if not seqData or not isinstance(seqData, dict) or not all(isinstance(seq, str) and seq for seq in seqData.values()):
+                    raise ValueError('"sequences" must map protein names to non-empty sequences')
+            except (ValueError, KeyError, TypeError) as error:
+                return self.reply(400, {'error': str(error)})
+
+            seqData = {str(name): ''.join(seq.split()).upper() for name, seq in seqData.items()}
+            invalid = [name for name, seq in seqData.items() if not seq or not set(seq) <= residueCodes]
+            if invalid:
+                return self.reply(400, {'error': 'Sequences with characters other than residue codes: ' + ', '.join(invalid)})
+
+            try:
+                results = batcher.submit(seqData).result()
+            except Exception as error:
+                return self.reply(500, {'error': str(error)})
+
+            self.reply(200, {'proteins': results})
+
+        def log_message(self, format, *args):
+            logging.debug('%s - ' + format, self.address_string(), *args)
+
+    server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,156 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from pathlib import Path
+import logging
+import subprocess
+import numpy as np
+from .FastaIO import readFasta
+
+prefilterMethods = ['kmer', 'phmmer']
+
+# Residue -> code for the k-mer seeds; any other letter (X, B, U, ...) breaks a seed
+aminoAcids = "ACDEFGHIKLMNPQRSTVWY"
+_residueCodes = np.full(256, 255, dtype=np.uint8)
+for _code, _aa in enumerate(aminoAcids):
+    _residueCodes[ord(_aa)] = _code
+    _residueCodes[ord(_aa.lower())] = _code
+
+def kmerCodes(seq: str, k: int) -> tuple :
+    """ Integer codes of the k-mers of seq made only of standard residues, and their start positions """
+
+    residues = _residueCodes[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    if len(residues) < k:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    windows = np.lib.stride_tricks.sliding_window_view(residues, k)
+    valid = (windows != 255).all(axis=1)
+    codes = windows.astype(np.int64) @ (len(aminoAcids) ** np.arange(k - 1, -1, -1, dtype=np.int64))
+
+    return codes[valid], np.flatnonzero(valid)
+
+@dataclass
+class KmerIndex:
+    """ Every k-mer of the target DB, sorted by code, with the DB sequence and position it comes from """
+
+    k: int
+    codes: np.ndarray
+    seqIds: np.ndarray
+    positions: np.ndarray
+
+    def buildIndex(targetDB: Path, k: int) -> KmerIndex :
+
+        codes, seqIds, positions = [], [], []
+        for seqId, (name, seq) in enumerate(readFasta(targetDB)):
+            seqCodes, seqPositions = kmerCodes(seq, k)
+            codes.append(seqCodes)
+            positions.append(seqPositions)
+            seqIds.append(np.full(len(seqCodes), seqId, dtype=np.int32))
+
+        codes = np.concatenate(codes)
+        order = np.argsort(codes, kind='stable')
+
+        return KmerIndex(k=k, codes=codes[order], seqIds=np.concatenate(seqIds)[order],
+                         positions=np.concatenate(positions)[order].astype(np.int32))
+
+    def diagonalScore(self, seq: str, band: int, exclude: int = -1) -> int :
+        """
+            Largest number of seed (exact k-mer) matches between seq and one DB sequence on one diagonal band.
+            Homologous stretches put many seeds on the same diagonal, chance matches scatter.
+            exclude: DB sequence id to ignore (leave-one-out evaluation)
+        """
+
+        codes, queryPositions = kmerCodes(seq, self.k)
+        lo = np.searchsorted(self.codes, codes, side='left')
+        counts = np.searchsorted(self.codes, codes, side='right') - lo
+        nMatches = int(counts.sum())
+        if nMatches == 0:
+            return 0
+
+        matches = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(nMatches)
+        seqIds = self.seqIds[matches].astype(np.int64)
+        diagonals = (self.positions[matches] - np.repeat(queryPositions, counts)) // band
+
+        keep = seqIds != exclude
+        if not keep.any():
+            return 0
+
+        _, hits = np.unique((seqIds[keep] << 32) + diagonals[keep], return_counts=True)
+        return int(hits.max())
+
+_indexes = {}
+
+def loadIndex(targetDB: Path, k: int) -> KmerIndex :
+    """ Resident k-mer index of targetDB, built on first use in each process """
+
+    key = (Path(targetDB).resolve(), k)
+    if key not in _indexes:
+        logging.info('Prefilter: indexing ' + str(targetDB) + ' - started')
+        _indexes[key] = KmerIndex.buildIndex(targetDB, k)
+        logging.info('Prefilter: indexing ' + str(targetDB) + ' - done, ' + str(len(_indexes[key].codes)) + ' ' + str(k) + '-mers')
+
+    return _indexes[key]
+
+@dataclass
+class Prefilter:
+    """
+        Cheap pre-screen deciding which proteins go through jackhmmer and the predictors.
+
+        kmer:   diagonal seed score against the target DB (no external tool); candidates score >= minScore.
+        phmmer: one phmmer pass against the target DB; candidates have a hit with E-value <= evalue.
+
+        Only the settings are held here, so the object is cheap to send to worker processes;
+        the k-mer index is built once per process by loadIndex.
+    """
+
+    method: str
+    targetDB: Path
+    minScore: int = 10
+    evalue: float = 1e-3
+    k: int = 5
+    band: int = 16
+
+    def screen(self, seqData: dict, processedFasta: Path, output_directory: Path, threads: int) -> tuple :
+        """ Returns (candidates: name -> sequence, skipped: name -> prefilter score) """
+
+        logging.info('Prefilter (' + self.method + ') - started')
+
+        if self.method == 'kmer':
+            index = loadIndex(self.targetDB, self.k)
+            scores = {name: index.diagonalScore(seqData[name], self.band) for name in seqData}
+            passed = {name for name in seqData if scores[name] >= self.minScore}
+        elif self.method == 'phmmer':
+            scores = self.runPhmmer(processedFasta, output_directory, threads)
+            passed = set(scores)
+        else:
+            raise ValueError('Unknown prefilter method ' + self.method + ', expected one of ' + ', '.join(prefilterMethods))
+
+        candidates = {name: seqData[name] for name in seqData if name in passed}
+        skipped = {name: scores.get(name, 0) for name in seqData if name not in passed}
+        logging.info('Prefilter (' + self.method + ') - done, ' + str(len(candidates)) + ' candidates, ' + str(len(skipped)) + ' skipped')
+
+        return candidates, skipped
+
+    def runPhmmer(self, processedFasta: Path, output_directory: Path, threads: int) -> dict :
+        """ Best full-sequence bit score of every query with at least one hit below the E-value cutoff """
+
+        tblout = str(output_directory) + "/" + str(processedFasta.stem) + '.prefilter.tbl'
+        subprocess.run(["phmmer",
+                        "--cpu", str(threads),
+                        "-o", "/dev/null",
+                        "--noali",
+                        "-E", str(self.evalue),
+                        "--tblout", tblout,
+                        processedFasta,
+                        self.targetDB,
+                        ],
+                       stdout=subprocess.PIPE)
+
+        scores = {}
+        with open(tblout, 'r') as tblFile:
+            for line in tblFile:
+                if line.startswith('#'):
+                    continue
+                fields = line.split()
+                scores[fields[2]] = max(scores.get(fields[2], float('-inf')), float(fields[5]))
+
+        return scores
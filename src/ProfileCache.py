@@ -0,0 +1,131 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from pathlib import Path
+import hashlib
+import logging
+import os
+import numpy as np
+
+# A full cache is evicted down to this fraction of maxBytes, so that the next batch does not list it again
+evictTarget = 0.9
+
+@dataclass
+class ProfileCache:
+    """
+        On-disk, content-addressed cache of per-protein (L, 40) profiles.
+
+        Each profile is stored as <directory>/<key[:2]>/<key>.npy, the key being the SHA-256 of the sequence,
+        the target DB hash and the jackhmmer parameters, so a profile is only reused when all three match.
+        Entries are evicted least-recently-used first (file mtime, refreshed on every hit) once the cache
+        grows above maxBytes. size is the running total of the entry sizes (scanned by loadCache, then counted by put),
+        so that checking for a full cache does not list the directory.
+    """
+
+    directory: Path
+    maxBytes: int
+    contextHash: str
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    stored: int = 0
+    size: int = 0
+
+    def loadCache(directory: Path, maxBytes: int, targetDB: Path, params: list) -> ProfileCache :
+        """ Creates the cache directory if needed, hashes the target DB and sizes the entries once """
+
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+        context = hashlib.sha256()
+        with open(targetDB, 'rb') as dbFile:
+            for block in iter(lambda: dbFile.read(1 << 20), b''):
+                context.update(block)
+        context.update(' '.join(params).encode())
+
+        cache = ProfileCache(directory=Path(directory), maxBytes=maxBytes, contextHash=context.hexdigest())
+        cache.size = sum(size for mtime, size, path in cache.entries())
+        return cache
+
+    def key(self, seq: str) -> str:
+        return hashlib.sha256((self.contextHash + ':' + seq).encode()).hexdigest()
+
+    def path(self, seq: str) -> Path:
+        key = self.key(seq)
+        return self.directory / key[:2] / (key + '.npy')
+
+    def get(self, seq: str):
+        """ Returns the cached profile of seq, or None on a miss """
+
+        path = self.path(seq)
+        try:
+            profile = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+
+        if profile.shape[0] != len(seq):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return profile
+
+    def put(self, seq: str, profile: np.ndarray):
+        """ Stores a profile; written to a temporary file first so concurrent workers never read partial entries """
+
+        path = self.path(seq)
+        path.parent.mkdir(exist_ok=True)
+        tmpPath = path.with_name(path.name + '.' + str(os.getpid()) + '.tmp')
+        with open(tmpPath, 'wb') as tmpFile:
+            np.save(tmpFile, profile)
+            self.size += tmpFile.tell()
+        os.replace(tmpPath, path)
+        self.stored += 1
+
+    def entries(self) -> list:
+        """ (mtime, size, path) of every entry, listing the whole cache directory """
+
+        entries = []
+        for path in self.directory.glob('*/*.npy'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+    def evictIfFull(self):
+        """ evict, only once the running size exceeds maxBytes """
+
+        if self.size > self.maxBytes:
+            self.evict()
+
+    def evict(self):
+        """
+            Lists the cache and, if it is larger than maxBytes, deletes least-recently-used entries until it fits
+            in evictTarget * maxBytes. Also resets the running size (e.g. after entries stored by other processes).
+        """
+
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, path in entries)
+        target = total if total <= self.maxBytes else evictTarget * self.maxBytes
+
+        for mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+        self.size = total
+        if self.evictions:
+            logging.info('Profile cache: ' + str(self.evictions) + ' entries evicted, ' + str(total) + ' bytes kept')
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'stored': self.stored, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
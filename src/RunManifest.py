@@ -0,0 +1,100 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+
+# Pipeline stages in run order; a stage recorded again with different files invalidates every later stage.
+# Sub-stages ('hmm/<batch>') share the position of their stage.
+stageOrder = ['fasta_proc', 'hmm', 'features', 'probabilities']
+manifestName = 'nlrexpress.manifest.json'
+
+def fileChecksum(path: Path) -> str:
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as inputFile:
+        for block in iter(lambda: inputFile.read(1 << 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+@dataclass
+class RunManifest:
+    """
+        Stage completion record of one pipeline run directory, kept in <directory>/nlrexpress.manifest.json.
+
+        context: SHA-256 of the input FASTA and the run settings; a manifest written for another context is discarded.
+        stages:  stage -> {'files': {path relative to the directory: SHA-256}, 'completed': timestamp}
+
+        A stage only counts as complete when every one of its files is still present with the recorded checksum,
+        so a re-invocation resumes at the first stage whose outputs are missing, truncated or changed.
+    """
+
+    path: Path
+    context: str
+    stages: dict = field(default_factory=dict)
+
+    def loadManifest(directory: Path, inputFasta: Path, settings: dict, restart: bool = False) -> RunManifest :
+
+        context = hashlib.sha256()
+        context.update(fileChecksum(inputFasta).encode())
+        context.update(json.dumps(settings, sort_keys=True, default=str).encode())
+
+        manifest = RunManifest(path=Path(directory) / manifestName, context=context.hexdigest())
+        if restart or not manifest.path.exists():
+            return manifest
+
+        try:
+            with open(manifest.path, 'r') as manifestFile:
+                recorded = json.load(manifestFile)
+        except (ValueError, OSError):
+            logging.warning('Run manifest ' + str(manifest.path) + ' is unreadable, starting over')
+            return manifest
+
+        if recorded.get('context') != manifest.context:
+            logging.info('Run manifest: input or settings changed since the last run, starting over')
+        else:
+            manifest.stages = recorded.get('stages', {})
+            logging.info('Run manifest: resuming, recorded stages ' + ', '.join(manifest.stages))
+
+        return manifest
+
+    def isComplete(self, stage: str) -> bool:
+        """ True if stage was recorded and all its files still match their checksums """
+
+        if stage not in self.stages:
+            return False
+
+        directory = self.path.parent
+        for name, checksum in self.stages[stage]['files'].items():
+            if not (directory / name).exists() or fileChecksum(directory / name) != checksum:
+                logging.info('Run manifest: ' + name + ' is missing or changed, stage ' + stage + ' will be run again')
+                return False
+
+        return True
+
+    def files(self, stage: str) -> list:
+        """ Paths of the files recorded for stage, in recording order """
+
+        return [self.path.parent / name for name in self.stages[stage]['files']]
+
+    def complete(self, stage: str, files: list):
+        """ Records stage with the checksums of its files; later stages are dropped if they changed """
+
+        checksums = {os.path.relpath(f, self.path.parent): fileChecksum(f) for f in files}
+        if stage in self.stages and self.stages[stage]['files'] == checksums:
+            return
+
+        position = stageOrder.index(stage.split('/')[0])
+        self.stages = {name: record for name, record in self.stages.items() if stageOrder.index(name.split('/')[0]) <= position}
+        self.stages[stage] = {'files': checksums, 'completed': datetime.now().isoformat(timespec='seconds')}
+        self.save()
+
+    def save(self):
+        """ Written to a temporary file first, so an interrupted run never leaves a partial manifest """
+
+        tmpPath = self.path.with_name(self.path.name + '.' + str(os.getpid()) + '.tmp')
+        with open(tmpPath, 'w') as manifestFile:
+            json.dump({'context': self.context, 'stages': self.stages}, manifestFile, indent=1)
+        os.replace(tmpPath, self.path)
@@ -0,0 +1,169 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+import json
+import logging
+import resource
+import sys
+import time
+
+profilers = ['cProfile', 'pyinstrument']
+
+def peakRssMb() -> float:
+    """ Peak resident set size of this process so far (ru_maxrss is in KB on Linux, bytes on macOS) """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def childrenCpu() -> float:
+    """ CPU seconds of the finished child processes (jackhmmer, phmmer) """
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+@dataclass
+class RunReport:
+    """
+        Per-stage wall time, CPU time (own and of child processes), peak RSS and throughput counters of a run.
+
+        Stages are recorded through stage(name, **counters); every numeric counter (proteins, residues, windows, rows)
+        also gets a <counter>_per_sec rate. Stages whose name starts with one of profileStages are run under
+        cProfile or pyinstrument and their profile is written to profileDir.
+        A stage started while another one is running (e.g. batches scored during jackhmmer_overlapped) is recorded
+        with within set to the outermost running stage, whose time already covers it.
+    """
+
+    stages: list = field(default_factory=list)
+    profileStages: list = field(default_factory=list)
+    profiler: str = 'cProfile'
+    profileDir: Path = None
+    started: str = field(default_factory=lambda: datetime.now().isoformat(timespec='seconds'))
+    startWall: float = field(default_factory=time.perf_counter)
+    startCpu: float = field(default_factory=time.process_time)
+    startChildrenCpu: float = field(default_factory=childrenCpu)
+    running: list = field(default_factory=list)
+
+    @contextmanager
+    def stage(self, name: str, **counters):
+        """ Times the enclosed block; counters can also be set on the yielded record once they are known """
+
+        record = {'stage': name, **counters}
+        if self.running:
+            record['within'] = self.running[0]
+        self.running.append(name)
+        profiler = self.startProfiler(name)
+        wall, cpu, children = time.perf_counter(), time.process_time(), childrenCpu()
+
+        try:
+            yield record
+        finally:
+            self.running.remove(name)
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            record['children_cpu_seconds'] = childrenCpu() - children
+            record['peak_rss_mb'] = peakRssMb()
+            for counter in [key for key in record if key not in stageFields and isinstance(record[key], (int, float))]:
+                record[counter + '_per_sec'] = record[counter] / max(record['wall_seconds'], 1e-9)
+
+            if profiler is not None:
+                self.stopProfiler(profiler, name)
+            self.stages.append(record)
+
+            logging.debug('Stage ' + name + ': ' + ', '.join(key + ' ' + (str(round(val, 3)) if isinstance(val, float) else str(val))
+                                                             for key, val in record.items() if key != 'stage'))
+
+    def startProfiler(self, name: str):
+
+        if self.profileDir is None or not any(name.startswith(prefix) for prefix in self.profileStages):
+            return None
+
+        if self.profiler == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                raise ImportError('Stage profiling with pyinstrument requires pyinstrument (pip install pyinstrument)')
+            profiler = Profiler()
+            profiler.start()
+        else:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        return profiler
+
+    def stopProfiler(self, profiler, name: str):
+
+        Path(self.profileDir).mkdir(parents=True, exist_ok=True)
+        fileName = name.replace('/', '_')
+
+        if self.profiler == 'pyinstrument':
+            profiler.stop()
+            path = Path(self.profileDir) / (fileName + '.html')
+            with open(path, 'w') as profileFile:
+                profileFile.write(profiler.output_html())
+        else:
+            profiler.disable()
+            path = Path(self.profileDir) / (fileName + '.prof')
+            profiler.dump_stats(path)
+
+        logging.info('Profile of stage ' + name + ' written to ' + str(path))
+
+    def summary(self) -> dict :
+        """
+            Stage records aggregated by stage name (times and counters summed, rates recomputed, peak RSS maxed).
+            Records within another stage are left out, so that no time is counted twice; they stay in stages.
+        """
+
+        totals = {}
+        for record in self.stages:
+            if 'within' in record:
+                continue
+            total = totals.setdefault(record['stage'], {'calls': 0})
+            total['calls'] += 1
+            for key, val in record.items():
+                if key == 'peak_rss_mb':
+                    total[key] = max(total.get(key, 0), val)
+                elif isinstance(val, (int, float)) and not key.endswith('_per_sec'):
+                    total[key] = total.get(key, 0) + val
+
+        for total in totals.values():
+            for counter in [key for key in total if key not in stageFields and key != 'calls']:
+                total[counter + '_per_sec'] = total[counter] / max(total['wall_seconds'], 1e-9)
+
+        return totals
+
+    def write(self, path: Path):
+
+        report = {'command': sys.argv,
+                  'started': self.started,
+                  'wall_seconds': time.perf_counter() - self.startWall,
+                  'cpu_seconds': time.process_time() - self.startCpu,
+                  'children_cpu_seconds': childrenCpu() - self.startChildrenCpu,
+                  'peak_rss_mb': peakRssMb(),
+                  'summary': self.summary(),
+                  'stages': self.stages}
+
+        with open(path, 'w') as reportFile:
+            json.dump(report, reportFile, indent=1)
+        logging.info('Run report written to ' + str(path))
+
+stageFields = {'stage', 'shard', 'within', 'wall_seconds', 'cpu_seconds', 'children_cpu_seconds', 'peak_rss_mb'}
+
+_report = RunReport()
+
+def startReport(profileStages: list = None, profiler: str = 'cProfile', profileDir: Path = None) -> RunReport :
+    """ Replaces the report of this process by a new one """
+
+    global _report
+    _report = RunReport(profileStages=list(profileStages or []), profiler=profiler, profileDir=profileDir)
+    return _report
+
+def currentReport() -> RunReport :
+    return _report
+
+def stage(name: str, **counters):
+    """ report.stage of the current report """
+
+    return _report.stage(name, **counters)
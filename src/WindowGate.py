@@ -0,0 +1,202 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from pathlib import Path
+import hashlib
+import logging
+import numpy as np
+from .FeaturesData import windowWidth, windowView, nFeatures, featuresDtype
+
+gatesName = 'nlrexpress_gates.npz'
+# Gates keeping a larger fraction of their calibration windows cost more than the predictor runs they save
+maxCandidates = 0.5
+
+@dataclass
+class LinearGate:
+    """
+        Cheap pre-screen of the windows of one motif: a linear model over the flattened window profile, fitted to
+        the logit of the motif's MLP probability. Windows scoring below threshold are not passed to the MLP.
+
+        modelHash is the hash of the (float64) model the gate was fitted against; hits is the number of the model's hits
+        among the calibration windows, recall and candidates the fraction of those hits and of all windows kept.
+    """
+
+    coef: np.ndarray
+    intercept: float
+    threshold: float
+    modelHash: str
+    recall: float = 1.0
+    candidates: float = 1.0
+    hits: int = 0
+
+    def fit(X: np.ndarray, proba: np.ndarray, modelHash: str, cutoff: float = 0.2, recall: float = 1.0,
+            margin: float = 2.0, ridge: float = 1.0) -> LinearGate :
+        """
+            Ridge regression of the clipped logit of proba (the MLP hit probabilities of the rows of X) on X.
+            The threshold keeps the given fraction of the windows with proba >= cutoff, lowered by margin
+            (logit units) for windows unlike the calibration ones. Without any calibration hit the gate keeps everything.
+        """
+
+        X = np.asarray(X, dtype=np.float64)
+        proba = np.asarray(proba, dtype=np.float64)
+        target = np.clip(np.log(np.clip(proba, 1e-12, 1)) - np.log(np.clip(1 - proba, 1e-12, 1)), -10, 10)
+
+        mean, targetMean = X.mean(axis=0), target.mean()
+        centered = X - mean
+        gram = centered.T @ centered
+        gram[np.diag_indices_from(gram)] += ridge * len(X)
+        coef = np.linalg.solve(gram, centered.T @ (target - targetMean))
+        intercept = float(targetMean - mean @ coef)
+
+        hits = proba >= cutoff
+        if not hits.any():
+            return LinearGate(coef=coef.astype(featuresDtype), intercept=intercept, threshold=-np.inf, modelHash=modelHash)
+
+        scores = X @ coef + intercept
+        threshold = float(np.quantile(scores[hits], 1 - recall, method='lower')) - margin
+        return LinearGate(coef=coef.astype(featuresDtype), intercept=intercept, threshold=threshold, modelHash=modelHash,
+                          recall=float((scores[hits] >= threshold).mean()), candidates=float((scores >= threshold).mean()),
+                          hits=int(hits.sum()))
+
+    def gatedHash(self, modelHash: str) -> str :
+        """ modelHash combined with the gate, so that gated and full probabilities are told apart """
+
+        checksum = hashlib.sha256((modelHash + '/gate/' + repr(self.intercept) + '/' + repr(self.threshold)).encode())
+        checksum.update(np.ascontiguousarray(self.coef).tobytes())
+        return checksum.hexdigest()
+
+@dataclass
+class GateSet:
+    """
+        motif -> LinearGate, fitted by fitGates and stored next to the models.
+        cutoff: hit probability the thresholds were calibrated for
+    """
+
+    gates: dict
+    cutoff: float
+    source: Path = None
+
+    def save(self, path: Path):
+
+        arrays = {'cutoff': np.array(self.cutoff)}
+        for motif, gate in self.gates.items():
+            arrays[motif + '/coef'] = gate.coef
+            arrays[motif + '/intercept'] = np.array(gate.intercept)
+            arrays[motif + '/threshold'] = np.array(gate.threshold)
+            arrays[motif + '/model_hash'] = np.array(gate.modelHash)
+            arrays[motif + '/recall'] = np.array(gate.recall)
+            arrays[motif + '/candidates'] = np.array(gate.candidates)
+            arrays[motif + '/hits'] = np.array(gate.hits)
+
+        np.savez(path, **arrays)
+        logging.info('Window gates written to ' + str(path))
+
+    def loadGates(path: Path) -> GateSet :
+
+        gates = {}
+        with np.load(path, allow_pickle=False) as data:
+            for motif in sorted({key.split('/')[0] for key in data.files if '/' in key}):
+                gates[motif] = LinearGate(coef=data[motif + '/coef'], intercept=float(data[motif + '/intercept']),
+                                          threshold=float(data[motif + '/threshold']), modelHash=str(data[motif + '/model_hash']),
+                                          recall=float(data[motif + '/recall']), candidates=float(data[motif + '/candidates']),
+                                          hits=int(data[motif + '/hits']))
+            cutoff = float(data['cutoff'])
+
+        return GateSet(gates=gates, cutoff=cutoff, source=Path(path))
+
+    def validGates(self, modelHashes: dict) -> dict :
+        """
+            The gates fitted against the current models (the others are left out with a warning)
+            that keep at most maxCandidates of their calibration windows
+        """
+
+        valid = {}
+        for motif, gate in self.gates.items():
+            if modelHashes.get(motif) == gate.modelHash:
+                if gate.candidates <= maxCandidates:
+                    valid[motif] = gate
+            elif motif in modelHashes:
+                logging.warning('Window gate of ' + motif + ' was fitted for another model, running full inference for it')
+
+        return valid
+
+def fitGates(inputData, predictors: dict, modelHashes: dict, cutoff: float = 0.2, recall: float = 1.0,
+             margin: float = 2.0) -> GateSet :
+    """ Fits one LinearGate per predictor on all windows of inputData, against that predictor's probabilities """
+
+    gates = {}
+    for motif, model in predictors.items():
+        X = stackedWindows(inputData, windowWidth(motif))
+        if len(X):
+            gates[motif] = LinearGate.fit(X, np.asarray(model.predict_proba(X))[:, 1], modelHashes[motif], cutoff, recall, margin)
+        else:
+            gates[motif] = LinearGate(coef=np.zeros(X.shape[1], dtype=featuresDtype), intercept=0.0, threshold=-np.inf,
+                                      modelHash=modelHashes[motif])
+        logging.info('Window gate ' + motif + ': ' + str(gates[motif].hits) + ' calibration hits, recall ' + str(round(gates[motif].recall, 4))
+                     + ', candidates ' + str(round(gates[motif].candidates, 4)) + ' of ' + str(len(X)) + ' windows')
+
+    return GateSet(gates=gates, cutoff=cutoff)
+
+def stackedWindows(inputData, width: int) -> np.ndarray :
+
+    features, rows = stackProfiles(inputData, width)
+    return windowView(features, width)[rows] if len(rows) else np.empty((0, width * nFeatures), dtype=features.dtype)
+
+def stackProfiles(inputData, width: int) -> tuple :
+    """
+        All profiles as one (N, nFeatures) array, and the row of each window of the given width in it,
+        in generateWindowMat order (windows never cross two proteins)
+    """
+
+    profiles = list(inputData.hmmData.values())
+    if not profiles:
+        return np.empty((0, nFeatures), dtype=featuresDtype), np.empty(0, dtype=np.int64)
+
+    lengths = np.array([len(profile) for profile in profiles], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    nWindows = np.maximum(lengths - width + 1, 0)
+    rows = np.repeat(offsets - (np.cumsum(nWindows) - nWindows), nWindows) + np.arange(nWindows.sum())
+
+    return np.concatenate(profiles), rows
+
+def gateScores(features: np.ndarray, width: int, coef: np.ndarray, intercept: np.ndarray) -> np.ndarray :
+    """
+        Linear gate scores of every window start of features, for gates of one width stacked as coef
+        (width * nFeatures, nGates). Summed over the window offsets, so the windows are never materialized.
+    """
+
+    nWindows = features.shape[0] - width + 1
+    if nWindows <= 0:
+        return np.empty((0, coef.shape[1]), dtype=coef.dtype)
+
+    coef = coef.reshape(width, nFeatures, coef.shape[1])
+    scores = np.broadcast_to(intercept.astype(coef.dtype), (nWindows, coef.shape[2])).copy()
+    for offset in range(width):
+        scores += features[offset:offset + nWindows] @ coef[offset]
+
+    return scores
+
+def candidateWindows(inputData, width: int, gates: dict) -> tuple :
+    """
+        Windows of the given width passing the gates of motif -> LinearGate (all of that width).
+        Returns the stacked profiles, the row of every window in them, and motif -> boolean mask over the windows.
+    """
+
+    features, rows = stackProfiles(inputData, width)
+    motifs = list(gates)
+    coef = np.stack([gates[motif].coef for motif in motifs], axis=1)
+    intercept = np.array([gates[motif].intercept for motif in motifs])
+    scores = gateScores(features, width, coef, intercept)[rows]
+
+    return features, rows, {motif: scores[:, k] >= gates[motif].threshold for k, motif in enumerate(motifs)}
+
+_gateSets = {}
+
+def loadGateSet(path: Path) -> GateSet :
+    """ Returns the resident GateSet of path, loading it on first use """
+
+    path = Path(path).resolve()
+    if path not in _gateSets:
+        _gateSets[path] = GateSet.loadGates(path)
+        logging.info('Window gates loaded from ' + str(path))
+
+    return _gateSets[path]
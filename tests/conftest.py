@@ -0,0 +1,54 @@
+from pathlib import Path
+import os
+import sys
+import pytest
+
+scriptDir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(scriptDir))
+
+from src.FastaIO import readFasta, writeFasta
+from src.FeaturesData import FeaturesData, generateInputFile, iterHmmProfiles
+from src.ModelRegistry import ModelRegistry, _registries
+
+modelsDir = scriptDir / 'models'
+sampleDir = scriptDir / 'sample' / 'output_ref'
+
+@pytest.fixture
+def pickleRegistry(monkeypatch):
+    """ The sklearn pickles as resident registry, whether or not a bundle was exported """
+
+    if not (modelsDir / 'MLP_NBS_MHD.pkl').exists():
+        pytest.skip('predictor models not downloaded (see README)')
+
+    registry = ModelRegistry.loadPickles(modelsDir)
+    monkeypatch.setitem(_registries, (modelsDir.resolve(), 'float64'), registry)
+    return registry
+
+@pytest.fixture(scope='session')
+def sampleFeatures() -> FeaturesData:
+    """ Features of the zar1_rpp1 sample, from the reference jackhmmer output """
+
+    seqData = dict(readFasta(sampleDir / 'zar1_rpp1.fasta_proc'))
+    hmm_it1 = dict(iterHmmProfiles(sampleDir / 'zar1_rpp1-1.hmm'))
+    hmm_it2 = dict(iterHmmProfiles(sampleDir / 'zar1_rpp1-2.hmm'))
+
+    return FeaturesData(seqData=seqData, hmmData=generateInputFile(seqData, hmm_it1, hmm_it2))
+
+@pytest.fixture
+def fakeJackhmmer(tmp_path, monkeypatch) -> Path:
+    """ tests/fake_jackhmmer.py first on PATH as jackhmmer; returns its directory """
+
+    binDir = tmp_path / 'bin'
+    binDir.mkdir()
+    script = binDir / 'jackhmmer'
+    script.write_text('#!/bin/sh\nexec ' + sys.executable + ' ' + str(Path(__file__).resolve().parent / 'fake_jackhmmer.py') + ' "$@"\n')
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', str(binDir) + os.pathsep + os.environ['PATH'])
+    return binDir
+
+def sampleCopies(path: Path, copies: int) -> Path:
+    """ FASTA of copies renamed copies of the sample proteins """
+
+    proteins = list(readFasta(sampleDir / 'zar1_rpp1.fasta_proc'))
+    writeFasta({name + '_' + str(k): seq for k in range(copies) for name, seq in proteins}, path)
+    return path
@@ -0,0 +1,48 @@
+"""
+    Stand-in for jackhmmer in the tests: writes the --chkhmm checkpoints of the query proteins from the reference output of
+    the zar1_rpp1 sample (proteins are matched by sequence, so renamed copies work). Batches whose FASTA stem is listed in
+    FAKE_JACKHMMER_FAIL exit with status 1 without writing anything; with FAKE_JACKHMMER_ONE_ITERATION only -1.hmm is written.
+    The stem of every query is appended to the file FAKE_JACKHMMER_LOG, if set.
+"""
+
+from pathlib import Path
+import os
+import re
+import sys
+
+sampleDir = Path(__file__).resolve().parent.parent / 'sample' / 'output_ref'
+sys.path.insert(0, str(sampleDir.parent.parent))
+from src.FastaIO import readFasta
+
+def records(path: Path) -> dict:
+
+    found, lines = {}, []
+    with open(path) as hmmFile:
+        for line in hmmFile:
+            lines.append(line)
+            if line.startswith('//'):
+                text = ''.join(lines)
+                found[re.search(r'^NAME\s+(\S+)', text, re.M).group(1).replace('-i1', '')] = text
+                lines = []
+    return found
+
+def main(args: list):
+
+    prefix, query = args[args.index('--chkhmm') + 1], args[-2]
+    if os.environ.get('FAKE_JACKHMMER_LOG'):
+        with open(os.environ['FAKE_JACKHMMER_LOG'], 'a') as log:
+            log.write(Path(query).stem + '\n')
+    if Path(query).stem in os.environ.get('FAKE_JACKHMMER_FAIL', '').split(','):
+        sys.exit(1)
+
+    reference = {seq: name for name, seq in readFasta(sampleDir / 'zar1_rpp1.fasta_proc')}
+    iterations = (1,) if os.environ.get('FAKE_JACKHMMER_ONE_ITERATION') else (1, 2)
+    for iteration in iterations:
+        hmm = records(sampleDir / ('zar1_rpp1-' + str(iteration) + '.hmm'))
+        with open(prefix + '-' + str(iteration) + '.hmm', 'w') as out:
+            for name, seq in readFasta(query):
+                suffix = '-i1' if iteration == 2 else ''
+                out.write(re.sub(r'^NAME\s+\S+', 'NAME  ' + name + suffix, hmm[reference[seq]], count=1, flags=re.M))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
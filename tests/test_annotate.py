@@ -0,0 +1,39 @@
+import pandas as pd
+
+from nlrexpress import annotate_table
+
+def hitsTable(proteins: dict) -> pd.DataFrame:
+    """ Results table of protein -> motifs, one hit at 90 every 10 residues """
+
+    rows = [(protein, 10 * (k + 1), motif, 90.0) for protein, motifs in proteins.items() for k, motif in enumerate(motifs)]
+    return pd.DataFrame(rows, columns=['protein', 'res_id', 'motif_id', 'probability'])
+
+def test_gap_absorbed_with_its_motifs():
+    """ A single NBS hit between two CC runs is absorbed into one CC run counting all its motifs """
+
+    runs, architectures = annotate_table(hitsTable({'p1': ['extEDVID', 'extEDVID', 'P-loop', 'extEDVID', 'LxxLxL', 'LxxLxL']}))
+
+    assert runs[['domain', 'start', 'end', 'n_motifs']].values.tolist() == [['CC', 10, 40, 4], ['LRR', 50, 60, 2]]
+    assert architectures['architecture'].tolist() == ['CC-LRR']
+
+def test_longer_runs_and_protein_boundaries_kept():
+    """ Runs longer than allowed_gaps, and runs whose neighbours belong to other proteins, are not absorbed """
+
+    runs, architectures = annotate_table(hitsTable({'p1': ['extEDVID', 'P-loop', 'MHD', 'extEDVID'],
+                                                    'p2': ['extEDVID'], 'p3': ['P-loop'], 'p4': ['extEDVID']}))
+
+    assert architectures['architecture'].tolist() == ['CC-NBS-CC', 'CC', 'NBS', 'CC']
+    assert runs['n_motifs'].sum() == 7
+
+def test_alternating_short_runs_kept():
+    """ Alternating single CC and NBS hits are all gap candidates: none of them is dropped """
+
+    runs, architectures = annotate_table(hitsTable({'p1': ['extEDVID', 'P-loop', 'extEDVID', 'P-loop', 'extEDVID', 'LxxLxL']}))
+
+    assert architectures['architecture'].tolist() == ['CC-NBS-CC-NBS-CC-LRR']
+    assert runs['n_motifs'].tolist() == [1] * 6
+
+def test_no_gaps_allowed():
+
+    runs, architectures = annotate_table(hitsTable({'p1': ['extEDVID', 'P-loop', 'extEDVID']}), allowed_gaps=0)
+    assert architectures['architecture'].tolist() == ['CC-NBS-CC']
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+
+from conftest import scriptDir
+from src.FeaturesData import jackhmmerParams, targetDB
+from src.ProfileCache import ProfileCache
+
+def sampleCache(directory, maxBytes: int = 2**30, params: list = jackhmmerParams) -> ProfileCache:
+    return ProfileCache.loadCache(directory=directory, maxBytes=maxBytes, targetDB=scriptDir / targetDB, params=params)
+
+def test_hit_and_miss(sampleFeatures, tmp_path):
+    """ Profiles are returned for the same sequence and context only """
+
+    cache = sampleCache(tmp_path)
+    seq, profile = next(iter(sampleFeatures.seqData.values())), next(iter(sampleFeatures.hmmData.values()))
+
+    assert cache.get(seq) is None
+    cache.put(seq, profile)
+    assert np.array_equal(cache.get(seq), profile)
+    assert cache.get(seq[:-1]) is None
+    assert sampleCache(tmp_path, params=jackhmmerParams + ['--F1', '0.01']).get(seq) is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'stored': 1, 'evictions': 0, 'hit_rate': 1 / 3}
+
+def test_evict_least_recently_used(sampleFeatures, tmp_path, monkeypatch):
+    """ Eviction lists the cache only once the running size exceeds maxBytes, and drops the least recently used entries """
+
+    profiles = [(seq + suffix, np.concatenate([profile, profile[:1]]) if suffix else profile)
+                for seq, profile in zip(sampleFeatures.seqData.values(), sampleFeatures.hmmData.values()) for suffix in ('', 'A')]
+    cache = sampleCache(tmp_path)
+    for k, (seq, profile) in enumerate(profiles):
+        cache.put(seq, profile)
+        os.utime(cache.path(seq), (k, k))
+    entrySizes = [cache.path(seq).stat().st_size for seq, profile in profiles]
+    assert cache.size == sum(entrySizes)
+
+    listings = []
+    entries = cache.entries
+    monkeypatch.setattr(cache, 'entries', lambda: listings.append(1) or entries())
+
+    cache.maxBytes = cache.size
+    cache.evictIfFull()
+    assert listings == [] and cache.evictions == 0
+
+    # Fits in evictTarget of maxBytes once the two oldest entries are gone, not before
+    cache.maxBytes = int(sum(entrySizes[2:]) / 0.9) + 1
+    cache.evictIfFull()
+    assert listings == [1] and cache.evictions == 2
+    assert [cache.path(seq).exists() for seq, profile in profiles] == [False, False, True, True]
+    assert cache.size == sum(entrySizes[2:]) <= 0.9 * cache.maxBytes
+    assert sampleCache(tmp_path).size == cache.size
@@ -0,0 +1,53 @@
+import gzip
+import json
+import pytest
+
+from src.FastaIO import partsManifestSuffix, readFasta, readParts, splitFasta
+
+# Header comment before the first record, descriptions, wrapped sequences, and no newline after the last line
+fastaText = ';comment line\n>p1 first protein\nMKV\nLLA\n>p2\nMK V\n>p3 x\nM\n>p4\nMKVLLAAG\n>p5\nMKVL'
+records = [('p1', 'MKVLLA'), ('p2', 'MKV'), ('p3', 'M'), ('p4', 'MKVLLAAG'), ('p5', 'MKVL')]
+
+@pytest.fixture(params=['plain', 'gzip'])
+def fasta(request, tmp_path):
+
+    if request.param == 'gzip':
+        path = tmp_path / 'input.fasta.gz'
+        with gzip.open(path, 'wt') as fastaFile:
+            fastaFile.write(fastaText)
+    else:
+        path = tmp_path / 'input.fasta'
+        path.write_text(fastaText)
+    return path
+
+def test_read_fasta(fasta):
+    assert list(readFasta(fasta)) == records
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_split_by_count(fasta, tmp_path, compress):
+    """ Every part but the last holds exactly batchsize records, all in input order, listed in the manifest """
+
+    outdir = tmp_path / 'parts'
+    outdir.mkdir()
+    parts = splitFasta(fasta, outdir, batchsize=2, compress=compress, threads=2)
+
+    assert [path.name for path in parts] == ['input_part_' + str(k) + ('.fasta.gz' if compress else '.fasta') for k in (1, 2, 3)]
+    assert [list(readFasta(path)) for path in parts] == [records[:2], records[2:4], records[4:]]
+
+    manifest = json.loads((outdir / ('input' + partsManifestSuffix)).read_text())
+    assert manifest == {'input': str(fasta), 'batch_size': 2, 'max_residues': None,
+                        'parts': [{'path': parts[0].name, 'proteins': 2, 'residues': 9},
+                                  {'path': parts[1].name, 'proteins': 2, 'residues': 9},
+                                  {'path': parts[2].name, 'proteins': 1, 'residues': 4}]}
+    assert readParts(outdir / ('input' + partsManifestSuffix)) == parts
+
+def test_split_by_residues(fasta, tmp_path):
+    """ A part is closed once it reaches maxResidues, or batchsize records, whichever comes first """
+
+    parts = splitFasta(fasta, tmp_path, batchsize=3, maxResidues=7)
+
+    assert [[name for name, seq in readFasta(path)] for path in parts] == [['p1', 'p2'], ['p3', 'p4'], ['p5']]
+
+def test_split_needs_a_limit(fasta, tmp_path):
+    with pytest.raises(ValueError):
+        splitFasta(fasta, tmp_path)
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from conftest import sampleDir
+from benchmark import generateInputFile_reference, generateXmat_reference
+from src.FastaIO import readFasta
+from src.FeaturesData import FeaturesData, allMotifs, generateInputFile, generateXmat, iterHmmProfiles, parse_hmm_multiprot
+
+@pytest.fixture(scope='module')
+def referenceFeatures() -> FeaturesData:
+    """ Sample features through the list-based parse_hmm_multiprot / generateInputFile pair """
+
+    seqData = dict(readFasta(sampleDir / 'zar1_rpp1.fasta_proc'))
+    hmm_it1 = parse_hmm_multiprot(sampleDir / 'zar1_rpp1-1.hmm')
+    hmm_it2 = parse_hmm_multiprot(sampleDir / 'zar1_rpp1-2.hmm')
+
+    return FeaturesData(seqData=seqData, hmmData=generateInputFile_reference(seqData, hmm_it1, hmm_it2))
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_windows_match_legacy(referenceFeatures, dtype):
+    """ X is bit-identical to the list-of-lists X with float64 profiles, and to its float32 cast with float32 ones """
+
+    seqData = referenceFeatures.seqData
+    hmm_it1 = dict(iterHmmProfiles(sampleDir / 'zar1_rpp1-1.hmm', dtype))
+    hmm_it2 = dict(iterHmmProfiles(sampleDir / 'zar1_rpp1-2.hmm', dtype))
+    inputData = FeaturesData(seqData=seqData, hmmData=generateInputFile(seqData, hmm_it1, hmm_it2, dtype))
+
+    for motif in allMotifs:
+        X = generateXmat(inputData, motif)
+        assert X.dtype == dtype
+        assert np.array_equal(X, np.array(generateXmat_reference(referenceFeatures, motif), dtype=dtype)), motif
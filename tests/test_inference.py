@@ -0,0 +1,50 @@
+import os
+import pickle
+import shutil
+import numpy as np
+import pytest
+
+from conftest import modelsDir
+from nlrexpress import predict_motifs, results_table
+from src.FeaturesData import FeaturesData, generateXmat
+from src.ModelRegistry import ModelRegistry, NumpyMLP, bundleName, modelFiles, modelHash, _registries
+
+@pytest.mark.parametrize('fused', [False, True])
+def test_all_skipped_batch(pickleRegistry, fused):
+    """ A batch the prefilter left empty gives empty predictions and results, not a sklearn error """
+
+    inputData = FeaturesData(seqData={}, hmmData={}, skipped={'decoy': 2})
+    results = predict_motifs(inputData, fused)
+
+    assert list(results) == list(pickleRegistry.predictors)
+    assert all(proba.shape == (0, 2) for proba in results.values())
+    assert len(results_table(inputData, results)) == 0
+
+def test_numpy_forward_matches_sklearn(pickleRegistry, sampleFeatures):
+    """ NumpyMLP reproduces MLPClassifier.predict_proba to 1e-6 on the sample windows """
+
+    for name, model in pickleRegistry.predictors.items():
+        X = generateXmat(sampleFeatures, name)
+        deviation = np.abs(NumpyMLP.fromSklearn(model).predict_proba(X) - model.predict_proba(X)).max()
+        assert deviation <= 1e-6, name
+
+def test_bundle_of_other_pickles_not_loaded(pickleRegistry, tmp_path):
+    """ A pickle replaced after export is loaded instead of the bundle, even with an older modification time """
+
+    for module in modelFiles:
+        for fileName in modelFiles[module].values():
+            shutil.copy2(modelsDir / fileName, tmp_path / fileName)
+    ModelRegistry.loadPickles(tmp_path).exportBundle(tmp_path / bundleName)
+    assert ModelRegistry.loadRegistry(tmp_path).source == tmp_path / bundleName
+
+    retrained = pickle.loads(pickle.dumps(pickleRegistry.predictors['MHD']))
+    retrained.coefs_[0] = retrained.coefs_[0] * 1.01
+    with open(tmp_path / modelFiles['NBSexpress']['MHD'], 'wb') as modelFile:
+        pickle.dump(retrained, modelFile)
+    os.utime(tmp_path / modelFiles['NBSexpress']['MHD'], (0, 0))
+
+    _registries.pop((tmp_path.resolve(), 'float64'))
+    registry = ModelRegistry.loadRegistry(tmp_path)
+    _registries.pop((tmp_path.resolve(), 'float64'))
+    assert registry.source == tmp_path
+    assert registry.modelHashes()['MHD'] == modelHash(retrained)
@@ -0,0 +1,28 @@
+import numpy as np
+
+from nlrexpress import predict_motifs
+from src.FeaturesData import allMotifs, windowWidth
+from src.OutputData import ProbabilityStore, ProbabilityWriter
+
+def test_probability_store_round_trip(pickleRegistry, sampleFeatures, tmp_path):
+    """ Residue rows of the memory-mapped store hold each motif's window probability at the window's motif start """
+
+    results = predict_motifs(sampleFeatures)
+    writer = ProbabilityWriter.openProbabilities(tmp_path, list(results), 'float32')
+    writer.write(sampleFeatures, results)
+    writer.close()
+
+    store = ProbabilityStore.openStore(tmp_path)
+    assert store.motifs == list(results) and store.names.tolist() == list(sampleFeatures.seqData)
+
+    offset = {motif: 0 for motif in results}
+    for name, seq in sampleFeatures.seqData.items():
+        rows = store.protein(name)
+        assert rows.shape == (len(seq), len(results))
+        for m, motif in enumerate(results):
+            nWindows = len(seq) - windowWidth(motif) + 1
+            windLeft = allMotifs[motif]['windLeft']
+            expected = results[motif][offset[motif]:offset[motif] + nWindows, 1].astype(np.float32)
+            assert np.array_equal(rows[windLeft:windLeft + nWindows, m], expected)
+            assert np.isnan(rows[:windLeft, m]).all() and np.isnan(rows[windLeft + nWindows:, m]).all()
+            offset[motif] += nWindows
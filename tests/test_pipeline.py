@@ -0,0 +1,62 @@
+import json
+import subprocess
+import pytest
+
+import src.FeaturesData as FeaturesModule
+from conftest import sampleCopies
+from nlrexpress import run_stages
+from src.RunReport import startReport
+
+@pytest.mark.parametrize('threads, overlap', [(1, False), (4, False), (4, True)])
+def test_jackhmmer_scheduling(pickleRegistry, fakeJackhmmer, tmp_path, monkeypatch, threads, overlap):
+    """ Runs without overlap go through scheduleJackhmmer, overlapped ones through overlapJackhmmer """
+
+    calls = []
+    for function in ('scheduleJackhmmer', 'overlapJackhmmer'):
+        original = getattr(FeaturesModule, function)
+        monkeypatch.setattr(FeaturesModule, function, lambda *args, original=original, function=function, **kwargs:
+                            calls.append(function) or original(*args, **kwargs))
+
+    report = startReport()
+    output = tmp_path / 'out'
+    output.mkdir()
+    inputData, results = run_stages(sampleCopies(tmp_path / 'copies.fa', 3), output, threads, jackhmmer_cpus=1, overlap=overlap)
+
+    stages = {record['stage'] for record in report.stages}
+    assert calls == ['overlapJackhmmer' if overlap else 'scheduleJackhmmer']
+    assert ('jackhmmer_overlapped' in stages) == overlap and ('jackhmmer' in stages) != overlap
+    assert len(inputData.hmmData) == 6 and all(len(proba) for proba in results.values())
+
+@pytest.mark.parametrize('overlap', [False, True])
+def test_resume_after_failed_batch(pickleRegistry, fakeJackhmmer, tmp_path, monkeypatch, overlap):
+    """ A batch whose jackhmmer failed stops the run and is not recorded, so that resuming searches it again """
+
+    fasta = sampleCopies(tmp_path / 'copies.fa', 3)
+    output = tmp_path / 'out'
+    output.mkdir()
+    log = tmp_path / 'searched.txt'
+    monkeypatch.setenv('FAKE_JACKHMMER_LOG', str(log))
+
+    monkeypatch.setenv('FAKE_JACKHMMER_FAIL', 'copies_batch_2')
+    with pytest.raises(subprocess.CalledProcessError):
+        run_stages(fasta, output, 4, jackhmmer_cpus=1, overlap=overlap)
+    stages = json.loads((output / 'nlrexpress.manifest.json').read_text())['stages']
+    assert 'hmm/copies_batch_2' not in stages and 'hmm/copies_batch_1' in stages
+
+    monkeypatch.delenv('FAKE_JACKHMMER_FAIL')
+    log.write_text('')
+    inputData, results = run_stages(fasta, output, 4, jackhmmer_cpus=1, overlap=overlap)
+    assert log.read_text().split() == ['copies_batch_2']
+    assert len(inputData.hmmData) == 6 and all(len(proba) for proba in results.values())
+
+def test_batch_without_second_iteration_not_recorded(pickleRegistry, fakeJackhmmer, tmp_path, monkeypatch):
+    """ Batches whose second iteration is missing are scored from the first one and searched again when resuming """
+
+    monkeypatch.setenv('FAKE_JACKHMMER_ONE_ITERATION', '1')
+    output = tmp_path / 'out'
+    output.mkdir()
+    inputData, results = run_stages(sampleCopies(tmp_path / 'copies.fa', 3), output, 4, jackhmmer_cpus=1)
+
+    stages = json.loads((output / 'nlrexpress.manifest.json').read_text())['stages']
+    assert not [name for name in stages if name.startswith('hmm/')]
+    assert len(inputData.hmmData) == 6
@@ -0,0 +1,26 @@
+import threading
+
+from src.RunReport import RunReport
+
+def test_stages_within_another_stage_are_not_summed_twice():
+    """ A stage recorded (here in another thread) while an enclosing stage runs is tagged and left out of the summary """
+
+    report = RunReport()
+
+    def scoreBatch():
+        with report.stage('predict_proba/MHD', windows=10):
+            pass
+
+    with report.stage('read_fasta', proteins=2):
+        pass
+    with report.stage('jackhmmer_overlapped', proteins=2):
+        consumer = threading.Thread(target=scoreBatch)
+        consumer.start()
+        consumer.join()
+    with report.stage('predict_proba/MHD', windows=5):
+        pass
+
+    assert [record.get('within') for record in report.stages] == [None, 'jackhmmer_overlapped', None, None]
+    summary = report.summary()
+    assert list(summary) == ['read_fasta', 'jackhmmer_overlapped', 'predict_proba/MHD']
+    assert summary['predict_proba/MHD']['calls'] == 1 and summary['predict_proba/MHD']['windows'] == 5
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from benchmark import results_table_reference, synthetic_results
+from nlrexpress import predict_motifs, results_table
+
+# Probabilities around the 0.2 cutoff once rounded to 4 decimals (NumPy rounds 0.19995 up, Python's round of a float down)
+boundary = [0.2, 0.19995, 0.199950001, 0.19994999, 0.20004999, 0.1999, 0.2001]
+
+@pytest.mark.parametrize('cutoff', [0.2, 0.8])
+def test_results_table_matches_reference(pickleRegistry, sampleFeatures, cutoff):
+    """ The vectorised table equals the per-residue loop on the sample, with probabilities placed on the rounding boundary """
+
+    results = predict_motifs(sampleFeatures)
+    for motif, proba in results.items():
+        positive = proba[:, 1].copy()
+        positive[:: max(1, len(positive) // len(boundary))][:len(boundary)] = boundary
+        results[motif] = np.column_stack([1 - positive, positive])
+
+    table = results_table(sampleFeatures, results, cutoff)
+    assert len(table) and table.equals(results_table_reference(sampleFeatures, results, cutoff))
+
+def test_results_table_matches_reference_synthetic():
+    """ Same on random sequences, including proteins shorter than some window widths """
+
+    inputData, results = synthetic_results(200, 5, 120)
+    assert results_table(inputData, results).equals(results_table_reference(inputData, results))
@@ -0,0 +1,55 @@
+from concurrent.futures import Future
+from functools import partial
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+
+from conftest import sampleDir
+from nlrexpress import serve_batch
+from src.FastaIO import readFasta
+from src.PredictionServer import MicroBatcher, makeServer
+
+@pytest.fixture
+def server():
+    """ HTTP front end of a batcher whose process only records the batches; yields (base url, batches) """
+
+    batches = []
+    batcher = MicroBatcher(process=lambda seqData: batches.append(seqData) or {name: len(seq) for name, seq in seqData.items()}).start()
+    httpServer = makeServer('127.0.0.1', 0, batcher)
+    threading.Thread(target=httpServer.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:' + str(httpServer.server_address[1]), batches
+    httpServer.shutdown()
+
+def post(url: str, body: dict) -> tuple:
+
+    request = urllib.request.Request(url + '/predict', data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+def test_bad_sequence_rejected(server):
+    """ Sequences with non-residue characters get a 400 and never reach the batcher """
+
+    url, batches = server
+    status, body = post(url, {'sequences': {'ok': 'MKV', 'bad': 'MKV1>'}})
+    assert status == 400 and 'bad' in body['error'] and 'ok' not in body['error']
+    assert batches == []
+
+    status, body = post(url, {'sequences': {'ok': ' mk\nv\r\n'}})
+    assert status == 200 and body['proteins'] == {'ok': 3}
+
+def test_failure_isolated_to_its_request(pickleRegistry, fakeJackhmmer, tmp_path):
+    """ A request jackhmmer fails on (a sequence the stand-in does not know) does not fail the requests batched with it """
+
+    batcher = MicroBatcher(process=partial(serve_batch, work_directory=tmp_path, threads=1))
+    requests = [dict(readFasta(sampleDir / 'zar1_rpp1.fasta_proc')), {'unknown': 'MKVLLAAGHRST' * 10}]
+    futures = [Future() for request in requests]
+    batcher.runBatch(list(zip(requests, futures)))
+
+    results = futures[0].result()
+    assert sorted(results) == sorted(requests[0]) and all(results[name]['hits'] for name in results)
+    assert futures[1].exception() is not None